@@ -5,8 +5,12 @@ api.py - Flask Web API 服务
 
 import logging
 import os
-from datetime import datetime
-from flask import Flask, jsonify, request, send_from_directory
+from datetime import date, datetime
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
+
+import hourkey
+from ratering import MAX_WINDOW, pick_resolution
+from stream import Broadcaster
 
 logger = logging.getLogger('sentinel.api')
 
@@ -21,7 +25,15 @@ def fmt_bytes(b: int) -> str:
     return f"{b:.2f} PB"
 
 
-def create_app(db, capture):
+# 各粒度序列行的标签字段，以及小时键到该字段取值的换算
+SERIES_LABEL = {
+    'hour':  ('hour_ts', hourkey.hour_str),
+    'day':   ('day',     lambda k: hourkey.day_str(k // 24)),
+    'month': ('month',   lambda k: hourkey.month_str(hourkey.month_of_hour(k))),
+}
+
+
+def create_app(db, capture, max_stream_clients=None):
     app = Flask(__name__, static_folder='static')
     app.config['JSON_SORT_KEYS'] = False
 
@@ -29,9 +41,55 @@ def create_app(db, capture):
     def index():
         return send_from_directory('static', 'index.html')
 
+    @app.after_request
+    def conditional_json(resp):
+        """
+        JSON 接口带 ETag：内容未变时对 If-None-Match 返回 304，浏览器复用本地副本。
+        no-cache 让浏览器每次都带 ETag 重新验证，而不是直接使用可能过期的缓存。
+        """
+        if (request.method == 'GET' and resp.status_code == 200
+                and resp.mimetype == 'application/json' and not resp.is_streamed):
+            resp.add_etag()
+            resp.headers['Cache-Control'] = 'no-cache'
+            resp = resp.make_conditional(request)
+        return resp
+
+    # ── 内存增量叠加 ─────────────────────────────────────────────────────────
+    # 数据库读取结果由 CachedStorage 缓存、仅在写库后失效；尚未写库的内存增量
+    # 不进缓存，每次请求时按小时键归并到对应的小时/天/月行上
+    def overlay_rows(rows, label, keep=None, insert=False):
+        """
+        rows: 数据库返回的序列（原地修改），label = (字段名, hour_key → 该字段取值)
+        只叠加 keep(hour_key) 为真的增量（None 表示全部，落在 rows 之外的自然忽略）；
+        insert=True 时为没有对应行的增量补一行并重新排序。
+        返回叠加到 rows 上的 (up, down) 合计。
+        """
+        field, label_of = label
+        index = {row[field]: row for row in rows}
+        added_up = added_down = 0
+        inserted = False
+        for k, v in capture.stats.get_hourly_snapshot().items():
+            if keep is not None and not keep(k):
+                continue
+            key = label_of(k)
+            row = index.get(key)
+            if row is None:
+                if not insert:
+                    continue
+                row = index[key] = {field: key, 'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0}
+                rows.append(row)
+                inserted = True
+            row['up_bytes']   = (row.get('up_bytes')   or 0) + v['up']
+            row['down_bytes'] = (row.get('down_bytes') or 0) + v['down']
+            if 'total_bytes' in row:
+                row['total_bytes'] = row['up_bytes'] + row['down_bytes']
+            added_up += v['up']; added_down += v['down']
+        if inserted:
+            rows.sort(key=lambda r: r[field])
+        return added_up, added_down
+
     # ── 首屏汇总（今日/本月/本年 + 内存增量）────────────────────────────────────
-    @app.route('/api/summary')
-    def api_summary():
+    def build_summary():
         today_db = db.get_today_stats()
         month_db = db.get_month_stats()
         year_db  = db.get_year_stats()
@@ -39,16 +97,16 @@ def create_app(db, capture):
         # 取内存快照（线程安全），避免裸读时 flush_and_get() 并发 clear() 造成空读
         mem       = capture.stats.get_hourly_snapshot()
         # 严格基于容器本地时间（已由 app.py 调用 time.tzset() 激活 TZ 变量）
-        now       = datetime.now()
-        today_str = now.strftime('%Y-%m-%d')
-        month_str = now.strftime('%Y-%m')
-        year_str  = now.strftime('%Y')
+        today     = date.today()
+        today_key = hourkey.day_key_of(today)
+        month_key = hourkey.month_key_of(today)
 
         t_up = t_dn = m_up = m_dn = y_up = y_dn = 0
         for k, v in mem.items():
-            if k.startswith(today_str): t_up += v['up']; t_dn += v['down']
-            if k.startswith(month_str): m_up += v['up']; m_dn += v['down']
-            if k.startswith(year_str):  y_up += v['up']; y_dn += v['down']
+            mk = hourkey.month_of_hour(k)
+            if k // 24 == today_key:     t_up += v['up']; t_dn += v['down']
+            if mk == month_key:          m_up += v['up']; m_dn += v['down']
+            if mk // 12 == today.year:   y_up += v['up']; y_dn += v['down']
 
         def stat(db_row, du, dd):
             u = (db_row.get('up_bytes')   or 0) + du
@@ -56,11 +114,15 @@ def create_app(db, capture):
             return {'up_bytes': u, 'down_bytes': d, 'total_bytes': u+d,
                     'up_fmt': fmt_bytes(u), 'down_fmt': fmt_bytes(d), 'total_fmt': fmt_bytes(u+d)}
 
-        return jsonify({
+        return {
             'today':  stat(today_db, t_up, t_dn),
             'month':  stat(month_db, m_up, m_dn),
             'year':   stat(year_db,  y_up, y_dn),
-        })
+        }
+
+    @app.route('/api/summary')
+    def api_summary():
+        return jsonify(build_summary())
 
     # ── 日期范围查询（核心接口）──────────────────────────────────────────────────
     @app.route('/api/query')
@@ -87,25 +149,13 @@ def create_app(db, capture):
 
         result = db.query_range(start, end, gran)
 
-        # 若查询范围包含今天，叠加内存增量到今天那条
-        # 使用 datetime.now() 而非 date.today()，两者在 tzset() 后等价，但保持一致性
-        today_str = datetime.now().strftime('%Y-%m-%d')
-        if start <= today_str <= end and gran == 'day':
-            mem   = capture.stats.get_hourly_snapshot()  # 线程安全快照
-            mem_u = mem_d = 0
-            for k, v in mem.items():
-                if k.startswith(today_str):
-                    mem_u += v['up']; mem_d += v['down']
-            if mem_u or mem_d:
-                for row in result['series']:
-                    if row.get('day') == today_str:
-                        row['up_bytes']    = (row.get('up_bytes')    or 0) + mem_u
-                        row['down_bytes']  = (row.get('down_bytes')  or 0) + mem_d
-                        row['total_bytes'] = row['up_bytes'] + row['down_bytes']
-                        break
-                result['summary']['up_bytes']    += mem_u
-                result['summary']['down_bytes']  += mem_d
-                result['summary']['total_bytes'] += mem_u + mem_d
+        # 叠加范围内尚未写库的内存增量（series 中缺少的小时/天/月补一行）
+        first, last = hourkey.parse_day(start), hourkey.parse_day(end)
+        in_range = lambda k: first * 24 <= k < (last + 1) * 24
+        mem_u, mem_d = overlay_rows(result['series'], SERIES_LABEL[gran], in_range, insert=True)
+        result['summary']['up_bytes']    += mem_u
+        result['summary']['down_bytes']  += mem_d
+        result['summary']['total_bytes'] += mem_u + mem_d
 
         # 格式化 summary
         s = result['summary']
@@ -118,19 +168,26 @@ def create_app(db, capture):
     @app.route('/api/history/30days')
     def api_history_30days():
         days = db.get_last_30days()
+        overlay_rows(days, SERIES_LABEL['day'])
         return jsonify({'days': days})
 
     # ── 最近12个月 ───────────────────────────────────────────────────────────
     @app.route('/api/history/12months')
     def api_history_12months():
         months = db.get_last_12months()
+        overlay_rows(months, SERIES_LABEL['month'])
         return jsonify({'months': months})
 
     # ── 今日24小时分布 ────────────────────────────────────────────────────────
+    def build_today_hours():
+        hours = db.get_hourly_today()
+        today_key = hourkey.day_key_of(date.today())
+        overlay_rows(hours, SERIES_LABEL['hour'], lambda k: k // 24 == today_key, insert=True)
+        return {'hours': hours}
+
     @app.route('/api/history/today_hours')
     def api_today_hours():
-        hours = db.get_hourly_today()
-        return jsonify({'hours': hours})
+        return jsonify(build_today_hours())
 
     # ── 数据库可用日期范围 ─────────────────────────────────────────────────────
     @app.route('/api/date_range')
@@ -138,28 +195,111 @@ def create_app(db, capture):
         return jsonify(db.get_available_date_range())
 
     # ── 实时速率（降为辅助接口，仅保留当前速率，不再是主角）──────────────────────
-    @app.route('/api/realtime')
-    def api_realtime():
-        samples = capture.get_realtime(seconds=60)
-        cur_up = cur_down = 0
+    def build_speed(samples):
+        cur_up = cur_down = ts = 0
         if samples:
             last = samples[-1]
-            cur_up, cur_down = last['up'], last['down']
-        return jsonify({
-            'samples': samples[-30:],   # 只返回最近30个点，够显示迷你图即可
+            cur_up, cur_down, ts = last['up'], last['down'], last['ts']
+        return {
+            'ts': ts,
             'current_up_bps': cur_up * 8,
             'current_down_bps': cur_down * 8,
             'current_up_Bps': cur_up,
             'current_down_Bps': cur_down,
-        })
+        }
+
+    @app.route('/api/realtime')
+    def api_realtime():
+        """
+        参数:
+          window  采样窗口秒数（默认 30，最大 48 小时）
+        10 分钟以内逐秒采样，6 小时以内每 10 秒，更长每分钟（桶内平均字节/秒）。
+        """
+        try:
+            window = max(1, min(int(request.args.get('window', 30)), MAX_WINDOW))
+        except ValueError:
+            return jsonify({'error': 'window must be an integer number of seconds'}), 400
+        result = {
+            'window': window,
+            'resolution': pick_resolution(window),
+            'samples': capture.get_realtime(seconds=window),
+        }
+        result.update(build_speed(capture.get_realtime(seconds=5)))
+        return jsonify(result)
 
     # ── TOP IP ────────────────────────────────────────────────────────────────
     @app.route('/api/top_ips')
     def api_top_ips():
-        top = capture.get_top_ips(10)
-        for item in top:
-            item['bytes_fmt'] = fmt_bytes(item['bytes'])
-        return jsonify({'top_ips': top})
+        """
+        参数:
+          start  YYYY-MM-DD（默认今天）
+          end    YYYY-MM-DD（默认同 start）
+          n      返回条数（默认 10，最大 100）
+        数据库中按天预聚合的 IP 统计 + 内存中尚未写库的增量。
+        内存与数据库中的数值都是确定下界，error_bound 为任一 IP 可能少计的字节数上限
+        （0 表示精确）：内存计数器的误差与截断部分，加上范围内已持久化的长尾行字节数。
+        """
+        today = date.today().strftime('%Y-%m-%d')
+        start = request.args.get('start', '') or today
+        end   = request.args.get('end', '') or start
+        try:
+            hourkey.parse_day(start)
+            hourkey.parse_day(end)
+            n = max(1, min(int(request.args.get('n', 10)), 100))
+        except ValueError:
+            return jsonify({'error': 'Invalid parameters, use start/end=YYYY-MM-DD and integer n'}), 400
+        return jsonify(build_top_ips(start, end, n))
+
+    def build_top_ips(start: str, end: str, n: int):
+        first, last = hourkey.parse_day(start), hourkey.parse_day(end)
+        totals = {r['ip']: r['bytes'] for r in db.get_top_ips(start, end, n)}
+        # 内存部分只取每个小时的前 n 项，未列出部分的上限计入 error_bound
+        mem, truncated = capture.stats.get_ip_top(first * 24, (last + 1) * 24 - 1, n)
+        if mem:
+            # 内存中排名靠前、但不在数据库前 n 名里的 IP，补查其已持久化的部分再合并排名
+            mem_top = sorted(mem, key=mem.get, reverse=True)[:n]
+            missing = [ip for ip in mem_top if ip not in totals]
+            if missing:
+                totals.update(db.get_ip_bytes(start, end, missing))
+            for ip in set(totals) | set(mem_top):
+                totals[ip] = totals.get(ip, 0) + mem.get(ip, 0)
+
+        top = sorted(totals.items(), key=lambda x: x[1], reverse=True)[:n]
+        # 已持久化的部分同样是下界：无法归属与压缩并入的字节都在长尾行里
+        error_bound = capture.stats.ip_error_bound() + truncated + db.get_ip_other_bytes(start, end)
+        return {
+            'start': start,
+            'end': end,
+            'top_ips': [{'ip': ip, 'bytes': b, 'bytes_fmt': fmt_bytes(b)} for ip, b in top],
+            'error_bound': error_bound,
+            'error_bound_fmt': fmt_bytes(error_bound),
+        }
+
+    # ── 推送流（SSE）─────────────────────────────────────────────────────────
+    # 所有连接共用一个广播线程：每类事件按周期只计算一次，内容变化时才推送
+    def today_top_ips():
+        today = date.today().strftime('%Y-%m-%d')
+        return build_top_ips(today, today, 10)
+
+    broadcaster = Broadcaster({
+        'speed':   (1,  lambda: build_speed(capture.get_realtime(seconds=5))),
+        'summary': (5,  build_summary),
+        'top_ips': (10, today_top_ips),
+        'hours':   (30, build_today_hours),
+    }, max_clients=max_stream_clients)
+
+    @app.route('/api/stream')
+    def api_stream():
+        """
+        Server-Sent Events：speed（每秒）、summary、top_ips、hours（内容变化时），
+        事件负载与 /api/realtime、/api/summary、/api/top_ips、/api/history/today_hours 相同。
+        连接数已满时返回 503，页面改用轮询。
+        """
+        q = broadcaster.subscribe()
+        if q is None:
+            return jsonify({'error': 'Too many stream clients, use polling endpoints'}), 503
+        return Response(stream_with_context(broadcaster.stream(q)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
     @app.route('/api/health')
     def api_health():
@@ -170,6 +310,8 @@ def create_app(db, capture):
             'kernel_drops_last_60s': capture.kernel_drops_last_60s,
             # 实际生效的 socket 接收缓冲区（KB），低于 16384 时 BT 高并发易丢包
             'socket_buffer_actual_kb': capture.socket_buffer_actual_kb,
+            # 数据库文件 / WAL / 空闲页占用，以及最近一次每日维护的结果与耗时（尚未运行为 null）
+            'database': {**db.get_storage_info(), 'last_maintenance': db.last_maintenance},
         })
 
 
@@ -180,14 +322,14 @@ def create_app(db, capture):
         用于验证公网 IPv6 是否被正确识别，确认上下行方向判断是否准确。
         访问：http://<NAS_IP>:<PORT>/api/debug/local_ips
         """
-        ips = sorted(capture.local_ips)
+        # 本机 IP 与 LAN 过滤前缀（手动或自动检测的 /56）取自同一份快照，
+        # 与抓包线程正在使用的判定规则完全一致
+        state = capture.local_state
+        ips = sorted(state.ips)
         v4 = [ip for ip in ips if ':' not in ip]
         v6 = [ip for ip in ips if ':' in ip]
-
-        # 读取当前生效的 LAN 过滤前缀（手动或自动检测的 /56）
-        with capture._local_ips_lock:
-            lan_prefixes = [str(n) for n in capture._lan_prefixes]
-        manual_mode = capture._manual_mode
+        lan_prefixes = [str(n) for n in state.lan_prefixes]
+        manual_mode = capture.manual_mode
 
         return jsonify({
             'iface': os.environ.get('MONITOR_IFACE', 'eth0'),
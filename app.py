@@ -2,16 +2,27 @@
 """
 NetTraffic-Sentinel - NAS公网流量监控程序
 主程序入口：启动抓包线程、数据库持久化、Web API服务
+PROCESS_MODE=split 时本进程只做监管：抓包与 API 各自运行在独立进程中，经共享内存交换实时状态
 """
 
 import os
 import sys
+import signal
 import threading
 import time
 import logging
+import multiprocessing
+from datetime import datetime
+from typing import Dict
+from cache import CachedStorage
 from capture import PacketCapture
-from database import Database
+from colstore import ColumnarStore
+from database import IP_OTHER, Database
+from journal import SpillJournal
+from livestate import LiveStatePublisher, LiveStateView, create_segment
+from storage import StorageBackend
 from api import create_app
+from server import serve
 
 logging.basicConfig(
     level=logging.INFO,
@@ -51,39 +62,107 @@ EXCLUDE_IPV6_PREFIX = os.environ.get('EXCLUDE_IPV6_PREFIX', '')
 WEB_PORT         = int(os.environ.get('WEB_PORT', '8080'))
 SAVE_INTERVAL    = int(os.environ.get('SAVE_INTERVAL', '300'))  # 秒
 DB_PATH          = os.environ.get('DB_PATH', '/data/traffic.db')
+CAPTURE_BACKEND  = os.environ.get('CAPTURE_BACKEND', 'recv').strip().lower()  # recv | mmap
+CAPTURE_SNAPLEN  = int(os.environ.get('CAPTURE_SNAPLEN', '128'))  # 字节，0 = 不截断
+CAPTURE_WORKERS  = int(os.environ.get('CAPTURE_WORKERS', '1'))  # >1 启用 PACKET_FANOUT 多进程
+CAPTURE_PREFILTER = os.environ.get('CAPTURE_PREFILTER', '1') not in ('0', 'false', 'no', 'off')
+CAPTURE_VECTORIZE = os.environ.get('CAPTURE_VECTORIZE', '1') not in ('0', 'false', 'no', 'off')
+JOURNAL_INTERVAL = float(os.environ.get('JOURNAL_INTERVAL', '5'))  # 秒，0 = 关闭溢写日志
+IP_RETENTION_DAYS = int(os.environ.get('IP_RETENTION_DAYS', '400'))  # 按天 IP 统计保留天数，0 = 永久
+IP_SKETCH_CAPACITY = int(os.environ.get('IP_SKETCH_CAPACITY', '10000'))  # 每小时精确跟踪的远端 IP 数上限
+HOURLY_RETENTION_MONTHS = int(os.environ.get('HOURLY_RETENTION_MONTHS', '24'))  # 小时明细保留月数，0 = 永久
+DAILY_RETENTION_YEARS = int(os.environ.get('DAILY_RETENTION_YEARS', '10'))      # 天汇总保留年数，0 = 永久
+MAINTENANCE_HOUR = int(os.environ.get('MAINTENANCE_HOUR', '4'))                # 每日维护的本地整点（低流量时段）
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'sqlite').lower()            # sqlite | columnar
+WEB_SERVER = os.environ.get('WEB_SERVER', 'waitress').strip().lower()            # waitress | dev
+WEB_THREADS = max(2, int(os.environ.get('WEB_THREADS', '8')))                    # Web 工作线程数
+WEB_NICE = int(os.environ.get('WEB_NICE', '0'))                                  # 拆分进程模式下 Web 线程的 nice 值，0 = 不调整
+PROCESS_MODE = os.environ.get('PROCESS_MODE', 'single').strip().lower()          # single | split
 
-def persistence_loop(db: Database, capture: PacketCapture, interval: int):
+# 维护线程检查是否到达维护时段的间隔（秒）
+MAINTENANCE_CHECK_INTERVAL = 60
+
+# 拆分进程模式：检查子进程存活的间隔（秒），同时起到重启退避的作用
+PROCESS_CHECK_INTERVAL = 5
+
+# 拆分进程模式：等待抓包进程首次发布共享状态的最长时间（秒），超时后照常启动 API 进程
+CAPTURE_READY_TIMEOUT = 30
+
+def persistence_loop(db: StorageBackend, capture: PacketCapture, interval: int):
     """定期将内存统计数据刷写到数据库"""
     while True:
         time.sleep(interval)
         try:
-            stats = capture.flush_stats()
-            db.commit_stats(stats)
-            logger.info(f"Stats flushed to DB: {len(stats)} records")
+            # 提交成功后才丢弃内存数据；失败时数据保留，下个周期重试
+            records, elapsed = capture.flush_stats(db.commit_stats)
+            logger.info(f"Stats flushed to DB: {records} records in {elapsed * 1000:.1f} ms")
         except Exception as e:
-            logger.error(f"Persistence error: {e}")
+            logger.error(f"Persistence error (data kept in memory for retry): {e}")
 
-def main():
-    # ── 第一步：激活时区（必须在任何 datetime 调用之前执行）──────────────
-    setup_timezone()
 
-    logger.info("="*50)
-    logger.info("  NetTraffic-Sentinel starting up")
-    logger.info(f"  Interface : {MONITOR_IFACE}")
-    logger.info(f"  Web Port  : {WEB_PORT}")
-    logger.info(f"  DB Path   : {DB_PATH}")
-    logger.info(f"  Save Interval: {SAVE_INTERVAL}s")
-    logger.info("="*50)
+def maintenance_loop(db: StorageBackend):
+    """每天在 MAINTENANCE_HOUR 点执行一次保留策略、IP 统计压缩与增量 VACUUM"""
+    last_run_day = None
+    while True:
+        time.sleep(MAINTENANCE_CHECK_INTERVAL)
+        now = datetime.now()
+        if now.hour != MAINTENANCE_HOUR or now.date() == last_run_day:
+            continue
+        last_run_day = now.date()
+        try:
+            db.run_maintenance(HOURLY_RETENTION_MONTHS, DAILY_RETENTION_YEARS, IP_RETENTION_DAYS)
+        except Exception as e:
+            logger.error(f"Maintenance error: {e}")
+
 
-    # 初始化数据库
+def replay_journal(db: StorageBackend, journal: SpillJournal):
+    """
+    启动时把上次运行残留的溢写日志写入数据库，成功后删除对应分段。
+    代次与数据在同一事务内记录，已写入的分段（写库后、删除前崩溃）会被跳过。
+    日志不含远端 IP 明细，重放的字节记到长尾行 IP_OTHER 上，使 IP 表按小时的合计
+    仍与流量计数器一致。
+    """
+    hourly, last_gen = journal.replay(db.journal_generation())
+    if not last_gen:
+        return
+    if hourly:
+        ip_hourly = {hour_key: {IP_OTHER: v['up'] + v['down']} for hour_key, v in hourly.items()}
+        db.commit_stats(hourly, ip_hourly, journal_gen=last_gen)
+        total = sum(v['up'] + v['down'] for v in hourly.values())
+        logger.info(f"[Journal] Replayed {len(hourly)} hourly records ({total} bytes) from spill journal")
+    journal.discard(last_gen)
+
+
+def open_storage() -> StorageBackend:
+    """按 STORAGE_BACKEND 创建存储（尚未初始化）：SQLite 始终存在（远端 IP 统计与维护），columnar 时流量计数器改存列式文件"""
     db = Database(DB_PATH)
-    db.init_schema()
+    if STORAGE_BACKEND == 'columnar':
+        db = ColumnarStore(os.path.join(os.path.dirname(DB_PATH), 'columnar'), db)
+    elif STORAGE_BACKEND != 'sqlite':
+        logger.warning(f"Unknown storage backend '{STORAGE_BACKEND}', using 'sqlite'")
+    return db
+
+
+def start_capture(db: StorageBackend) -> PacketCapture:
+    """重放溢写日志，启动抓包、持久化与维护线程"""
+    # 溢写日志：与数据库同目录，先重放上次崩溃残留的增量再开始抓包
+    journal = None
+    if JOURNAL_INTERVAL > 0:
+        journal = SpillJournal(os.path.join(os.path.dirname(DB_PATH), 'journal'), JOURNAL_INTERVAL)
+        replay_journal(db, journal)
 
     # 初始化抓包模块
     ipv6_prefixes = [p.strip() for p in EXCLUDE_IPV6_PREFIX.split(',') if p.strip()]
     capture = PacketCapture(
         iface=MONITOR_IFACE,
-        exclude_ipv6_prefixes=ipv6_prefixes
+        exclude_ipv6_prefixes=ipv6_prefixes,
+        capture_backend=CAPTURE_BACKEND,
+        snaplen=CAPTURE_SNAPLEN,
+        prefilter=CAPTURE_PREFILTER,
+        workers=CAPTURE_WORKERS,
+        vectorize=CAPTURE_VECTORIZE,
+        journal=journal,
+        ip_capacity=IP_SKETCH_CAPACITY,
     )
 
     # 启动抓包线程
@@ -101,10 +180,129 @@ def main():
     persist_thread.start()
     logger.info(f"Persistence thread started (interval={SAVE_INTERVAL}s)")
 
-    # 启动 Web API
-    app = create_app(db, capture)
+    # 启动维护线程（保留策略 / 压缩 / VACUUM）
+    maint_thread = threading.Thread(target=maintenance_loop, args=(db,), daemon=True, name='maintenance')
+    maint_thread.start()
+    logger.info(f"Maintenance thread started (daily at {MAINTENANCE_HOUR:02d}:00, "
+                f"hourly={HOURLY_RETENTION_MONTHS or 'forever'} months, "
+                f"daily={DAILY_RETENTION_YEARS or 'forever'} years)")
+    return capture
+
+
+def serve_api(db: StorageBackend, capture, nice: int = 0):
+    """
+    阻塞运行 Web API；capture 为 PacketCapture 或拆分进程模式下的 LiveStateView。
+    nice 只在拆分进程模式下传入：单进程模式中降低优先级的请求线程持有 GIL 时被抢占，
+    抓包线程反而要等它，见 server.py。
+    """
+    # 每个 SSE 连接独占一个工作线程，最多占用一半，其余留给普通请求
+    app = create_app(db, capture, max_stream_clients=WEB_THREADS // 2)
     logger.info(f"Web dashboard available at http://0.0.0.0:{WEB_PORT}")
-    app.run(host='0.0.0.0', port=WEB_PORT, debug=False, threaded=True)
+    serve(app, '0.0.0.0', WEB_PORT, server=WEB_SERVER, threads=WEB_THREADS, nice=nice)
+
+
+# ── 拆分进程模式（PROCESS_MODE=split）────────────────────────────────────────
+
+def _exit_on_sigterm():
+    """SIGTERM 时正常退出解释器，multiprocessing 借 atexit 回收 daemon 子进程（抓包 fanout 工作进程）"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+
+def capture_process_main(shm_name: str):
+    """抓包进程：抓包、持久化、维护，并把内存状态发布到共享内存"""
+    _exit_on_sigterm()
+    publisher = LiveStatePublisher(shm_name)
+    # 写入版本号随每次写库/维护即时发布，API 进程据此失效查询缓存。
+    # 重启后从段中已发布的版本继续（取下一个偶数且至少前进 1），不会回到 API 进程缓存过的版本
+    db = CachedStorage(open_storage(), on_version=publisher.set_db_version,
+                       initial_version=(publisher.db_version() + 2) & ~1)
+    db.init_schema()
+    capture = start_capture(db)
+    publisher.start(capture, db)
+    logger.info(f"[Supervisor] Capture process {os.getpid()} publishing live state to {shm_name}")
+    while True:
+        time.sleep(3600)
+
+
+def api_process_main(shm_name: str):
+    """API 进程：从共享内存读取实时状态，只读访问存储"""
+    _exit_on_sigterm()
+    view = LiveStateView(shm_name)
+    db = CachedStorage(open_storage(), remote=view)
+    db.attach()
+    logger.info(f"[Supervisor] API process {os.getpid()} reading live state from {shm_name}")
+    serve_api(db, view, nice=WEB_NICE)
+
+
+def supervise():
+    """父进程：创建共享内存段，启动抓包进程与 API 进程，任一方退出时单独重启"""
+    shm = create_segment()
+    ctx = multiprocessing.get_context('spawn')
+    roles = {'capture': capture_process_main, 'api': api_process_main}
+    procs: Dict[str, multiprocessing.Process] = {}
+
+    def spawn(role: str):
+        p = ctx.Process(target=roles[role], args=(shm.name,), name=f'sentinel-{role}')
+        p.start()
+        procs[role] = p
+        logger.info(f"[Supervisor] Started {role} process (pid {p.pid})")
+
+    _exit_on_sigterm()
+    try:
+        spawn('capture')
+        # API 进程以只读方式打开存储，等抓包进程完成结构迁移并首次发布后再启动
+        view = LiveStateView(shm.name)
+        deadline = time.time() + CAPTURE_READY_TIMEOUT
+        while not view.ready and procs['capture'].is_alive() and time.time() < deadline:
+            time.sleep(0.2)
+        view.close()
+        spawn('api')
+
+        while True:
+            time.sleep(PROCESS_CHECK_INTERVAL)
+            for role, p in list(procs.items()):
+                if not p.is_alive():
+                    logger.error(f"[Supervisor] {role} process exited (code {p.exitcode}), restarting")
+                    spawn(role)
+    finally:
+        for p in procs.values():
+            p.terminate()
+        for p in procs.values():
+            p.join(timeout=5)
+        shm.close()
+        shm.unlink()
+
+
+def main():
+    # ── 第一步：激活时区（必须在任何 datetime 调用之前执行）──────────────
+    setup_timezone()
+
+    logger.info("="*50)
+    logger.info("  NetTraffic-Sentinel starting up")
+    logger.info(f"  Interface : {MONITOR_IFACE}")
+    logger.info(f"  Web Port  : {WEB_PORT}")
+    logger.info(f"  DB Path   : {DB_PATH} (storage={STORAGE_BACKEND})")
+    logger.info(f"  Save Interval: {SAVE_INTERVAL}s")
+    logger.info(f"  Journal   : {f'every {JOURNAL_INTERVAL:g}s' if JOURNAL_INTERVAL > 0 else 'off'}")
+    logger.info(f"  Capture   : {CAPTURE_BACKEND} (snaplen={CAPTURE_SNAPLEN}, "
+                f"prefilter={'on' if CAPTURE_PREFILTER else 'off'}, workers={CAPTURE_WORKERS}, "
+                f"vectorize={'on' if CAPTURE_VECTORIZE else 'off'})")
+    logger.info(f"  Processes : {PROCESS_MODE}")
+    logger.info("="*50)
+
+    if PROCESS_MODE == 'split':
+        supervise()
+        return
+    if PROCESS_MODE != 'single':
+        logger.warning(f"Unknown process mode '{PROCESS_MODE}', using 'single'")
+
+    # 读取结果缓存：每次写库/维护后整体失效，API 再叠加内存中尚未写库的增量
+    db = CachedStorage(open_storage())
+    db.init_schema()
+    capture = start_capture(db)
+    if WEB_NICE > 0:
+        logger.info("[Web] WEB_NICE only applies with PROCESS_MODE=split, request threads keep normal priority")
+    serve_api(db, capture)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,98 @@
+"""
+batchring.py - 收包线程与处理线程之间的单生产者/单消费者批次环
+
+queue.Queue 每次 put/get 都要获取 Condition 锁，并为每个元素分配元组，
+处理线程还要为每个包调用一次 get(timeout=...)。高包速率时这部分开销本身
+就会让队列撑满（[Buffer] Packet queue full!）。
+
+BatchRing 针对"恰好一个生产者 + 恰好一个消费者"的场景：
+  - 预分配固定数量的槽位，元素是整批帧（FrameBatch），而非单个包
+  - 写指针只由生产者修改，读指针只由消费者修改，发布/取走一批无需加锁
+  - 消费者空闲等待时才通过 Event 唤醒：生产者每批最多一次 set()，
+    繁忙时完全不触碰任何同步原语
+  - 容量同时按槽位数与在途帧数限制，超出时整批丢弃并计数（不阻塞收包）
+"""
+
+import threading
+from typing import List, Optional, Tuple
+
+
+class BatchRing:
+    """
+    单生产者/单消费者批次环。
+
+    生产者线程调用 put()；消费者线程调用 get()。
+    两端各自只写自己的指针与计数器，依赖 GIL 保证单个属性赋值的原子可见性。
+    """
+
+    def __init__(self, max_frames: int, slots: int = 4096):
+        # 槽位数取 2 的幂，下标用位与代替取模
+        size = 1
+        while size < slots:
+            size <<= 1
+        self._slots: List[Optional[object]] = [None] * size
+        self._mask = size - 1
+        self.max_frames = max_frames
+
+        # 生产者独占写入
+        self._head = 0
+        self._frames_in = 0
+        self.drops = 0
+        # 消费者独占写入
+        self._tail = 0
+        self._frames_out = 0
+        self._waiting = False
+
+        self._wakeup = threading.Event()
+
+    # ── 生产者侧 ──────────────────────────────────────────────────────────────
+
+    def put(self, batch) -> bool:
+        """发布一批帧；槽位或在途帧数已满时丢弃整批并返回 False。"""
+        n = len(batch)
+        head = self._head
+        if (head - self._tail > self._mask
+                or self._frames_in - self._frames_out + n > self.max_frames):
+            self.drops += n
+            return False
+        self._slots[head & self._mask] = batch
+        self._frames_in += n
+        self._head = head + 1          # 写指针最后更新：消费者看到它时槽位已就绪
+        if self._waiting:
+            self._wakeup.set()
+        return True
+
+    # ── 消费者侧 ──────────────────────────────────────────────────────────────
+
+    def get(self, timeout: float = 1.0):
+        """取出下一批帧；timeout 秒内没有数据时返回 None。"""
+        tail = self._tail
+        if tail == self._head:
+            # 先声明等待再复查，避免生产者在两步之间发布却未唤醒
+            self._waiting = True
+            if tail == self._head:
+                self._wakeup.wait(timeout)
+            self._waiting = False
+            self._wakeup.clear()
+            if tail == self._head:
+                return None
+
+        idx = tail & self._mask
+        batch = self._slots[idx]
+        self._slots[idx] = None        # 及时释放引用，便于回收帧缓冲区
+        self._tail = tail + 1
+        return batch
+
+    def task_done(self, batch):
+        """消费者处理完一批后调用，释放其占用的在途帧额度。"""
+        self._frames_out += len(batch)
+
+    # ── 诊断 ──────────────────────────────────────────────────────────────────
+
+    def occupancy(self) -> Tuple[int, int]:
+        """返回 (在途帧数, 帧容量)，与 [PktProcessor] 日志中的 queue depth 对应。"""
+        return self._frames_in - self._frames_out, self.max_frames
+
+    def __len__(self) -> int:
+        """当前排队的批次数。"""
+        return self._head - self._tail
@@ -0,0 +1,248 @@
+"""
+bpf.py - 经典 BPF（cBPF）套接字过滤器
+
+通过 SO_ATTACH_FILTER 把一段 cBPF 程序挂到 AF_PACKET 套接字上，由内核在
+数据包进入套接字缓冲区之前执行：
+  - 返回值 0        → 丢弃，该包完全不会进入用户态
+  - 返回值 N (> 0)  → 接收，且只保留前 N 字节（即 snaplen 截断）
+
+解析器只读取以太网/IP 头（计费长度取自 IP 头字段），因此把每个包截断到
+几十字节并不影响统计精度，却能让拷贝到用户态的数据量下降一个数量级。
+
+prefilter_program() 进一步把"本地侧"地址规则（私有网段、本机地址、LAN 前缀）
+编译进过滤器，与 PacketCapture 的方向判定保持一致：
+  - 非 IPv4/IPv6 帧（ARP 等）                  → 丢弃
+  - 两端都属于本地侧（LAN 内部互传、组播）      → 丢弃
+  - 两端都不属于本地侧（与本机无关的过路流量）   → 丢弃
+  - 恰好一端属于本地侧（真正的公网上下行）       → 接收并截断到 snaplen
+这样局域网内部流量（SMB、组播发现等）完全不会消耗任何 Python 处理时间。
+"""
+
+import ctypes
+import ipaddress
+import socket
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+# ── 指令编码（linux/filter.h）────────────────────────────────────────────────
+BPF_LD   = 0x00
+BPF_ALU  = 0x04
+BPF_JMP  = 0x05
+BPF_RET  = 0x06
+
+BPF_W    = 0x00
+BPF_H    = 0x08
+BPF_B    = 0x10
+BPF_ABS  = 0x20
+
+BPF_AND  = 0x50
+
+BPF_JA   = 0x00
+BPF_JEQ  = 0x10
+BPF_JGT  = 0x20
+BPF_JGE  = 0x30
+
+BPF_K    = 0x00
+
+SO_ATTACH_FILTER = getattr(socket, 'SO_ATTACH_FILTER', 26)
+
+# 接收整包时的返回值（与 tcpdump 默认 snaplen 一致）
+SNAPLEN_MAX = 262144
+
+# struct sock_filter { __u16 code; __u8 jt; __u8 jf; __u32 k; }
+_SOCK_FILTER = struct.Struct('=HBBI')
+
+Insn = Tuple[int, int, int, int]
+
+# 以太网协议类型
+_ETH_P_IP    = 0x0800
+_ETH_P_IPV6  = 0x86DD
+_ETH_P_8021Q = 0x8100
+
+# 条件跳转偏移只有 8 位；地址匹配块超过此指令数时插入 ja 跳板中转
+_TRAMPOLINE_SPAN = 200
+
+
+class _Assembler:
+    """带标签的极简 cBPF 汇编器：跳转目标写标签名，assemble() 时解析为相对偏移。"""
+
+    def __init__(self):
+        self._insns: List[list] = []
+        self._labels: Dict[str, int] = {}
+        self._seq = 0
+
+    def new_label(self, hint: str) -> str:
+        self._seq += 1
+        return f"{hint}_{self._seq}"
+
+    def label(self, name: str):
+        self._labels[name] = len(self._insns)
+
+    def stmt(self, code: int, k: int = 0):
+        self._insns.append([code, None, None, k])
+
+    def jump(self, code: int, k: int, jt: Optional[str] = None, jf: Optional[str] = None):
+        """条件跳转；jt/jf 为 None 表示顺序执行下一条。"""
+        self._insns.append([code, jt, jf, k])
+
+    def ja(self, target: str):
+        self._insns.append([BPF_JMP | BPF_JA, None, None, target])
+
+    def __len__(self):
+        return len(self._insns)
+
+    def assemble(self) -> List[Insn]:
+        program: List[Insn] = []
+        for pc, (code, jt, jf, k) in enumerate(self._insns):
+            def rel(target):
+                if target is None:
+                    return 0
+                off = self._labels[target] - pc - 1
+                if not 0 <= off <= 255:
+                    raise ValueError(f"BPF jump to {target} out of range ({off})")
+                return off
+            if code == BPF_JMP | BPF_JA:
+                k = self._labels[k] - pc - 1
+            else:
+                jt, jf = rel(jt), rel(jf)
+            program.append((code, jt or 0, jf or 0, k & 0xFFFFFFFF))
+        return program
+
+
+Network = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+
+
+def _emit_match(asm: _Assembler, nets: Sequence[Network], addr_off: int, on_match: str):
+    """
+    生成"地址 ∈ nets 中任一网段则跳转 on_match，否则顺序执行"的指令序列。
+    网段按 32 位字逐字比较（IPv4 一个字，IPv6 最多四个字）；
+    块较长时周期性插入 ja 跳板，保证条件跳转偏移不超过 255。
+    """
+    hit = asm.new_label('hit')
+    block_start = len(asm)
+
+    for net in nets:
+        packed = net.network_address.packed
+        plen = net.prefixlen
+        nwords = (plen + 31) // 32
+        if nwords == 0:
+            asm.ja(on_match)   # /0：任意地址均匹配
+            continue
+        next_net = asm.new_label('next')
+        for i in range(nwords):
+            word = struct.unpack_from('!I', packed, i * 4)[0]
+            bits = min(32, plen - i * 32)
+            asm.stmt(BPF_LD | BPF_W | BPF_ABS, addr_off + i * 4)
+            if bits < 32:
+                mask = (0xFFFFFFFF << (32 - bits)) & 0xFFFFFFFF
+                asm.stmt(BPF_ALU | BPF_AND | BPF_K, mask)
+                word &= mask
+            if i == nwords - 1:
+                asm.jump(BPF_JMP | BPF_JEQ | BPF_K, word, jt=hit)
+            else:
+                asm.jump(BPF_JMP | BPF_JEQ | BPF_K, word, jf=next_net)
+        asm.label(next_net)
+
+        # 跳板：顺序执行时越过，命中时经 ja 转到 on_match
+        if len(asm) - block_start >= _TRAMPOLINE_SPAN:
+            skip = asm.new_label('skip')
+            asm.ja(skip)
+            asm.label(hit)
+            asm.ja(on_match)
+            asm.label(skip)
+            hit = asm.new_label('hit')
+            block_start = len(asm)
+
+    over = asm.new_label('miss')
+    asm.ja(over)
+    asm.label(hit)
+    asm.ja(on_match)
+    asm.label(over)
+
+
+def _emit_exactly_one_local(asm: _Assembler, nets: Sequence[Network],
+                            src_off: int, dst_off: int, accept: int):
+    """src/dst 恰好一端命中本地侧网段时返回 accept，否则返回 0。"""
+    src_local  = asm.new_label('src_local')
+    src_remote = asm.new_label('src_remote')
+    both_local = asm.new_label('both_local')
+    one_local  = asm.new_label('one_local')
+
+    _emit_match(asm, nets, src_off, src_local)
+    asm.ja(src_remote)
+
+    asm.label(src_local)
+    _emit_match(asm, nets, dst_off, both_local)
+    asm.stmt(BPF_RET | BPF_K, accept)        # 本地 → 公网：上行
+    asm.label(both_local)
+    asm.stmt(BPF_RET | BPF_K, 0)             # 两端都在本地侧：LAN 内部
+
+    asm.label(src_remote)
+    _emit_match(asm, nets, dst_off, one_local)
+    asm.stmt(BPF_RET | BPF_K, 0)             # 两端都是公网：与本机无关
+    asm.label(one_local)
+    asm.stmt(BPF_RET | BPF_K, accept)        # 公网 → 本地：下行
+
+
+def prefilter_program(v4_local: Sequence[ipaddress.IPv4Network],
+                      v6_local: Sequence[ipaddress.IPv6Network],
+                      snaplen: int) -> List[Insn]:
+    """
+    生成丢弃非 IP 帧与 LAN 内部流量的过滤器。
+    v4_local / v6_local：视为"本地侧"的网段（私有网段、本机地址 /32 /128、LAN 前缀）。
+    同时处理无 tag 帧与 802.1Q 单层 VLAN 帧（IP 头偏移 14 / 18）。
+    """
+    accept = snaplen if snaplen > 0 else SNAPLEN_MAX
+    asm = _Assembler()
+
+    branches = []
+    for l3 in (14, 18):
+        branches.append((l3, asm.new_label(f'v4_{l3}'), asm.new_label(f'v6_{l3}')))
+    vlan = asm.new_label('vlan')
+
+    (_, v4_plain, v6_plain), (_, v4_vlan, v6_vlan) = branches
+
+    def dispatch(ethertype: int, target: str):
+        # 条件跳转只跨一条指令，真正的长跳转交给 ja（32 位偏移）
+        other = asm.new_label('other')
+        asm.jump(BPF_JMP | BPF_JEQ | BPF_K, ethertype, jf=other)
+        asm.ja(target)
+        asm.label(other)
+
+    asm.stmt(BPF_LD | BPF_H | BPF_ABS, 12)
+    dispatch(_ETH_P_IP, v4_plain)
+    dispatch(_ETH_P_IPV6, v6_plain)
+    dispatch(_ETH_P_8021Q, vlan)
+    asm.stmt(BPF_RET | BPF_K, 0)             # ARP 等非 IP 协议
+
+    asm.label(vlan)
+    asm.stmt(BPF_LD | BPF_H | BPF_ABS, 16)
+    dispatch(_ETH_P_IP, v4_vlan)
+    dispatch(_ETH_P_IPV6, v6_vlan)
+    asm.stmt(BPF_RET | BPF_K, 0)
+
+    for l3, v4_label, v6_label in branches:
+        asm.label(v4_label)
+        _emit_exactly_one_local(asm, v4_local, l3 + 12, l3 + 16, accept)
+        asm.label(v6_label)
+        _emit_exactly_one_local(asm, v6_local, l3 + 8, l3 + 24, accept)
+
+    return asm.assemble()
+
+
+def snaplen_program(snaplen: int) -> List[Insn]:
+    """仅做截断的过滤器：接收所有包，每包最多保留 snaplen 字节。"""
+    return [(BPF_RET | BPF_K, 0, 0, snaplen if snaplen > 0 else SNAPLEN_MAX)]
+
+
+def attach_filter(sock: socket.socket, program: List[Insn]):
+    """
+    把 cBPF 程序挂到套接字上；已有过滤器时内核会原子替换。
+    失败时抛出 OSError（如内核拒绝非法程序）。
+    """
+    buf = ctypes.create_string_buffer(b''.join(_SOCK_FILTER.pack(*insn) for insn in program))
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    # 原生对齐打包，指针字段由 struct 自动补齐填充
+    fprog = struct.pack('HP', len(program), ctypes.addressof(buf))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
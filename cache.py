@@ -0,0 +1,180 @@
+"""
+cache.py - 存储读取结果缓存
+
+数据库中的流量数据只在持久化线程提交（commit_stats）或每日维护时变化，
+而仪表盘与 SSE 广播会反复执行同样的汇总查询。CachedStorage 包装任意
+StorageBackend：
+  - 读取结果按 (方法, 参数, 今天的日期) 缓存；日期参与键值，跨零点时
+    "今日/本月/最近 30 天"等相对查询自然失效
+  - 写入或维护开始前、结束后各递增一次 version 并清空缓存：version 为奇数表示
+    正在写入，此时的读取不进缓存；查询前后 version 不同的结果同样丢弃
+  - 返回缓存结果的深拷贝，调用方叠加内存增量时不会污染缓存
+内存中尚未写库的增量不进入缓存，由 API 层在返回前叠加。
+
+拆分进程模式（PROCESS_MODE=split）下写入发生在抓包进程：抓包进程的 CachedStorage
+经 on_version 把 version 发布到共享内存，API 进程的 CachedStorage 以 remote
+（livestate.LiveStateView）为版本来源，发现变化时先 backend.refresh() 再清空缓存。
+"""
+
+import copy
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from storage import StorageBackend
+
+# 缓存条目上限（LRU）；自定义日期范围查询的参数组合可能很多
+CACHE_MAX_ENTRIES = 256
+
+
+class CachedStorage(StorageBackend):
+    """
+    backend:    被包装的存储
+    on_version: version 变化时的回调（拆分进程模式下发布给 API 进程）
+    remote:     拆分进程模式的 API 侧版本来源，提供 db_version() 与 last_maintenance
+    initial_version: 起始版本号。拆分进程模式下抓包进程重启时传入已发布的版本号，
+                保证发布出去的版本只增不减，API 进程不会把新写入误认成已缓存的旧版本
+    """
+
+    def __init__(self, backend: StorageBackend, on_version: Optional[Callable[[int], None]] = None,
+                 remote=None, initial_version: int = 0):
+        self._backend = backend
+        self._on_version = on_version
+        self._remote = remote
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[tuple, Any]' = OrderedDict()
+        # 本进程写入时维护；remote 模式下为最近一次看到的远端版本
+        self.version = initial_version
+        self.hits = 0
+        self.misses = 0
+
+    def _current_version(self) -> int:
+        if self._remote is None:
+            return self.version
+        version = self._remote.db_version()
+        if version != self.version:
+            with self._lock:
+                self.version = version
+                self._entries.clear()
+            self._backend.refresh()
+        return version
+
+    def _cached(self, name: str, args: tuple, load: Callable[[], Any]) -> Any:
+        key = (name, args, date.today())
+        version = self._current_version()
+        if version & 1:
+            # 写入进行中：直接读取，不缓存可能只反映部分写入的结果
+            return load()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(self._entries[key])
+            self.misses += 1
+        value = load()
+        unchanged = version == self._current_version()
+        with self._lock:
+            if unchanged and version == self.version:
+                self._entries[key] = value
+                if len(self._entries) > CACHE_MAX_ENTRIES:
+                    self._entries.popitem(last=False)
+        return copy.deepcopy(value)
+
+    def _bump(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+            version = self.version
+        if self._on_version is not None:
+            self._on_version(version)
+
+    def invalidate(self):
+        """清空缓存（version 前进两步，保持偶数）。"""
+        self._bump()
+        self._bump()
+
+    # ── 生命周期与写入：直接转发，成功后失效 ──────────────────────────────────
+
+    def init_schema(self):
+        self._backend.init_schema()
+        self.invalidate()
+
+    def attach(self):
+        self._backend.attach()
+
+    def refresh(self):
+        self._backend.refresh()
+        self.invalidate()
+
+    def close(self):
+        self._backend.close()
+
+    def commit_stats(self, hourly_data: Dict[int, Dict],
+                     ip_hourly: Optional[Dict[int, Dict[str, int]]] = None, journal_gen: int = 0) -> float:
+        self._bump()
+        try:
+            return self._backend.commit_stats(hourly_data, ip_hourly, journal_gen)
+        finally:
+            # 失败时也可能已部分写入，保守地一并失效
+            self._bump()
+
+    def journal_generation(self) -> int:
+        return self._backend.journal_generation()
+
+    @property
+    def last_maintenance(self) -> Optional[Dict]:
+        if self._remote is not None:
+            return self._remote.last_maintenance
+        return self._backend.last_maintenance
+
+    def run_maintenance(self, hourly_months: int, daily_years: int, ip_retention_days: int) -> Dict:
+        self._bump()
+        try:
+            return self._backend.run_maintenance(hourly_months, daily_years, ip_retention_days)
+        finally:
+            self._bump()
+
+    def get_storage_info(self) -> Dict:
+        info = self._backend.get_storage_info()
+        info['cache'] = {'version': self._current_version(), 'entries': len(self._entries),
+                         'hits': self.hits, 'misses': self.misses}
+        return info
+
+    # ── 读取：按参数缓存 ──────────────────────────────────────────────────────
+
+    def get_today_stats(self) -> Dict:
+        return self._cached('today', (), self._backend.get_today_stats)
+
+    def get_month_stats(self) -> Dict:
+        return self._cached('month', (), self._backend.get_month_stats)
+
+    def get_year_stats(self) -> Dict:
+        return self._cached('year', (), self._backend.get_year_stats)
+
+    def get_last_30days(self) -> List[Dict]:
+        return self._cached('30days', (), self._backend.get_last_30days)
+
+    def get_last_12months(self) -> List[Dict]:
+        return self._cached('12months', (), self._backend.get_last_12months)
+
+    def query_range(self, start: str, end: str, granularity: str = 'day') -> Dict:
+        return self._cached('range', (start, end, granularity),
+                            lambda: self._backend.query_range(start, end, granularity))
+
+    def get_available_date_range(self) -> Dict:
+        return self._cached('date_range', (), self._backend.get_available_date_range)
+
+    def get_hourly_today(self) -> List[Dict]:
+        return self._cached('today_hours', (), self._backend.get_hourly_today)
+
+    def get_top_ips(self, start: str, end: str, n: int = 10) -> List[Dict]:
+        return self._cached('top_ips', (start, end, n),
+                            lambda: self._backend.get_top_ips(start, end, n))
+
+    def get_ip_bytes(self, start: str, end: str, ips: Sequence[str]) -> Dict[str, int]:
+        # 参数随内存中的排行变化，命中率低，不缓存
+        return self._backend.get_ip_bytes(start, end, ips)
+
+    def get_ip_other_bytes(self, start: str, end: str) -> int:
+        return self._cached('ip_other', (start, end), lambda: self._backend.get_ip_other_bytes(start, end))
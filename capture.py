@@ -36,15 +36,17 @@ capture.py - 抓包与流量统计核心模块
     两端都是内网           → 忽略
 
   IPv6（NAS 直接持有公网 IPv6，无 NAT）：
-    src=本机IPv6, dst=公网IPv6 → 上行（靠 _local_ips 识别本机）
+    src=本机IPv6, dst=公网IPv6 → 上行（靠 LocalState.ips 识别本机）
     src=公网IPv6, dst=本机IPv6 → 下行
     两端都是公网且都不是本机   → 忽略
 
   本机 IPv6 每隔 LOCAL_IP_REFRESH_INTERVAL 秒自动重新检测（应对 SLAAC 轮换）
 """
 
+import heapq
 import ipaddress
 import logging
+import multiprocessing
 import os
 import queue
 import socket
@@ -53,8 +55,17 @@ import subprocess
 import threading
 import time
 from collections import defaultdict
-from datetime import datetime
-from typing import Dict, List, Set, Tuple
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from batchring import BatchRing
+from heavyhitter import DEFAULT_CAPACITY as IP_SKETCH_CAPACITY, SpaceSaving
+from hourkey import hour_key_of, hour_start_ts
+from ipkey import V4_MAPPED, key_of, key_str
+from journal import SpillJournal
+from ratering import RateRing
+from bpf import attach_filter, prefilter_program, snaplen_program
+from rawsock import BatchReceiver, FrameBatch, TPacketV3Ring, join_fanout
+import vecparse
 
 logger = logging.getLogger('sentinel.capture')
 
@@ -70,7 +81,7 @@ GUA_PREFIX_LEN = 56
 # libpcap 内核接收缓冲区大小：32MB（默认通常只有 2MB，高流量时容易溢出丢包）
 SOCKET_RCVBUF_SIZE = 32 * 1024 * 1024
 
-# 生产者-消费者队列容量（包数）：限制内存占用，队列满时丢弃并计数
+# 生产者-消费者批次环容量（包数，按批内帧数累计）：限制内存占用，超出时整批丢弃并计数
 # BT 同时数百连接时瞬时包速率可达数万 pkt/s
 PACKET_QUEUE_MAXSIZE = 50000
 
@@ -80,6 +91,28 @@ KERNEL_DROP_MONITOR_INTERVAL = 60
 # 包处理速率统计间隔（秒），定期打印便于性能诊断
 PKT_RATE_LOG_INTERVAL = 60
 
+# 多进程抓包：工作进程向主进程发送统计增量的间隔（秒），决定实时速率的延迟
+FANOUT_MERGE_INTERVAL = 1.0
+
+# 多进程抓包：主进程检查工作进程存活的间隔（秒）
+FANOUT_WORKER_CHECK_INTERVAL = 10
+
+# 远端 IP 长尾键：SpaceSaving 无法确定归属的字节写库时记在此键上（与 database.IP_OTHER 一致）
+IP_OTHER = '*'
+
+# 内核侧截断长度（字节）：通过 cBPF 过滤器让内核每包只拷贝前 N 字节到用户态
+# 解析器只读以太网头 + VLAN + IP 头（≤ 58 字节），计费长度取自 IP 头字段，截断不影响精度
+# 0 表示不截断（整帧拷贝）
+DEFAULT_SNAPLEN = 128
+# 可配置的最小截断长度：14（以太网）+ 4（VLAN）+ 40（IPv6 固定头）
+MIN_SNAPLEN = 58
+
+# 可选收包后端（rawsock.py）：
+#   recv  = 逐帧 sock.recv()
+#   mmap  = TPACKET_V3 内存映射环，按 block 批量交付
+#   batch = recvmmsg 批量收包（不可用时退化为 recv_into），预分配缓冲区
+CAPTURE_BACKENDS = ('recv', 'mmap', 'batch')
+
 # 以太网协议类型常量
 ETH_P_IP   = 0x0800   # IPv4
 ETH_P_IPV6 = 0x86DD   # IPv6
@@ -95,6 +128,7 @@ PRIVATE_IPV4_NETWORKS = [
     ipaddress.ip_network('169.254.0.0/16'),
     ipaddress.ip_network('0.0.0.0/8'),
     ipaddress.ip_network('255.255.255.255/32'),
+    ipaddress.ip_network('224.0.0.0/4'),       # 组播（SSDP/mDNS 等，只在局域网内传播）
 ]
 
 # ── IPv6 始终排除的网段 ───────────────────────────────────────────────────────
@@ -120,10 +154,72 @@ def _is_private_v4_int(ip_int: int) -> bool:
     return any(lo <= ip_int <= hi for lo, hi in _PRIVATE_V4_RANGES)
 
 
-def _ipv6_bytes_is_excluded(addr_bytes: bytes, extra_nets: List[ipaddress.IPv6Network]) -> bool:
-    """判断 16 字节的 IPv6 地址是否属于需排除的网段"""
-    addr = ipaddress.ip_address(addr_bytes)
-    return any(addr in net for net in BUILTIN_IPV6_EXCLUDE + extra_nets)
+# IPv6 固定头中连续存放的 src/dst 地址，按 4 个 64 位大端整数一次解出
+_V6_ADDR_PAIR = struct.Struct('!QQQQ')
+
+
+class _V6PrefixSet:
+    """
+    预编译的 IPv6 前缀集合：按前缀长度分组，每组是"地址右移掉主机位后的网络号"集合。
+    判定一个 128 位整数地址只需对每种前缀长度做一次移位 + 集合查找，
+    不构建任何 ipaddress 对象；本机地址以 /128 形式放入同一结构。
+    """
+
+    __slots__ = ('_groups',)
+
+    def __init__(self, nets: List[ipaddress.IPv6Network]):
+        groups: Dict[int, Set[int]] = {}
+        for net in nets:
+            shift = 128 - net.prefixlen
+            groups.setdefault(shift, set()).add(int(net.network_address) >> shift)
+        # 短前缀（大移位）在前：内置保留段最常命中
+        self._groups = tuple(
+            (shift, frozenset(keys)) for shift, keys in sorted(groups.items(), reverse=True)
+        )
+
+    def __contains__(self, addr: int) -> bool:
+        for shift, keys in self._groups:
+            if (addr >> shift) in keys:
+                return True
+        return False
+
+
+class LocalState:
+    """
+    本地侧判定状态的不可变快照。刷新线程构建新快照后整体替换
+    PacketCapture._local 引用，包处理路径与 API 读取时无需加锁：
+      ips          : 本机 IP 字符串集合（IPv4 + IPv6）
+      v4_ints      : 本机 IPv4（整数）
+      v6_bytes     : 本机 IPv6（16 字节 packed）
+      lan_prefixes : LAN 前缀（/56 或手动指定）
+      v6_lan       : LAN 前缀的预编译集合，用于双端 LAN 检测
+      v6_local     : 本地侧 = 本机地址 /128 + BUILTIN_IPV6_EXCLUDE + LAN 前缀
+    """
+
+    __slots__ = ('ips', 'v4_ints', 'v6_bytes', 'lan_prefixes', 'v6_lan', 'v6_local')
+
+    def __init__(self, ips: Set[str], lan_prefixes: List[ipaddress.IPv6Network]):
+        v4_ints: Set[int] = set()
+        v6_bytes: Set[bytes] = set()
+        for ip_str in ips:
+            try:
+                addr = ipaddress.ip_address(ip_str)
+            except ValueError:
+                continue
+            if addr.version == 4:
+                v4_ints.add(int(addr))
+            else:
+                v6_bytes.add(addr.packed)
+
+        self.ips = frozenset(ips)
+        self.v4_ints = frozenset(v4_ints)
+        self.v6_bytes = frozenset(v6_bytes)
+        self.lan_prefixes = tuple(lan_prefixes)
+        self.v6_lan = _V6PrefixSet(self.lan_prefixes)
+        self.v6_local = _V6PrefixSet(
+            BUILTIN_IPV6_EXCLUDE + list(self.lan_prefixes)
+            + [ipaddress.IPv6Network(b) for b in v6_bytes]
+        )
 
 
 # ── 本机 IP 检测 ──────────────────────────────────────────────────────────────
@@ -255,82 +351,508 @@ def check_offload_status(iface: str) -> dict:
 
 # ── 流量统计 ──────────────────────────────────────────────────────────────────
 
-class TrafficStats:
-    """线程安全的流量统计存储"""
+def _new_hour_bucket() -> Dict:
+    return {'up': 0, 'down': 0, 'tz_offset': 0}
+
+
+class _Accum:
+    """单个线程在一个合并周期内的本地累加缓冲区（小时桶以 hour_key 为键）。"""
+
+    __slots__ = ('hourly', 'up', 'down', 'merged')
+
+    def __init__(self):
+        self.hourly: Dict[int, list] = {}   # hour_key → [up, down, tz_offset, {远端IP: 字节数}]
+        self.up = 0
+        self.down = 0
+        # 合并线程读取完毕后置位；写入端写完后检查它，发现迟到的写入（见 _ThreadSlot）
+        self.merged = False
+
+
+class _ThreadSlot:
+    """
+    每个写入线程独占的累加槽位。
+    active 只由所属线程写入；合并线程每秒把 active 换成新缓冲区并移入 retired，
+    retired 在下一次合并时才被读取，写入端无需任何锁。
+    这依赖一个假设：写入线程从读取 slot.active 到写完这次增量之间不会停顿超过
+    一个合并周期（约 1 秒）。写入端不会阻塞，但线程可能被抢占或长时间得不到 GIL；
+    此时增量可能写进已被合并的缓冲区而丢失。写入端写完后检查 merged，这类迟到的
+    写入计入 TrafficStats.late_writes，由 tick_realtime() 记录告警。
+    """
+
+    __slots__ = ('active', 'retired', 'hour_key', 'tz_offset', 'hour_start', 'hour_end')
 
     def __init__(self):
+        self.active = _Accum()
+        self.retired: Optional[_Accum] = None
+        # 当前小时桶：hour_key 及其绝对时间范围 [hour_start, hour_end)，跨整点时才重新计算
+        self.hour_key = 0
+        self.tz_offset = 0
+        self.hour_start = 0
+        self.hour_end = 0
+
+
+class TrafficStats:
+    """
+    线程安全的流量统计存储。
+
+    写入路径（add_bytes / add_batch）只累加调用线程自己的 _ThreadSlot，
+    不格式化时间字符串、不获取共享锁；tick_realtime() 每秒把各线程的增量
+    合并进共享的 hourly / ip_hourly。读取接口与持久化线程只与合并线程竞争 _lock，
+    不会阻塞抓包路径。合并存在约 1~2 秒延迟，对按小时持久化的数据没有影响。
+
+    远端 IP 按小时各用一个容量为 ip_capacity 的 SpaceSaving 计数器汇总，
+    内存占用与不同 IP 的数量无关；写库与读取时只取每个 IP 的确定下界，
+    无法确定归属的字节记到长尾键 IP_OTHER 上，总量保持不变。
+
+    传入 journal 时，合并后的小时增量每隔 journal.interval 秒追加到溢写日志，
+    崩溃后由启动流程重放（见 journal.py）。写库通过 flush() 完成：
+    只有提交成功后才丢弃这部分内存数据与对应日志分段，失败时原样放回。
+    """
+
+    def __init__(self, journal: Optional[SpillJournal] = None, ip_capacity: int = IP_SKETCH_CAPACITY):
         self._lock = threading.Lock()
-        self.hourly: Dict[str, Dict] = defaultdict(lambda: {'up': 0, 'down': 0})
-        self.realtime_samples: List[Tuple[float, int, int]] = []
+        # hour_key（见 hourkey.py）→ {'up', 'down', 'tz_offset'}
+        self.hourly: Dict[int, Dict] = defaultdict(_new_hour_bucket)
+        # 已取出、正在写库的小时数据：提交成功前仍计入 get_hourly_snapshot()
+        self._flushing: Dict[int, Dict] = {}
+        # 实时速率：1 秒 / 10 秒 / 1 分钟三级环形缓冲（见 ratering.py），持 _lock 访问
+        self.realtime = RateRing()
         self._current_up = 0
         self._current_down = 0
-        self.ip_counter: Dict[str, int] = defaultdict(int)
-
-    def add_bytes(self, direction: str, size: int, remote_ip: str, ts: float):
+        # 尚未写库的按小时远端 IP 字节数：hour_key → SpaceSaving，随 flush() 一起持久化后清空
+        self.ip_capacity = ip_capacity
+        self.ip_hourly: Dict[int, SpaceSaving] = {}
+        self._flushing_ips: Dict[int, SpaceSaving] = {}
+
+        # 各写入线程的累加槽位；注册时持 _lock，之后只由合并线程遍历
+        self._tls = threading.local()
+        self._slots: List[_ThreadSlot] = []
+        # 写进已合并缓冲区的增量次数（可能已丢失）；只做诊断，不加锁
+        self.late_writes = 0
+        self._late_writes_logged = 0
+
+        # 溢写日志：_journal_pending 为已合并、尚未写入日志的小时增量（持 _lock 访问）；
+        # _journal_lock 保证"取出待写增量 + 追加/切段"整体有序，加锁顺序为 _journal_lock → _lock
+        self._journal = journal
+        self._journal_lock = threading.Lock()
+        self._journal_pending: Dict[int, List[int]] = {}
+        self._last_spill = time.time()
+
+    def _slot(self) -> _ThreadSlot:
+        try:
+            return self._tls.slot
+        except AttributeError:
+            slot = self._tls.slot = _ThreadSlot()
+            with self._lock:
+                self._slots.append(slot)
+            return slot
+
+    @staticmethod
+    def _roll_hour(slot: _ThreadSlot, ts: float):
+        """ts 落在槽位当前小时桶之外时，重新计算其所属的本地小时。"""
+        slot.hour_key, slot.tz_offset = hour_key_of(ts)
+        slot.hour_start = hour_start_ts(slot.hour_key, slot.tz_offset)
+        slot.hour_end = slot.hour_start + 3600
+
+    def add_bytes(self, direction: str, size: int, remote: int, ts: float):
         """
         记录一次流量事件。
         size 应传入 IP 层声明的字节数（IPv4: IP.len，IPv6: IPv6.plen + 40）
         而非 len(ethernet_frame)，以避免链路层头部的干扰。
+        remote 为远端地址的整数键（见 ipkey.py），读取时才格式化为文本。
         """
-        hour_key = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:00:00')
-        with self._lock:
-            if direction == 'up':
-                self.hourly[hour_key]['up'] += size
-                self._current_up += size
+        slot = self._slot()
+        if not slot.hour_start <= ts < slot.hour_end:
+            self._roll_hour(slot, ts)
+        acc = slot.active
+        bucket = acc.hourly.get(slot.hour_key)
+        if bucket is None:
+            bucket = acc.hourly[slot.hour_key] = [0, 0, slot.tz_offset, {}]
+        if direction == 'up':
+            bucket[0] += size
+            acc.up += size
+        else:
+            bucket[1] += size
+            acc.down += size
+        ips = bucket[3]
+        ips[remote] = ips.get(remote, 0) + size
+        if acc.merged:
+            self.late_writes += 1
+
+    def add_batch(self, up: int, down: int, ip_bytes: Dict[int, int], ts: float):
+        """
+        一次记录整批流量（向量化解析的结果）。
+        批内所有帧共用 ts，归入同一个小时桶。
+        """
+        slot = self._slot()
+        if not slot.hour_start <= ts < slot.hour_end:
+            self._roll_hour(slot, ts)
+        acc = slot.active
+        bucket = acc.hourly.get(slot.hour_key)
+        if bucket is None:
+            bucket = acc.hourly[slot.hour_key] = [0, 0, slot.tz_offset, {}]
+        bucket[0] += up
+        bucket[1] += down
+        acc.up += up
+        acc.down += down
+        ips = bucket[3]
+        for ip, b in ip_bytes.items():
+            ips[ip] = ips.get(ip, 0) + b
+        if acc.merged:
+            self.late_writes += 1
+
+    def _fold(self):
+        """
+        合并各线程上一周期退役的缓冲区，并把当前缓冲区换下待下次合并。
+        调用方需持有 _lock。
+        """
+        for slot in self._slots:
+            acc = slot.retired
+            slot.retired = slot.active
+            slot.active = _Accum()
+            if acc is None:
+                continue
+            # 迟到的写入可能仍在修改这个缓冲区（见 _ThreadSlot）：遍历快照，
+            # 避免新增小时/IP 键时抛出 "dictionary changed size during iteration"
+            for hour_key, (up, down, tz_offset, ips) in list(acc.hourly.items()):
+                self._add_hourly(hour_key, up, down, tz_offset)
+                self._add_ips(hour_key, dict(ips))
+            self._current_up += acc.up
+            self._current_down += acc.down
+            acc.merged = True
+
+    def _add_hourly(self, hour_key: int, up: int, down: int, tz_offset: int):
+        """把一个小时增量并入共享表，并记入待写日志。调用方需持有 _lock。"""
+        bucket = self.hourly[hour_key]
+        bucket['up'] += up
+        bucket['down'] += down
+        bucket['tz_offset'] = tz_offset
+        if self._journal is not None:
+            pending = self._journal_pending.get(hour_key)
+            if pending is None:
+                self._journal_pending[hour_key] = [up, down, tz_offset]
             else:
-                self.hourly[hour_key]['down'] += size
-                self._current_down += size
-            self.ip_counter[remote_ip] += size
+                pending[0] += up
+                pending[1] += down
+                pending[2] = tz_offset
+
+    def _ip_sketch(self, hour_key: int) -> SpaceSaving:
+        sketch = self.ip_hourly.get(hour_key)
+        if sketch is None:
+            sketch = self.ip_hourly[hour_key] = SpaceSaving(self.ip_capacity)
+        return sketch
+
+    def _add_ips(self, hour_key: int, ips: Dict[int, int]):
+        """把一个小时内各远端 IP 的字节数并入共享表。调用方需持有 _lock。"""
+        self._ip_sketch(hour_key).update(ips)
 
     def tick_realtime(self):
         ts = time.time()
         with self._lock:
+            self._fold()
             up, down = self._current_up, self._current_down
             self._current_up = self._current_down = 0
-            self.realtime_samples.append((ts, up, down))
-            cutoff = ts - 120
-            self.realtime_samples = [
-                (t, u, d) for t, u, d in self.realtime_samples if t > cutoff
-            ]
+            self.realtime.add(ts, up, down)
+        late = self.late_writes
+        if late != self._late_writes_logged:
+            logger.warning(f"[Stats] {late - self._late_writes_logged} write(s) landed in an already merged "
+                           f"buffer (writer stalled for over a tick), those bytes may be lost")
+            self._late_writes_logged = late
+        if self._journal is not None and ts - self._last_spill >= self._journal.interval:
+            self.spill()
+
+    def _take_journal_pending(self) -> List[Tuple[int, int, int, int]]:
+        """取出待写日志的增量。调用方需持有 _lock。"""
+        pending, self._journal_pending = self._journal_pending, {}
+        return [(k, up, down, tz) for k, (up, down, tz) in pending.items()]
+
+    def spill(self):
+        """把自上次以来合并的小时增量追加到溢写日志（一次 fsync）。"""
+        self._last_spill = time.time()
+        with self._journal_lock:
+            with self._lock:
+                rows = self._take_journal_pending()
+            try:
+                self._journal.append(rows)
+            except OSError as e:
+                logger.warning(f"[Journal] Append failed ({e}); these deltas are only in memory until the next flush")
+
+    def get_realtime_speed(self, seconds: int = 60, resolution: Optional[int] = None) -> List[Dict]:
+        """
+        最近 seconds 秒的速率采样 [{'ts', 'up', 'down'}]（字节/秒，多秒桶为桶内平均值）。
+        resolution 缺省时按窗口选择：10 分钟内逐秒，6 小时内 10 秒，48 小时内 1 分钟。
+        """
+        with self._lock:
+            return self.realtime.samples(seconds, time.time(), resolution)
 
-    def get_realtime_speed(self, seconds: int = 60) -> List[Dict]:
+    def get_realtime_tiers(self) -> Dict[int, List[Tuple[int, int, int]]]:
+        """各分辨率全部采样 {分辨率: [(ts, up, down)]}，供拆分进程模式跨进程发布。"""
         with self._lock:
-            cutoff = time.time() - seconds
-            return [
-                {'ts': int(t), 'up': u, 'down': d}
-                for t, u, d in self.realtime_samples
-                if t > cutoff
-            ]
+            ring = self.realtime.copy()
+        return ring.tiers()
+
+    def _ip_sketches(self, first_hour: Optional[int], last_hour: Optional[int]) -> List[SpaceSaving]:
+        """内存中（含正在写库）落在 [first_hour, last_hour] 内的 IP 计数器。调用方需持有 _lock。"""
+        return [
+            sketch
+            for table in (self.ip_hourly, self._flushing_ips)
+            for hour_key, sketch in table.items()
+            if (first_hour is None or hour_key >= first_hour)
+            and (last_hour is None or hour_key <= last_hour)
+        ]
+
+    def _ip_tops(self, first_hour: Optional[int], last_hour: Optional[int], n: int
+                 ) -> List[Tuple[int, List[Tuple[int, int, int]], int]]:
+        """
+        内存中（含正在写库）落在 [first_hour, last_hour] 内的每个计数器计数最大的 n 项：
+        [(hour_key, [(键, count, error)], 未列出的键可能具有的最大计数)]。
+        每个计数器只读增量维护的前列键，持锁时间与容量无关。调用方需持有 _lock。
+        """
+        result = []
+        for table in (self.ip_hourly, self._flushing_ips):
+            for hour_key, sketch in table.items():
+                if (first_hour is not None and hour_key < first_hour) or \
+                        (last_hour is not None and hour_key > last_hour):
+                    continue
+                rows = sketch.top(n)
+                result.append((hour_key, rows, rows[-1][1] if len(sketch) > n else 0))
+        return result
+
+    def get_ip_top(self, first_hour: int = None, last_hour: int = None, n: int = 10
+                   ) -> Tuple[Dict[str, int], int]:
+        """
+        内存中尚未写库（含正在写库）的远端 IP 字节数（确定下界），按 [first_hour, last_hour]
+        过滤，由每个小时计数最大的 n 项汇总：({ip: 字节数}, 截断误差)。
+        截断误差为各小时未列出的 IP 可能具有的最大字节数之和，应加到 ip_error_bound() 上。
+        与写库的数值口径一致，API 用它叠加到数据库中已持久化的 IP 统计上。
+        """
+        with self._lock:
+            tops = self._ip_tops(first_hour, last_hour, n)
+        totals: Dict[int, int] = {}
+        truncated = 0
+        for _, rows, cutoff in tops:
+            truncated += cutoff
+            for key, count, error in rows:
+                if count > error:
+                    totals[key] = totals.get(key, 0) + count - error
+        return {key_str(key): b for key, b in totals.items()}, truncated
 
     def get_top_ips(self, n: int = 10) -> List[Dict]:
+        """
+        内存中尚未写库的流量里字节数最多的 n 个远端 IP。
+        bytes 为确定下界，真实值不超过 bytes + error；跨小时合并时，某 IP 未进入
+        某小时前 n 项的部分计入该小时的截断误差。
+        """
+        with self._lock:
+            tops = self._ip_tops(None, None, n)
+            # 并入工作进程增量时带来的上界误差（见 SpaceSaving.merge）
+            merge_error = sum(sketch.merge_error for sketch in self._ip_sketches(None, None))
+        totals: Dict[int, List[int]] = {}
+        truncated = 0
+        for _, rows, cutoff in tops:
+            truncated += cutoff
+            for key, count, error in rows:
+                acc = totals.setdefault(key, [0, 0, 0])
+                acc[0] += count - error
+                acc[1] += error
+                acc[2] += cutoff
+        top = heapq.nlargest(n, totals.items(), key=lambda x: x[1][0])
+        return [{'ip': key_str(key), 'bytes': b, 'error': e + truncated - listed + merge_error}
+                for key, (b, e, listed) in top]
+
+    def get_ip_hourly_top(self, n: int) -> Tuple[Dict[int, List[Tuple[int, int]]], int]:
+        """
+        每个内存小时（含正在写库）确定下界最大的 n 个远端 IP：({hour_key: [(键, 字节数)]}, 截断误差)。
+        截断误差为各小时被截掉的 IP 可能具有的最大字节数之和，供拆分进程模式按固定大小
+        跨进程发布（见 livestate.py）。持锁期间只读各计数器的前 n 项，合并在锁外完成。
+        """
+        with self._lock:
+            tops = self._ip_tops(None, None, n)
+        by_hour: Dict[int, Dict[int, int]] = {}
+        cutoffs: Dict[int, int] = {}
+        for hour_key, rows, cutoff in tops:
+            acc = by_hour.setdefault(hour_key, {})
+            # 同一小时可能同时有正在写库与新建的两个计数器，各自的截断上限相加
+            cutoffs[hour_key] = cutoffs.get(hour_key, 0) + cutoff
+            for key, count, error in rows:
+                if count > error:
+                    acc[key] = acc.get(key, 0) + count - error
+        top: Dict[int, List[Tuple[int, int]]] = {}
+        truncated = 0
+        for hour_key, acc in by_hour.items():
+            rows = heapq.nlargest(n, acc.items(), key=lambda x: x[1])
+            truncated += cutoffs[hour_key]
+            if len(acc) > n:
+                # 合并后超出 n 项的部分同样被截掉
+                truncated += rows[-1][1]
+            top[hour_key] = rows
+        return top, truncated
+
+    def ip_error_bound(self) -> int:
+        """内存中任一 IP 的字节数误差上界（各小时计数器最小计数之和），0 表示全部精确。"""
+        with self._lock:
+            return sum(s.min_count() for s in self._ip_sketches(None, None))
+
+    def flush(self, commit: Callable[[Dict[int, Dict], Dict[int, Dict[str, int]], int], Any]) -> Tuple[int, Any]:
+        """
+        取出全部小时数据与按小时的远端 IP 数据，调用 commit(hourly, ip_hourly, journal_gen) 写库，
+        返回 (小时记录数, commit 的返回值)。ip_hourly 为 {hour_key: {ip: 确定字节数}}，
+        无法确定归属的字节记在 IP_OTHER 上；journal_gen 为本批数据所在的最大日志代次
+        （未启用日志时为 0），存储在同一事务内记录它，崩溃后重放时跳过这些分段。
+        commit 抛出异常时数据并回内存（对应日志分段保留），异常继续向上抛出；
+        成功后才丢弃这部分数据及其日志分段。
+        """
+        gen = None
+        with self._journal_lock:
+            with self._lock:
+                data = dict(self.hourly)
+                self.hourly = defaultdict(_new_hour_bucket)
+                self._flushing = data
+                ips, self.ip_hourly = self.ip_hourly, {}
+                self._flushing_ips = ips
+                rows = self._take_journal_pending() if self._journal is not None else None
+            if self._journal is not None:
+                # 取出时刻之前的增量写入旧段后切段，之后的增量进入新段
+                try:
+                    self._journal.append(rows)
+                except OSError as e:
+                    logger.warning(f"[Journal] Append failed before flush: {e}")
+                gen = self._journal.rotate()
+
+        ip_rows: Dict[int, Dict[str, int]] = {}
+        for hour_key, sketch in ips.items():
+            counts, unattributed = sketch.guaranteed()
+            rows = {key_str(key): b for key, b in counts.items()}
+            if unattributed:
+                rows[IP_OTHER] = unattributed
+            ip_rows[hour_key] = rows
+
+        try:
+            result = commit(data, ip_rows, gen or 0)
+        except Exception:
+            with self._lock:
+                for hour_key, v in data.items():
+                    bucket = self.hourly[hour_key]
+                    bucket['up'] += v['up']
+                    bucket['down'] += v['down']
+                    bucket['tz_offset'] = v['tz_offset']
+                for hour_key, sketch in ips.items():
+                    self._ip_sketch(hour_key).merge(sketch)
+                self._flushing = {}
+                self._flushing_ips = {}
+            raise
+
         with self._lock:
-            sorted_ips = sorted(
-                self.ip_counter.items(), key=lambda x: x[1], reverse=True
-            )[:n]
-            return [{'ip': ip, 'bytes': b} for ip, b in sorted_ips]
+            self._flushing = {}
+            self._flushing_ips = {}
+        if gen is not None:
+            self._journal.discard(gen)
+        return len(data), result
 
-    def flush_and_get(self) -> Dict:
+    def drain_deltas(self) -> Dict:
+        """
+        取出并清零自上次调用以来的全部增量（小时流量、IP 计数、实时字节数）。
+        多进程抓包时由工作进程定期调用，结果发送给主进程 merge_deltas()。
+        工作进程没有 tick 线程，这里顺带完成线程缓冲区的合并。
+        """
         with self._lock:
-            data = dict(self.hourly)
+            self._fold()
+            deltas = {
+                'hourly': {k: dict(v) for k, v in self.hourly.items()},
+                'ips': self.ip_hourly,
+                'up': self._current_up,
+                'down': self._current_down,
+            }
             self.hourly.clear()
-            return data
+            self.ip_hourly = {}
+            self._current_up = self._current_down = 0
+            return deltas
 
-    def get_hourly_snapshot(self) -> Dict[str, Dict]:
+    def merge_deltas(self, deltas: Dict):
+        """把工作进程发来的增量并入本实例（主进程侧，供持久化/API 读取）。"""
+        with self._lock:
+            for hour_key, v in deltas['hourly'].items():
+                self._add_hourly(hour_key, v['up'], v['down'], v['tz_offset'])
+            for hour_key, sketch in deltas['ips'].items():
+                self._ip_sketch(hour_key).merge(sketch)
+            self._current_up += deltas['up']
+            self._current_down += deltas['down']
+
+    def get_hourly_snapshot(self) -> Dict[int, Dict]:
         """返回当前内存流量数据的线程安全深拷贝快照。
-        直接读 self.hourly 会与 flush_and_get() 的 clear() 产生竞态（读到被并发清空的空字典），
-        此方法在持锁状态下复制数据，确保安全且不影响持久化线程。"""
+        直接读 self.hourly 会与 flush() 的替换产生竞态（读到被并发取走的空字典），
+        此方法在持锁状态下复制数据，确保安全且不影响持久化线程。
+        正在写库、尚未提交的数据一并计入，避免提交期间 API 读数短暂回落。"""
         with self._lock:
-            return {k: dict(v) for k, v in self.hourly.items()}
+            snap = {k: dict(v) for k, v in self.hourly.items()}
+            for k, v in self._flushing.items():
+                bucket = snap.setdefault(k, _new_hour_bucket())
+                bucket['up'] += v['up']
+                bucket['down'] += v['down']
+            return snap
 
 
 # ── 抓包核心 ──────────────────────────────────────────────────────────────────
 
+def _fanout_worker_main(config: Dict, worker_id: int, group_id: int, out_queue):
+    """
+    多进程抓包的工作进程入口（spawn 启动，参数须可 pickle）。
+    独立构建一个只负责收包+解析的 PacketCapture，加入 PACKET_FANOUT 组后
+    在本进程内直接解析，定期把统计增量发回主进程合并。
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f'%(asctime)s [%(levelname)s] %(name)s[w{worker_id}]: %(message)s'
+    )
+    capture = PacketCapture(**config, fanout_worker=True)
+    capture._run_fanout_worker(worker_id, group_id, out_queue)
+
+
 class PacketCapture:
 
-    def __init__(self, iface: str, exclude_ipv6_prefixes: List[str] = None):
+    def __init__(self, iface: str, exclude_ipv6_prefixes: List[str] = None,
+                 capture_backend: str = 'recv', snaplen: int = DEFAULT_SNAPLEN,
+                 prefilter: bool = True, workers: int = 1,
+                 vectorize: bool = True, fanout_worker: bool = False,
+                 journal: Optional[SpillJournal] = None, ip_capacity: int = IP_SKETCH_CAPACITY):
         self.iface = iface
-        self.stats = TrafficStats()
+        # journal：溢写日志（仅主进程持有；工作进程的增量合并进主进程后再写日志）
+        # ip_capacity：每小时最多精确跟踪的远端 IP 数（SpaceSaving 容量）
+        self.stats = TrafficStats(journal=journal, ip_capacity=ip_capacity)
         self.running = False
+        # 多进程抓包：workers > 1 时由 N 个工作进程通过 PACKET_FANOUT 分摊收包与解析
+        # fanout_worker=True 表示本实例运行在工作进程中，不启动主进程专属的后台线程
+        self._workers = max(1, workers)
+        self._fanout_worker = fanout_worker
+        # 工作进程的构造参数（spawn 时原样传递）
+        self._worker_config = {
+            'iface': iface,
+            'exclude_ipv6_prefixes': list(exclude_ipv6_prefixes or []),
+            'capture_backend': capture_backend,
+            'snaplen': snaplen,
+            'prefilter': prefilter,
+            'vectorize': vectorize,
+            'ip_capacity': ip_capacity,
+        }
+        # 收包后端：'recv'（逐帧 recv，默认）| 'mmap'（TPACKET_V3 内存映射环）| 'batch'（recvmmsg）
+        if capture_backend not in CAPTURE_BACKENDS:
+            logger.warning(f"Unknown capture backend '{capture_backend}', using 'recv'")
+            capture_backend = 'recv'
+        self._capture_backend = capture_backend
+        # 内核截断长度：0 = 整帧；过小会截掉 IP 头，强制抬到 MIN_SNAPLEN
+        if 0 < snaplen < MIN_SNAPLEN:
+            logger.warning(f"Snaplen {snaplen} too small to hold IP headers, using {MIN_SNAPLEN}")
+            snaplen = MIN_SNAPLEN
+        self._snaplen = snaplen
+        # 内核侧预过滤：把本地侧地址规则编译进 cBPF，LAN 内部流量不再进入用户态
+        self._prefilter = prefilter
+        # 当前抓包套接字，本机 IP / LAN 前缀变化时需在其上重建过滤器
+        self._sock = None
+        # 向量化批量解析（需要 NumPy）：判定表随本机 IP / LAN 前缀变化重建
+        self._vectorize = vectorize and vecparse.HAVE_NUMPY
+        if vectorize and not vecparse.HAVE_NUMPY:
+            logger.info("NumPy not installed; vectorized batch parsing disabled")
+        self._vec_tables = None
 
         # ── IPv6 LAN 前缀过滤策略 ────────────────────────────────────────────
         # 优先级：手动指定 > 自动检测 GUA /56
@@ -345,18 +867,12 @@ class PacketCapture:
                 logger.warning(f"Invalid IPv6 prefix '{prefix}': {e}")
 
         self._manual_mode: bool = len(manual_nets) > 0
-        # _lan_prefixes: 同时用于双端 LAN 检测和 _is_local_v6 单端判断
-        # 需要加锁，因为自动模式下每小时可能刷新
-        self._lan_prefixes: List[ipaddress.IPv6Network] = manual_nets
-        # 向后兼容：_extra_ipv6 保持引用，与 _lan_prefixes 共享同一列表对象
-        self._extra_ipv6 = self._lan_prefixes
-
-        # 本机 IP 集合（含公网 IPv6），用于方向判定
-        self._local_ips: Set[str] = set()
+
+        # 本机 IP 与 LAN 前缀的不可变快照（写时复制）：
+        # 刷新线程构建新 LocalState 后整体替换引用，包处理路径与 API 无锁读取。
+        # _local_ips_lock 只用于串行化写入方（刷新线程与 start() 挂载过滤器）
+        self._local = LocalState(set(), manual_nets)
         self._local_ips_lock = threading.RLock()
-        # 同时缓存为整数/bytes 格式用于高速比较
-        self._local_v4_ints: Set[int] = set()
-        self._local_v6_bytes: Set[bytes] = set()
         self._refresh_local_ips()   # 启动时立即执行一次（含 /56 自动检测）
 
         self._refresh_thread = threading.Thread(
@@ -364,6 +880,9 @@ class PacketCapture:
         )
         self._refresh_thread.start()
 
+        if fanout_worker:
+            return  # 工作进程只需本机 IP 状态与解析逻辑，其余由主进程负责
+
         self._tick_thread = threading.Thread(
             target=self._tick_loop, daemon=True, name='tick'
         )
@@ -374,11 +893,9 @@ class PacketCapture:
         self._socket_buffer_actual_kb: int = 0
         # 最近一个监控周期内的内核级丢包增量（通过 /proc/net/dev 采样）
         self._kernel_drops_last_60s: int = 0
-        # 队列满时被丢弃的帧计数
-        self._queue_drop_count: int = 0
-        # 生产者-消费者解耦队列：recv 线程仅投帧，处理线程负责解析
-        # 队列上限防止内存无限增长；满时在生产者侧丢帧并告警
-        self._pkt_queue: queue.Queue = queue.Queue(maxsize=PACKET_QUEUE_MAXSIZE)
+        # 生产者-消费者解耦环（单生产者/单消费者）：recv 线程仅投递 FrameBatch，
+        # 处理线程负责解析；每批只有一次同步，容量按在途帧数限制，满时整批丢弃并计数
+        self._pkt_ring = BatchRing(max_frames=PACKET_QUEUE_MAXSIZE)
 
         # 启动内核丢包监控线程
         self._drop_monitor_thread = threading.Thread(
@@ -400,24 +917,10 @@ class PacketCapture:
     def _refresh_local_ips(self):
         new_ips = detect_local_ips(self.iface)
 
-        # 同时构建整数/bytes 缓存，供抓包回调高速查找
-        new_v4_ints: Set[int] = set()
-        new_v6_bytes: Set[bytes] = set()
-        for ip_str in new_ips:
-            try:
-                addr = ipaddress.ip_address(ip_str)
-                if addr.version == 4:
-                    new_v4_ints.add(int(addr))
-                else:
-                    new_v6_bytes.add(addr.packed)
-            except ValueError:
-                pass
-
         with self._local_ips_lock:
-            old_ips = self._local_ips
-            self._local_ips = new_ips
-            self._local_v4_ints = new_v4_ints
-            self._local_v6_bytes = new_v6_bytes
+            old_ips = set(self._local.ips)
+            if new_ips == old_ips and old_ips:
+                return  # 无变化：保留现有快照，派生状态无需重建
 
         added   = new_ips - old_ips
         removed = old_ips - new_ips
@@ -428,31 +931,44 @@ class PacketCapture:
             if added:   logger.info(f"  + Added:   {added}")
             if removed: logger.info(f"  - Removed: {removed}")
 
-        # IP 变动时顺带刷新 /56 前缀（运营商重拨后地址段会改变）
-        if added or removed or not old_ips:
-            self._refresh_gua_prefixes()
+        # IP 变动时顺带刷新 /56 前缀（运营商重拨后地址段会改变），
+        # 两者合并为一份新快照一次性发布
+        self._publish_local_state(new_ips, self._detect_lan_prefixes())
 
-    def _refresh_gua_prefixes(self):
+    def _refresh_gua_prefixes(self) -> bool:
         """
         自动检测网卡上的 GUA 并提取 /56 前缀，更新 LAN 过滤器。
         手动模式（EXCLUDE_IPV6_PREFIX 已设置）时跳过，不覆盖手动配置。
+        返回前缀是否发生变化（变化时已发布新快照）。
         """
         if self._manual_mode:
-            return  # 手动优先，禁止自动覆盖
+            return False  # 手动优先，禁止自动覆盖
+        with self._local_ips_lock:
+            return self._publish_local_state(self._local.ips, self._detect_lan_prefixes())
 
-        new_prefixes = detect_gua_slash56_prefixes(self.iface, GUA_PREFIX_LEN)
+    def _detect_lan_prefixes(self) -> List[ipaddress.IPv6Network]:
+        """返回应生效的 LAN 前缀：手动模式沿用当前配置，否则重新检测 GUA /56。"""
+        if self._manual_mode:
+            return list(self._local.lan_prefixes)
+        return detect_gua_slash56_prefixes(self.iface, GUA_PREFIX_LEN)
 
+    def _publish_local_state(self, ips: Set[str], lan_prefixes: List[ipaddress.IPv6Network]) -> bool:
+        """
+        构建新的 LocalState 快照并整体替换引用，随后重建由其派生的
+        向量化判定表与内核过滤器。返回 LAN 前缀是否发生变化。
+        """
         with self._local_ips_lock:
-            old_keys = {str(n) for n in self._lan_prefixes}
-            new_keys  = {str(n) for n in new_prefixes}
-
-            if new_keys == old_keys:
-                return  # 无变化，不做多余日志
+            old = self._local
+            new_prefixes = list(lan_prefixes)
+            prefixes_changed = {str(n) for n in new_prefixes} != {str(n) for n in old.lan_prefixes}
+            if set(ips) == old.ips and not prefixes_changed and old.ips:
+                return False  # 无变化，不做多余日志与重建（首次发布总是构建派生状态）
 
-            # 原地替换列表内容，_extra_ipv6 共享同一对象，无需额外同步
-            self._lan_prefixes.clear()
-            self._lan_prefixes.extend(new_prefixes)
+            self._local = LocalState(set(ips), new_prefixes)
+            self._on_local_state_changed()
 
+        if not prefixes_changed or self._manual_mode:
+            return prefixes_changed
         if new_prefixes:
             logger.info(
                 f"[IPv6-Filter] Auto GUA /56 prefixes updated: "
@@ -468,6 +984,24 @@ class PacketCapture:
                 "falling back to BUILTIN_IPV6_EXCLUDE only "
                 "(fe80::/10, ::1, fc00::/7, ff00::/8)."
             )
+        return True
+
+    def _on_local_state_changed(self):
+        """LocalState 快照替换后，重建由其派生的内核过滤器与向量化判定表。"""
+        self._rebuild_vec_tables()
+        self._install_socket_filter()
+
+    def _rebuild_vec_tables(self):
+        """按当前本地侧快照构建 NumPy 判定表，构建完成后整体替换引用。"""
+        if not self._vectorize:
+            return
+        state = self._local
+        self._vec_tables = vecparse.LocalTables(
+            _PRIVATE_V4_RANGES,
+            state.v4_ints,
+            state.v6_bytes,
+            BUILTIN_IPV6_EXCLUDE + list(state.lan_prefixes),
+        )
 
     def _ip_refresh_loop(self):
         """双速率刷新循环：
@@ -496,10 +1030,7 @@ class PacketCapture:
 
     def _is_local_v4(self, ip_int: int) -> bool:
         """IPv4：私有地址 or 本机公网地址 → True（本地侧）"""
-        if _is_private_v4_int(ip_int):
-            return True
-        with self._local_ips_lock:
-            return ip_int in self._local_v4_ints
+        return _is_private_v4_int(ip_int) or ip_int in self._local.v4_ints
 
     def _is_local_v6(self, addr_bytes: bytes) -> bool:
         """
@@ -508,33 +1039,28 @@ class PacketCapture:
           - 公网 IPv6 且在本机绑定列表中 → True（本机）
           - 公网 IPv6 且不在本机列表中 → False（远端）
           - 公网 IPv6 且属于 LAN /56 前缀 → True（LAN 设备，视为本地侧）
+        判定读取 LocalState 快照中的预编译前缀集合，无锁、不构建 ipaddress 对象。
         """
-        # 先快速检查是否在本机列表（最常见的 NAS 自身 IPv6）
-        with self._local_ips_lock:
-            if addr_bytes in self._local_v6_bytes:
-                return True
-        # 再检查保留/私有网段（BUILTIN）以及 LAN /56 前缀
-        return _ipv6_bytes_is_excluded(addr_bytes, self._extra_ipv6)
+        return int.from_bytes(addr_bytes, 'big') in self._local.v6_local
 
     def _is_in_lan_prefix(self, addr_bytes: bytes) -> bool:
         """
         判断一个 IPv6 地址是否属于当前检测到的 LAN 前缀（/56 或手动指定前缀）。
         用于双端检查：src 和 dst 同时在 LAN 前缀内 → 局域网内部流量，应忽略。
-        只检查 _lan_prefixes，不包含 BUILTIN_IPV6_EXCLUDE。
+        只检查 LAN 前缀，不包含 BUILTIN_IPV6_EXCLUDE。
         """
-        with self._local_ips_lock:
-            prefixes = list(self._lan_prefixes)  # 快照，避免持锁过久
-        if not prefixes:
-            return False
-        addr = ipaddress.ip_address(addr_bytes)
-        return any(addr in net for net in prefixes)
+        return int.from_bytes(addr_bytes, 'big') in self._local.v6_lan
 
     # ── 实时速率采样 ──────────────────────────────────────────────────────────
 
     def _tick_loop(self):
         while True:
             time.sleep(1)
-            self.stats.tick_realtime()
+            try:
+                self.stats.tick_realtime()
+            except Exception as e:
+                # 合并是线程增量进入共享统计的唯一途径，出错时记录后继续，不能让线程退出
+                logger.error(f"[Tick] Error folding stats: {e}")
 
     # ── Offload 诊断 ──────────────────────────────────────────────────────────
 
@@ -628,80 +1154,86 @@ class PacketCapture:
 
     def _packet_processor_loop(self):
         """
-        包处理消费者线程：从 _pkt_queue 取出 (frame, ts) 并调用 _parse_frame()。
+        包处理消费者线程：从 _pkt_ring 取出 FrameBatch 并调用 _parse_batch()。
 
         通过与 recv 线程解耦，避免解析耗时阻塞缓冲区消费，
-        降低内核缓冲区被撑满的概率。
+        降低内核缓冲区被撑满的概率。按批次取出，一次环操作处理整批帧。
 
         每 PKT_RATE_LOG_INTERVAL 秒打印一次处理速率与队列深度，
         便于判断单线程处理是否成为瓶颈（若持续满队列则需考虑多工作线程）。
         """
+        ring = self._pkt_ring
         pkt_count = 0
         last_log_time = time.time()
 
         while True:
             try:
-                frame, ts = self._pkt_queue.get(timeout=1.0)
-                self._parse_frame(frame, ts)
-                pkt_count += 1
+                batch = ring.get(timeout=1.0)
+                if batch is None:
+                    continue
+                try:
+                    self._parse_batch(batch)
+                finally:
+                    ring.task_done(batch)
+                pkt_count += len(batch)
 
                 # 定期打印速率诊断
                 now = time.time()
                 elapsed = now - last_log_time
                 if elapsed >= PKT_RATE_LOG_INTERVAL:
                     rate = pkt_count / elapsed if elapsed > 0 else 0
+                    depth, capacity = ring.occupancy()
                     logger.info(
                         f"[PktProcessor] {rate:.0f} pkt/s, "
-                        f"queue depth: {self._pkt_queue.qsize()}/{PACKET_QUEUE_MAXSIZE}, "
-                        f"queue drops (total): {self._queue_drop_count}"
+                        f"queue depth: {depth}/{capacity}, "
+                        f"queue drops (total): {ring.drops}"
                     )
                     pkt_count = 0
                     last_log_time = now
 
-            except queue.Empty:
-                continue
             except Exception as e:
                 logger.error(f"[PktProcessor] Error processing packet: {e}")
 
     # ── 数据包处理（轻量级手工解析，取代 Scapy 对象构建）────────────────────
 
-    def _handle_ipv4(self, data: bytes, ts: float):
+    def _handle_ipv4(self, buf: bytes, off: int, end: int, ts: float):
         """
         解析 IPv4 数据包并计入流量统计。
-        data: 从以太网帧中剥离链路层头后的 IP 层原始字节。
+        buf[off:end]: 从以太网帧中剥离链路层头后的 IP 层原始字节
+        （按偏移读取，批次缓冲区中的帧无需切片拷贝）。
 
         关键修复：使用 IP 头中的 total length 字段（偏移 2-4 字节）
         作为计费字节数，而非 len(ethernet_frame)。
         这是协议层声明的精确值，不受以太网头、FCS、padding 干扰。
         """
-        if len(data) < 20:  # IPv4 头最小 20 字节
+        if end - off < 20:  # IPv4 头最小 20 字节
             return
 
-        ip_len = struct.unpack_from('!H', data, 2)[0]   # total length（含 IP 头）
-        src_int = struct.unpack_from('!I', data, 12)[0]  # src addr as uint32
-        dst_int = struct.unpack_from('!I', data, 16)[0]  # dst addr as uint32
+        ip_len = struct.unpack_from('!H', buf, off + 2)[0]   # total length（含 IP 头）
+        src_int, dst_int = struct.unpack_from('!II', buf, off + 12)  # src/dst addr as uint32
 
-        src_local = self._is_local_v4(src_int)
-        dst_local = self._is_local_v4(dst_int)
+        # 读取一次快照引用：本包两端始终用同一份本机地址集合
+        local_v4 = self._local.v4_ints
+        src_local = _is_private_v4_int(src_int) or src_int in local_v4
+        dst_local = _is_private_v4_int(dst_int) or dst_int in local_v4
 
         if src_local and dst_local:
             return  # 内网互传，忽略
         if not src_local and not dst_local:
             return  # 两端都是公网且不是本机，忽略
 
+        # 远端地址以整数键计数（见 ipkey.py），不在包处理路径上格式化
         if src_local:
             # NAS 发出 → 上行，remote = dst
-            remote = socket.inet_ntoa(struct.pack('!I', dst_int))
-            self.stats.add_bytes('up', ip_len, remote, ts)
+            self.stats.add_bytes('up', ip_len, V4_MAPPED | dst_int, ts)
         else:
             # NAS 收到 → 下行，remote = src
-            remote = socket.inet_ntoa(struct.pack('!I', src_int))
-            self.stats.add_bytes('down', ip_len, remote, ts)
+            self.stats.add_bytes('down', ip_len, V4_MAPPED | src_int, ts)
 
-    def _handle_ipv6(self, data: bytes, ts: float):
+    def _handle_ipv6(self, buf: bytes, off: int, end: int, ts: float):
         """
         解析 IPv6 数据包并计入流量统计。
-        data: 从以太网帧剥离链路层头后的 IPv6 层原始字节。
+        buf[off:end]: 从以太网帧剥离链路层头后的 IPv6 层原始字节。
 
         关键修复：使用 IPv6 头中的 payload length 字段（偏移 4-6 字节）
         加上固定的 40 字节 IPv6 基础头，得到 IP 层总长度作为计费字节数。
@@ -711,62 +1243,87 @@ class PacketCapture:
         这类流量属于局域网内部传输，不应计入公网流量统计。
         过滤规则：not (src in /56 AND dst in /56)
         """
-        if len(data) < 40:  # IPv6 固定头 40 字节
+        if end - off < 40:  # IPv6 固定头 40 字节
             return
 
-        payload_len = struct.unpack_from('!H', data, 4)[0]  # payload length
+        payload_len = struct.unpack_from('!H', buf, off + 4)[0]  # payload length
         ip_len = 40 + payload_len  # IPv6 total = 40B header + payload
 
-        src_bytes = data[8:24]    # src addr (16 bytes)
-        dst_bytes = data[24:40]   # dst addr (16 bytes)
+        # src/dst 地址（偏移 8-40）一次解出为 128 位整数，不做切片拷贝
+        s_hi, s_lo, d_hi, d_lo = _V6_ADDR_PAIR.unpack_from(buf, off + 8)
+        src = (s_hi << 64) | s_lo
+        dst = (d_hi << 64) | d_lo
 
-        # ── 第一关：双端 LAN 前缀检测（优先执行，开销最低）──────────────
-        # 若 src 和 dst 同时属于 LAN /56 前缀 → 局域网内部流量，直接丢弃
-        if self._is_in_lan_prefix(src_bytes) and self._is_in_lan_prefix(dst_bytes):
-            return
+        # 读取一次快照引用：刷新线程整体替换，本包两端始终用同一份规则
+        local = self._local.v6_local
 
-        # ── 第二关：方向判定 ─────────────────────────────────────────────
-        src_local = self._is_local_v6(src_bytes)
-        dst_local = self._is_local_v6(dst_bytes)
+        # ── 方向判定 ─────────────────────────────────────────────────────
+        # 双端 LAN 前缀检测已被"两端都属于本地侧"覆盖（LAN 前缀 ⊂ 本地侧），
+        # 两端同属 /56 的包在这里一并忽略，无需单独再查一次 lan 集合
+        src_local = src in local
+        dst_local = dst in local
 
         if src_local and dst_local:
-            return  # 本地/内网互传（链路本地等），忽略
+            return  # 本地/内网互传（LAN /56 内部、链路本地等），忽略
         if not src_local and not dst_local:
             return  # 两端都是公网且不是本机，忽略
 
         if src_local:
             # NAS 发出（如：向公网服务器上传）→ 上行，remote = dst
-            remote = str(ipaddress.ip_address(dst_bytes))
-            self.stats.add_bytes('up', ip_len, remote, ts)
+            self.stats.add_bytes('up', ip_len, dst, ts)
         else:
             # NAS 收到（如：从公网下载）→ 下行，remote = src
-            remote = str(ipaddress.ip_address(src_bytes))
-            self.stats.add_bytes('down', ip_len, remote, ts)
+            self.stats.add_bytes('down', ip_len, src, ts)
 
-    def _parse_frame(self, frame: bytes, ts: float):
+    def _parse_frame(self, frame: bytes, ts: float, off: int = 0, end: int = None):
         """
         解析一个以太网帧，提取 IP/IPv6 层并分发处理。
+        帧位于 frame[off:end]（默认整个 frame），批次解析时直接传入批次缓冲区与偏移。
         支持 802.1Q VLAN tag（跳过 4 字节 tag）。
         """
-        if len(frame) < 14:
+        if end is None:
+            end = len(frame)
+        if end - off < 14:
             return
 
-        ethertype = struct.unpack_from('!H', frame, 12)[0]
-        payload_offset = 14
+        ethertype = struct.unpack_from('!H', frame, off + 12)[0]
+        payload_offset = off + 14
 
         # 处理 802.1Q VLAN tag（跳过 4 字节）
         if ethertype == ETH_P_8021Q:
-            if len(frame) < 18:
+            if end - off < 18:
                 return
-            ethertype = struct.unpack_from('!H', frame, 16)[0]
-            payload_offset = 18
+            ethertype = struct.unpack_from('!H', frame, off + 16)[0]
+            payload_offset = off + 18
 
         if ethertype == ETH_P_IP:
-            self._handle_ipv4(frame[payload_offset:], ts)
+            self._handle_ipv4(frame, payload_offset, end, ts)
         elif ethertype == ETH_P_IPV6:
-            self._handle_ipv6(frame[payload_offset:], ts)
+            self._handle_ipv6(frame, payload_offset, end, ts)
         # 其他协议（ARP 等）直接忽略
 
+    def _parse_batch(self, batch: FrameBatch):
+        """
+        解析一个 FrameBatch（帧按 stride 定长槽位排列，不做切片拷贝）。
+        批次足够大且 NumPy 可用时整批向量化解析，每批只做一次统计更新；
+        否则逐帧解析。
+        """
+        tables = self._vec_tables
+        if tables is not None and len(batch) >= vecparse.VECTOR_MIN_BATCH:
+            result = vecparse.parse_batch(batch, tables)
+            if result is not None:
+                up, down, ip_bytes = result
+                if up or down:
+                    self.stats.add_batch(up, down, ip_bytes, batch.ts)
+                return
+
+        buf, stride, ts = batch.buf, batch.stride, batch.ts
+        parse = self._parse_frame
+        off = 0
+        for caplen in batch.caplens:
+            parse(buf, ts, off, off + caplen)
+            off += stride
+
     # ── 启动抓包（raw socket 替代 Scapy sniff）───────────────────────────────
 
     def start(self):
@@ -777,72 +1334,44 @@ class PacketCapture:
         1. 无需为每个数据包构建完整 Scapy 层次对象，CPU 开销降低约 20x
         2. 可以手动设置更大的 SO_RCVBUF，减少内核缓冲区溢出导致的丢包
         3. 直接操作 bytes，避免 Python 对象 GC 压力
+
+        capture_backend='mmap' 时优先使用 TPACKET_V3 内存映射环（见 rawsock.py），
+        创建失败（内核/权限不支持）则回退到逐帧 recv 循环；
+        capture_backend='batch' 时使用 recvmmsg 批量收包。
+        所有后端都以 FrameBatch 为单位投递给处理线程。
         """
         self.running = True
         logger.info(f"Starting raw socket capture on interface: {self.iface}")
 
+        sock = None
         try:
-            # AF_PACKET + SOCK_RAW：接收所有以太网帧（含链路层头）
-            # ETH_P_ALL (0x0003) 的 big-endian 形式
-            sock = socket.socket(
-                socket.AF_PACKET,
-                socket.SOCK_RAW,
-                socket.htons(ETH_P_ALL)
-            )
-
-            # 绑定到指定网卡，只抓该网卡的流量
-            sock.bind((self.iface, 0))
-
-            # 放大内核接收缓冲区，减少高流量下的丢包
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_SIZE)
-            actual_buf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
-            self._socket_buffer_actual_kb = actual_buf // 1024
-            logger.info(
-                f"Socket recv buffer: requested={SOCKET_RCVBUF_SIZE//1024}KB, "
-                f"actual={actual_buf//1024}KB"
-            )
-
-            # 若实际缓冲区低于请求值的 50%，说明宿主机 net.core.rmem_max 限制过低
-            # BT 高并发下载时极易导致内核丢包，统计严重偏低
-            if actual_buf < SOCKET_RCVBUF_SIZE * 0.5:
-                logger.warning(
-                    f"[Buffer] Socket recv buffer is much smaller than requested "
-                    f"({actual_buf//1024}KB vs {SOCKET_RCVBUF_SIZE//1024}KB). "
-                    "High-traffic scenarios (BT) will likely suffer kernel drops!"
-                )
-                logger.warning(
-                    "[Buffer] Fix: run on host: sysctl -w net.core.rmem_max=134217728"
-                )
+            sock = self._open_socket()
 
-            # 设置非阻塞超时，便于检查 self.running 标志
-            sock.settimeout(1.0)
+            if self._workers > 1:
+                # 主进程套接字仅用于验证权限，随即关闭，收包全部交给工作进程
+                self._sock = None
+                sock.close()
+                self._run_fanout()
+                return
 
-            logger.info("Raw socket ready, capturing packets (producer->queue->processor)...")
+            if self._capture_backend == 'mmap':
+                ring = self._setup_rx_ring(sock)
+                if ring is not None:
+                    try:
+                        self._ring_loop(ring)
+                    finally:
+                        ring.close()
+                    return
 
-            while self.running:
+            if self._capture_backend == 'batch':
+                receiver = BatchReceiver(sock)
                 try:
-                    frame = sock.recv(65535)
-                    ts = time.time()
-                    # ── 生产者仅投帧到队列，不在此做任何解析 ──────────────
-                    # 解析由 _packet_processor_loop 在独立线程中完成，
-                    # recv 循环保持最低延迟，最大化内核缓冲区消费速度。
-                    try:
-                        self._pkt_queue.put_nowait((frame, ts))
-                    except queue.Full:
-                        self._queue_drop_count += 1
-                        # 每 1000 个丢帧打印一次，避免日志洪泛
-                        if self._queue_drop_count % 1000 == 1:
-                            logger.warning(
-                                f"[Buffer] Packet queue full! Total dropped by queue: "
-                                f"{self._queue_drop_count}. "
-                                "Processor thread may be too slow or traffic is extremely high."
-                            )
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    if self.running:
-                        logger.error(f"Recv error: {e}")
-                    break
+                    self._batch_loop(receiver)
+                finally:
+                    receiver.close()
+                return
+
+            self._recv_loop(sock)
 
         except PermissionError:
             logger.error("Permission denied: need NET_RAW capability or root")
@@ -853,11 +1382,288 @@ class PacketCapture:
             logger.warning("Falling back to Scapy simulation mode")
             self._simulate()
         finally:
+            self._sock = None
             try:
                 sock.close()
             except Exception:
                 pass
 
+    # ── 多进程抓包（PACKET_FANOUT）─────────────────────────────────────────
+
+    def _run_fanout(self):
+        """
+        主进程侧：启动 N 个工作进程加入同一 PACKET_FANOUT 组（按流哈希分发），
+        持续接收它们发来的统计增量并入 self.stats；工作进程意外退出时自动重启。
+        持久化、实时速率、API 读取的仍是主进程的 TrafficStats，行为与单进程一致。
+        """
+        ctx = multiprocessing.get_context('spawn')
+        out_queue = ctx.Queue()
+        # fanout 组号在同一网络命名空间内须唯一，取主进程 PID 低 16 位
+        group_id = os.getpid() & 0xFFFF
+        procs: Dict[int, multiprocessing.Process] = {}
+
+        def spawn(worker_id: int):
+            p = ctx.Process(
+                target=_fanout_worker_main,
+                args=(self._worker_config, worker_id, group_id, out_queue),
+                daemon=True, name=f'capture-worker-{worker_id}',
+            )
+            p.start()
+            procs[worker_id] = p
+
+        for i in range(self._workers):
+            spawn(i)
+        logger.info(
+            f"[Fanout] Started {self._workers} capture worker processes "
+            f"(PACKET_FANOUT group {group_id}, hash by flow, backend={self._capture_backend})"
+        )
+
+        last_check = time.time()
+        while self.running:
+            try:
+                msg = out_queue.get(timeout=1.0)
+            except queue.Empty:
+                msg = None
+            if msg is not None:
+                if msg.get('rcvbuf_kb'):
+                    self._socket_buffer_actual_kb = msg['rcvbuf_kb']
+                self.stats.merge_deltas(msg)
+
+            now = time.time()
+            if now - last_check >= FANOUT_WORKER_CHECK_INTERVAL:
+                last_check = now
+                for worker_id, p in list(procs.items()):
+                    if not p.is_alive():
+                        logger.error(
+                            f"[Fanout] Worker {worker_id} exited (code {p.exitcode}), restarting"
+                        )
+                        spawn(worker_id)
+
+        for p in procs.values():
+            p.terminate()
+
+    def _run_fanout_worker(self, worker_id: int, group_id: int, out_queue):
+        """
+        工作进程侧：打开自己的套接字（含 BPF 过滤器）并加入 fanout 组，
+        收包后在本进程内直接解析（无需处理线程），
+        每 FANOUT_MERGE_INTERVAL 秒把增量发送给主进程；主进程退出后自行结束。
+        """
+        self.running = True
+        parent = os.getppid()
+        sock = self._open_socket()
+        reader = None
+        if self._capture_backend == 'mmap':
+            reader = self._setup_rx_ring(sock)
+        if reader is not None:
+            read = reader.read_block
+        else:
+            # 工作进程内 recv 与 batch 后端统一使用批量收包器
+            reader = BatchReceiver(sock)
+            read = reader.recv_batch
+        join_fanout(sock, group_id)
+        logger.info(f"[Fanout] Worker {worker_id} joined fanout group {group_id}")
+
+        first = True
+        last_merge = time.time()
+        try:
+            while self.running:
+                batch = read(timeout_ms=200)
+                if batch is not None:
+                    self._parse_batch(batch)
+
+                now = time.time()
+                if now - last_merge >= FANOUT_MERGE_INTERVAL:
+                    last_merge = now
+                    if os.getppid() != parent:
+                        break   # 主进程已退出
+                    deltas = self.stats.drain_deltas()
+                    if first:
+                        deltas['rcvbuf_kb'] = self._socket_buffer_actual_kb
+                        first = False
+                    out_queue.put(deltas)
+        finally:
+            reader.close()
+            sock.close()
+
+    def _open_socket(self) -> socket.socket:
+        """创建并配置 AF_PACKET 原始套接字（绑定网卡 + 放大接收缓冲区）。"""
+        # AF_PACKET + SOCK_RAW：接收所有以太网帧（含链路层头）
+        # ETH_P_ALL (0x0003) 的 big-endian 形式
+        sock = socket.socket(
+            socket.AF_PACKET,
+            socket.SOCK_RAW,
+            socket.htons(ETH_P_ALL)
+        )
+
+        # 绑定到指定网卡，只抓该网卡的流量
+        sock.bind((self.iface, 0))
+
+        # 放大内核接收缓冲区，减少高流量下的丢包
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_RCVBUF_SIZE)
+        actual_buf = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._socket_buffer_actual_kb = actual_buf // 1024
+        logger.info(
+            f"Socket recv buffer: requested={SOCKET_RCVBUF_SIZE//1024}KB, "
+            f"actual={actual_buf//1024}KB"
+        )
+
+        # 若实际缓冲区低于请求值的 50%，说明宿主机 net.core.rmem_max 限制过低
+        # BT 高并发下载时极易导致内核丢包，统计严重偏低
+        if actual_buf < SOCKET_RCVBUF_SIZE * 0.5:
+            logger.warning(
+                f"[Buffer] Socket recv buffer is much smaller than requested "
+                f"({actual_buf//1024}KB vs {SOCKET_RCVBUF_SIZE//1024}KB). "
+                "High-traffic scenarios (BT) will likely suffer kernel drops!"
+            )
+            logger.warning(
+                "[Buffer] Fix: run on host: sysctl -w net.core.rmem_max=134217728"
+            )
+
+        self._sock = sock
+        self._install_socket_filter(sock)
+        return sock
+
+    def _install_socket_filter(self, sock: socket.socket = None):
+        """
+        在抓包套接字上挂载（或原子替换）内核侧 cBPF 过滤器：
+          - 预过滤开启时：按当前本机 IP / LAN 前缀编译方向判定规则，
+            非 IP 帧与 LAN 内部流量在内核中直接丢弃，接收的包同时截断到 snaplen
+          - 预过滤关闭时：仅做 snaplen 截断
+        本机 IP 或 /56 前缀变化时由刷新线程再次调用，使内核规则与
+        _is_local_v4 / _is_local_v6 保持一致。
+        挂载失败不影响抓包，用户态判定仍然完整生效。
+        """
+        with self._local_ips_lock:
+            sock = sock or self._sock
+            if sock is None:
+                return  # 套接字尚未创建，start() 中会再次调用
+            if not self._prefilter and self._snaplen <= 0:
+                logger.info("[BPF] Snaplen truncation disabled, full frames are copied to userspace")
+                return
+
+            if self._prefilter:
+                v4_local, v6_local = self._local_networks()
+                try:
+                    program = prefilter_program(v4_local, v6_local, self._snaplen)
+                    attach_filter(sock, program)
+                    logger.info(
+                        f"[BPF] Kernel prefilter attached: {len(program)} insns, "
+                        f"{len(v4_local)} IPv4 / {len(v6_local)} IPv6 local networks, "
+                        f"snaplen={self._snaplen or 'full'}"
+                    )
+                    return
+                except (OSError, ValueError) as e:
+                    logger.warning(f"[BPF] Failed to attach prefilter ({e}); falling back to snaplen-only filter")
+
+            try:
+                attach_filter(sock, snaplen_program(self._snaplen))
+                logger.info(f"[BPF] Kernel snaplen filter attached: {self._snaplen} bytes per packet")
+            except OSError as e:
+                logger.warning(f"[BPF] Failed to attach snaplen filter ({e}); full frames will be copied")
+
+    def _local_networks(self) -> Tuple[List[ipaddress.IPv4Network], List[ipaddress.IPv6Network]]:
+        """
+        汇总"本地侧"网段，供内核过滤器编译，与 _is_local_v4 / _is_local_v6 判定等价：
+          IPv4 = 私有网段 + 本机地址 /32
+          IPv6 = LAN 前缀 + BUILTIN_IPV6_EXCLUDE + 本机地址 /128
+        LAN 前缀放在最前（NAS 自身地址通常落在其中，命中最快）；
+        已被前缀覆盖的本机地址不再单独生成匹配指令。
+        """
+        state = self._local
+        v4 = list(PRIVATE_IPV4_NETWORKS)
+        v4 += [ipaddress.IPv4Network(ip) for ip in sorted(state.v4_ints)
+               if not _is_private_v4_int(ip)]
+        v6 = list(state.lan_prefixes) + BUILTIN_IPV6_EXCLUDE
+        for packed in sorted(state.v6_bytes):
+            addr = ipaddress.IPv6Address(packed)
+            if not any(addr in net for net in v6):
+                v6.append(ipaddress.IPv6Network(packed))
+        return v4, v6
+
+    def _setup_rx_ring(self, sock: socket.socket):
+        """在套接字上建立 TPACKET_V3 接收环，失败返回 None（调用方回退 recv 循环）。"""
+        try:
+            ring = TPacketV3Ring(sock)
+        except (OSError, ValueError) as e:
+            logger.warning(f"[RxRing] TPACKET_V3 ring unavailable ({e}); falling back to recv loop")
+            return None
+        logger.info(
+            f"[RxRing] TPACKET_V3 ring ready: {ring.block_nr} x {ring.block_size // 1024}KB blocks, "
+            f"header bytes per frame: {ring.header_bytes}"
+        )
+        return ring
+
+    def _enqueue_batch(self, batch: FrameBatch):
+        """生产者投递一批帧：环已满时整批丢弃并计数，不阻塞收包。"""
+        ring = self._pkt_ring
+        prev = ring.drops
+        if not ring.put(batch):
+            # 每丢 1000 帧打印一次，避免日志洪泛
+            if prev == 0 or prev // 1000 != ring.drops // 1000:
+                logger.warning(
+                    f"[Buffer] Packet queue full! Total dropped by queue: "
+                    f"{ring.drops}. "
+                    "Processor thread may be too slow or traffic is extremely high."
+                )
+
+    def _ring_loop(self, ring: TPacketV3Ring):
+        """mmap 环消费循环：每次取一整个 block，整块作为一批投递。"""
+        logger.info("RX ring ready, capturing packets (mmap block->queue->processor)...")
+        last_stats_time = time.time()
+        while self.running:
+            batch = ring.read_block(timeout_ms=1000)
+            if batch is not None:
+                self._enqueue_batch(batch)
+
+            # 环满时内核直接丢包且不计入 /proc/net/dev，需单独采样告警
+            now = time.time()
+            if now - last_stats_time >= KERNEL_DROP_MONITOR_INTERVAL:
+                last_stats_time = now
+                st = ring.stats()
+                if st and st['drops']:
+                    logger.warning(
+                        f"[RxRing] Ring dropped {st['drops']} packets in last "
+                        f"{KERNEL_DROP_MONITOR_INTERVAL}s (received {st['packets']})"
+                    )
+
+    def _batch_loop(self, receiver: BatchReceiver):
+        """批量收包循环：一次系统调用取走当前排队的多帧，整批投递。"""
+        logger.info(
+            f"Batch receiver ready ({receiver.mode}, up to {receiver.batch_size} frames/call), "
+            "capturing packets (batch->queue->processor)..."
+        )
+        while self.running:
+            try:
+                batch = receiver.recv_batch(timeout_ms=1000)
+            except OSError as e:
+                if self.running:
+                    logger.error(f"Recv error: {e}")
+                break
+            if batch is not None:
+                self._enqueue_batch(batch)
+
+    def _recv_loop(self, sock: socket.socket):
+        """逐帧 recv 循环（默认后端，也是 mmap 环不可用时的回退路径）。"""
+        # 设置非阻塞超时，便于检查 self.running 标志
+        sock.settimeout(1.0)
+
+        logger.info("Raw socket ready, capturing packets (producer->queue->processor)...")
+
+        while self.running:
+            try:
+                frame = sock.recv(self._snaplen or 65535)
+                ts = time.time()
+                # ── 生产者仅投帧到队列，不在此做任何解析 ──────────────
+                # 解析由 _packet_processor_loop 在独立线程中完成，
+                # recv 循环保持最低延迟，最大化内核缓冲区消费速度。
+                self._enqueue_batch(FrameBatch.single(frame, ts))
+            except socket.timeout:
+                continue
+            except Exception as e:
+                if self.running:
+                    logger.error(f"Recv error: {e}")
+                break
+
     def _simulate(self):
         """无法抓包时的演示模式"""
         import random
@@ -872,23 +1678,33 @@ class PacketCapture:
             ip = random.choice(fake_ips)
             size = random.randint(500, 1460)
             direction = random.choices(['up', 'down'], weights=[1, 4])[0]
-            self.stats.add_bytes(direction, size, ip, time.time())
+            self.stats.add_bytes(direction, size, key_of(ip), time.time())
 
     # ── 对外接口 ──────────────────────────────────────────────────────────────
 
-    def flush_stats(self) -> Dict:
-        return self.stats.flush_and_get()
+    def flush_stats(self, commit: Callable[[Dict[int, Dict], Dict[int, Dict[str, int]], int], Any]) -> Tuple[int, Any]:
+        """把内存小时数据交给 commit 写库，失败时数据保留在内存中（见 TrafficStats.flush）。"""
+        return self.stats.flush(commit)
 
-    def get_realtime(self, seconds: int = 60) -> List[Dict]:
-        return self.stats.get_realtime_speed(seconds)
+    def get_realtime(self, seconds: int = 60, resolution: Optional[int] = None) -> List[Dict]:
+        return self.stats.get_realtime_speed(seconds, resolution)
 
     def get_top_ips(self, n: int = 10) -> List[Dict]:
         return self.stats.get_top_ips(n)
 
     @property
     def local_ips(self) -> Set[str]:
-        with self._local_ips_lock:
-            return set(self._local_ips)
+        return set(self._local.ips)
+
+    @property
+    def local_state(self) -> LocalState:
+        """当前生效的本地侧快照（不可变），调用方可直接读取其字段而无需加锁。"""
+        return self._local
+
+    @property
+    def manual_mode(self) -> bool:
+        """LAN 前缀是否由 EXCLUDE_IPV6_PREFIX 手动指定（否则按网卡 GUA 自动检测）。"""
+        return self._manual_mode
 
     @property
     def kernel_drops_last_60s(self) -> int:
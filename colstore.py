@@ -0,0 +1,517 @@
+"""
+colstore.py - 内存映射列式流量存储（STORAGE_BACKEND=columnar）
+
+SQLite 行存储中，天/月/年合计依赖汇总表，多年范围的小时查询仍要扫描大量行。
+ColumnarStore 把每小时的计数器存为定长 int64 数组文件，按 hour_key 相对
+BASE_HOUR 的偏移直接定位：
+  up / down        每小时上下行字节数
+  tz_offset        该小时的 UTC 偏移（秒）
+  updated          最后写入的时间戳，0 表示该小时无记录
+  cum_up / cum_down 前缀和：cum[i] = 前 i 个小时之和
+任意 [a, b) 小时区间的合计 = cum[b] - cum[a]，天、月、年乃至多年查询都是两次
+数组读取，不经过 SQL。每年约 280 KB，文件按整年扩展；BASE_HOUR 之前的空洞
+由文件系统稀疏存储，不占磁盘。
+
+写入是追加式的：新数据几乎总落在最近一两个小时，前缀和只需从最早被修改的
+小时重算到末尾。每批写入先把受影响小时的新绝对值记入 redo 文件并 fsync，再写
+映射、msync，最后删除 redo；中途崩溃时启动重放 redo（绝对值，可重复执行）。
+
+远端 IP 统计与数据库维护仍由 SQLite（database.Database）负责。
+"""
+
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from datetime import date
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import hourkey
+from database import Database
+from storage import StorageBackend
+
+logger = logging.getLogger('sentinel.colstore')
+
+# 数组下标 0 对应的小时：2000-01-01 00:00（本地）；更早的记录视为时钟异常并丢弃
+BASE_HOUR = hourkey.day_key_of(date(2000, 1, 1)) * 24
+
+# 每小时一格的列
+HOUR_COLUMNS = ('up', 'down', 'tz_offset', 'updated')
+# 维护前缀和的列（文件名 cum_<列名>，比小时列多一格）
+PREFIX_COLUMNS = ('up', 'down')
+
+# 文件按此小时数整块扩展，避免频繁重新映射
+GROW_HOURS = 24 * 366
+
+# 单次写入允许超前当前时间的小时数，防止异常时间戳把文件撑大
+MAX_FUTURE_HOURS = 48
+
+_ITEM_SIZE = 8
+_META_FILE = 'meta.json'
+_REDO_FILE = 'redo.json'
+
+
+class _Column:
+    """一个 int64 数组文件的可写内存映射（本机字节序），下标即小时偏移。"""
+
+    def __init__(self, path: str, length: int):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._mm = None
+        self.view = None
+        self._map(max(length, os.fstat(self._fd).st_size // _ITEM_SIZE))
+
+    def _map(self, length: int):
+        if os.fstat(self._fd).st_size < length * _ITEM_SIZE:
+            os.ftruncate(self._fd, length * _ITEM_SIZE)   # 扩展部分为稀疏空洞，读出为 0
+        self._mm = mmap.mmap(self._fd, length * _ITEM_SIZE)
+        self.view = memoryview(self._mm).cast('q')
+
+    def __len__(self) -> int:
+        return len(self.view)
+
+    def resize(self, length: int):
+        self._unmap()
+        self._map(length)
+
+    def flush(self):
+        self._mm.flush()
+
+    def _unmap(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    def close(self):
+        self._unmap()
+        os.close(self._fd)
+
+
+class ColumnarStore(StorageBackend):
+    """
+    列式计数器存储；查询接口与返回结构与 Database 完全一致。
+    sql 为同一数据目录下的 Database，负责远端 IP 统计、维护与首次导入的历史数据。
+    """
+
+    def __init__(self, directory: str, sql: Database):
+        self.directory = directory
+        self._sql = sql
+        # 保护全部映射的读写；读取都是 O(1) 或按请求范围的短循环
+        self._lock = threading.Lock()
+        self._cols: Dict[str, _Column] = {}
+        self._cum: Dict[str, _Column] = {}
+        # 有记录的最早/最晚小时（None 表示尚无数据）
+        self.first_hour: Optional[int] = None
+        self.last_hour: Optional[int] = None
+        # 已写入的溢写日志最大代次，与小时范围一起记在元数据中
+        self.journal_gen = 0
+        # 计数器已写入、但写入 SQLite 失败的远端 IP 数据，随下一批重试
+        self._pending_ips: Dict[int, Dict[str, int]] = {}
+
+    # ── 生命周期 ──────────────────────────────────────────────────────────────
+
+    def init_schema(self):
+        self._sql.init_schema()
+        os.makedirs(self.directory, exist_ok=True)
+        fresh = not self._load_meta()
+        self._map_columns()
+        with self._lock:
+            self._replay_redo()
+            if fresh:
+                self._import_sql()
+                self._save_meta()
+        logger.info(f"Columnar store initialized: {self.directory}")
+
+    def attach(self):
+        """只读打开：不重放 redo、不导入，写入由另一进程完成，之后随 refresh() 跟进。"""
+        self._sql.attach()
+        self._load_meta()
+        self._map_columns()
+        logger.info(f"Columnar store attached: {self.directory}")
+
+    def refresh(self):
+        """重新读取元数据，写入进程扩展过文件时同步扩大映射。"""
+        with self._lock:
+            self._load_meta()
+            if self.last_hour is not None:
+                self._ensure(self.last_hour - BASE_HOUR)
+
+    def _load_meta(self) -> bool:
+        """读取有记录的小时范围，元数据文件不存在时返回 False。"""
+        meta_path = os.path.join(self.directory, _META_FILE)
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        self.first_hour, self.last_hour = meta['first_hour'], meta['last_hour']
+        self.journal_gen = meta.get('journal_gen', 0)
+        return True
+
+    def _map_columns(self):
+        length = GROW_HOURS
+        if self.last_hour is not None:
+            length = self._grown_length(self.last_hour - BASE_HOUR)
+        for name in HOUR_COLUMNS:
+            self._cols[name] = _Column(os.path.join(self.directory, f'{name}.i64'), length)
+        for name in PREFIX_COLUMNS:
+            self._cum[name] = _Column(os.path.join(self.directory, f'cum_{name}.i64'), length + 1)
+
+    def close(self):
+        with self._lock:
+            if self._pending_ips:
+                try:
+                    self._sql.commit_stats({}, self._pending_ips)
+                except Exception as e:
+                    logger.error(f"Columnar store: dropping IP data of {len(self._pending_ips)} hours "
+                                 f"that could not be written: {e}")
+                self._pending_ips = {}
+            for col in list(self._cols.values()) + list(self._cum.values()):
+                col.flush()
+                col.close()
+            self._cols.clear()
+            self._cum.clear()
+        self._sql.close()
+
+    def _import_sql(self):
+        """
+        首次启用时导入 SQLite 中已有的数据。调用方需持有 _lock。
+        小时记录原样导入；保留策略删除小时记录后，天/月汇总中多出的部分（即没有小时
+        明细的历史）记到该天 / 该月第一天的第一个小时，天、月、年合计与 SQLite 一致。
+        """
+        now = int(time.time())
+        # 导入的数据已包含 SQLite 记录的日志代次
+        self.journal_gen = self._sql.journal_generation()
+        hours: Dict[int, List[int]] = {h: [up, down, tz] for h, tz, up, down in self._sql.export_hourly()}
+        daily, monthly = self._sql.export_rollups()
+
+        day_sums: Dict[int, List[int]] = {}
+        for h, (up, down, _) in hours.items():
+            acc = day_sums.setdefault(h // 24, [0, 0])
+            acc[0] += up
+            acc[1] += down
+        rolled = 0
+
+        def add_residual(hour_key: int, up: int, down: int):
+            nonlocal rolled
+            up, down = max(up, 0), max(down, 0)
+            if not up and not down:
+                return
+            row = hours.setdefault(hour_key, [0, 0, hourkey.offset_of_key(hour_key)])
+            row[0] += up
+            row[1] += down
+            rolled += 1
+
+        for day_key, up, down in daily:
+            have = day_sums.get(day_key, (0, 0))
+            add_residual(day_key * 24, up - have[0], down - have[1])
+        # 天汇总也已过期的月份只剩月汇总：按补齐后的小时数据求各月已有的部分
+        month_sums: Dict[int, List[int]] = {}
+        for h, (up, down, _) in hours.items():
+            acc = month_sums.setdefault(hourkey.month_of_hour(h), [0, 0])
+            acc[0] += up
+            acc[1] += down
+        for month_key, up, down in monthly:
+            have = month_sums.get(month_key, (0, 0))
+            add_residual(hourkey.month_start_day(month_key) * 24, up - have[0], down - have[1])
+
+        dropped = [h for h in hours if h < BASE_HOUR]
+        for h in dropped:
+            del hours[h]
+        if dropped:
+            logger.warning(f"Columnar store: skipped {len(dropped)} records before "
+                           f"{hourkey.hour_str(BASE_HOUR)} (not representable)")
+        rows = [(h, up, down, tz, now) for h, (up, down, tz) in sorted(hours.items())]
+        if rows:
+            self._apply(rows)
+            self._flush()
+            logger.info(f"Columnar store: imported {len(rows)} hourly records from SQLite "
+                        f"({rolled} of them carry daily/monthly rollups without hourly detail)")
+
+    # ── 文件布局 ──────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _grown_length(max_index: int) -> int:
+        return (max_index // GROW_HOURS + 1) * GROW_HOURS
+
+    def _ensure(self, max_index: int):
+        """保证下标 max_index 可写。调用方需持有 _lock。"""
+        if max_index < len(self._cols['up']):
+            return
+        length = self._grown_length(max_index)
+        for col in self._cols.values():
+            col.resize(length)
+        for col in self._cum.values():
+            col.resize(length + 1)
+
+    def _used(self) -> int:
+        """已使用的小时数（前缀和有效下标为 0..used）。"""
+        return 0 if self.last_hour is None else self.last_hour - BASE_HOUR + 1
+
+    def _save_meta(self):
+        path = os.path.join(self.directory, _META_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'first_hour': self.first_hour, 'last_hour': self.last_hour,
+                       'journal_gen': self.journal_gen}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _flush(self):
+        for col in list(self._cols.values()) + list(self._cum.values()):
+            col.flush()
+
+    # ── 写入 ──────────────────────────────────────────────────────────────────
+
+    def _apply(self, rows: Sequence[Tuple[int, int, int, int, int]]):
+        """
+        写入 (hour_key, up, down, tz_offset, updated) 绝对值并重算受影响的前缀和。
+        重复执行结果不变（redo 重放依赖这一点）。调用方需持有 _lock。
+        """
+        lo = min(r[0] for r in rows) - BASE_HOUR
+        hi = max(r[0] for r in rows) - BASE_HOUR
+        self._ensure(hi)
+        up, down = self._cols['up'].view, self._cols['down'].view
+        tz, updated = self._cols['tz_offset'].view, self._cols['updated'].view
+        for hour_key, u, d, offset, ts in rows:
+            i = hour_key - BASE_HOUR
+            up[i], down[i], tz[i], updated[i] = u, d, offset, ts
+        # 跳过的空白小时同样需要延续前缀和，因此从 min(lo, 原 used) 开始重算；
+        # 首次写入之前的前缀和全为 0，保持稀疏空洞不写
+        start = lo if self.last_hour is None else min(lo, self._used())
+        if self.first_hour is None or lo + BASE_HOUR < self.first_hour:
+            self.first_hour = lo + BASE_HOUR
+        if self.last_hour is None or hi + BASE_HOUR > self.last_hour:
+            self.last_hour = hi + BASE_HOUR
+        used = self._used()
+        for name in PREFIX_COLUMNS:
+            values, cum = self._cols[name].view, self._cum[name].view
+            acc = cum[start]
+            for i in range(start, used):
+                acc += values[i]
+                cum[i + 1] = acc
+
+    def _replay_redo(self):
+        path = os.path.join(self.directory, _REDO_FILE)
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, encoding='utf-8') as f:
+                redo = json.load(f)
+            rows = [tuple(r) for r in redo['rows']]
+            journal_gen = redo.get('journal_gen', 0)
+        except (ValueError, KeyError):
+            rows, journal_gen = [], 0   # redo 尚未完整写入就崩溃：映射未被修改，直接丢弃
+        if rows or journal_gen > self.journal_gen:
+            if rows:
+                self._apply(rows)
+                self._flush()
+            self.journal_gen = max(self.journal_gen, journal_gen)
+            self._save_meta()
+            logger.info(f"Columnar store: replayed {len(rows)} hourly records from redo file")
+        os.remove(path)
+
+    def _write_redo(self, rows: Iterable[Tuple[int, int, int, int, int]], journal_gen: int):
+        path = os.path.join(self.directory, _REDO_FILE)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'rows': [list(r) for r in rows], 'journal_gen': journal_gen}, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def commit_stats(self, hourly_data: Dict[int, Dict],
+                     ip_hourly: Optional[Dict[int, Dict[str, int]]] = None, journal_gen: int = 0) -> float:
+        """
+        先累加小时计数器（redo 记录绝对值与 journal_gen，崩溃后重放是幂等的），再把远端 IP 数据写入
+        SQLite。计数器写入失败时抛出异常，由调用方整批重试；计数器已落盘而 IP 写入失败时
+        不再抛出（否则整批重试会重复累加计数器），IP 数据留在 _pending_ips 中随下一批写入。
+        """
+        if not hourly_data and not ip_hourly and not self._pending_ips:
+            return 0.0
+        t0 = time.perf_counter()
+
+        now = int(time.time())
+        limit = hourkey.hour_key_of(now)[0] + MAX_FUTURE_HOURS
+        with self._lock:
+            up, down = self._cols['up'].view, self._cols['down'].view
+            size = len(up)
+            rows = []
+            for hour_key, stats in sorted(hourly_data.items()):
+                if not BASE_HOUR <= hour_key <= limit:
+                    logger.warning(f"Columnar store: dropping record for implausible hour "
+                                   f"{hourkey.hour_str(hour_key)} (clock error?)")
+                    continue
+                i = hour_key - BASE_HOUR
+                cur_up, cur_down = (up[i], down[i]) if i < size else (0, 0)
+                tz_offset = stats.get('tz_offset')
+                if tz_offset is None:
+                    tz_offset = hourkey.offset_of_key(hour_key)
+                rows.append((hour_key, cur_up + stats.get('up', 0), cur_down + stats.get('down', 0),
+                             tz_offset, now))
+            if rows or journal_gen > self.journal_gen:
+                self._write_redo(rows, journal_gen)
+                if rows:
+                    self._apply(rows)
+                    self._flush()
+                self.journal_gen = max(self.journal_gen, journal_gen)
+                self._save_meta()
+                os.remove(os.path.join(self.directory, _REDO_FILE))
+            ip_hourly = self._take_pending_ips(ip_hourly)
+        if ip_hourly:
+            try:
+                self._sql.commit_stats({}, ip_hourly)
+            except Exception as e:
+                with self._lock:
+                    self._pending_ips = self._take_pending_ips(ip_hourly)
+                logger.warning(f"Columnar store: IP write failed, will retry with the next batch: {e}")
+        elapsed = time.perf_counter() - t0
+        logger.debug(f"commit_stats (columnar): {len(rows)} hourly records in {elapsed * 1000:.1f} ms")
+        return elapsed
+
+    def journal_generation(self) -> int:
+        with self._lock:
+            return self.journal_gen
+
+    def _take_pending_ips(self, ip_hourly: Optional[Dict[int, Dict[str, int]]]) -> Dict[int, Dict[str, int]]:
+        """取出待重试的 IP 数据并与 ip_hourly 合并。调用方需持有 _lock。"""
+        merged, self._pending_ips = self._pending_ips, {}
+        for hour_key, ips in (ip_hourly or {}).items():
+            bucket = merged.setdefault(hour_key, {})
+            for ip, b in ips.items():
+                bucket[ip] = bucket.get(ip, 0) + b
+        return merged
+
+    # ── 区间求和 ──────────────────────────────────────────────────────────────
+
+    def _sums(self, bounds: Sequence[int]) -> List[Dict]:
+        """
+        相邻小时边界 [bounds[i], bounds[i+1]) 的合计列表。
+        每个边界只查一次前缀和，n 个区间共 n + 1 次数组读取。
+        """
+        with self._lock:
+            used = self._used()
+            cum_up, cum_down = self._cum['up'].view, self._cum['down'].view
+            points = []
+            for h in bounds:
+                i = min(max(h - BASE_HOUR, 0), used)
+                points.append((cum_up[i], cum_down[i]))
+        result = []
+        for (u0, d0), (u1, d1) in zip(points, points[1:]):
+            up, down = u1 - u0, d1 - d0
+            result.append({'up_bytes': up, 'down_bytes': down, 'total_bytes': up + down})
+        return result
+
+    def _sum(self, first_hour: int, end_hour: int) -> Dict:
+        """[first_hour, end_hour) 的合计，两次前缀和查表。"""
+        return self._sums((first_hour, end_hour))[0]
+
+    def _daily_sums(self, first: int, last: int) -> List[Dict]:
+        return self._sums([k * 24 for k in range(first, last + 2)])
+
+    def _monthly_sums(self, first: int, last: int) -> List[Dict]:
+        return self._sums([hourkey.month_start_day(k) * 24 for k in range(first, last + 2)])
+
+    # ── 流量查询 ──────────────────────────────────────────────────────────────
+
+    def get_today_stats(self) -> Dict:
+        today = hourkey.day_key_of(date.today())
+        return self._daily_sums(today, today)[0]
+
+    def get_month_stats(self) -> Dict:
+        month = hourkey.month_key_of(date.today())
+        return self._monthly_sums(month, month)[0]
+
+    def get_year_stats(self) -> Dict:
+        first = date.today().year * 12
+        return self._sum(hourkey.month_start_day(first) * 24, hourkey.month_start_day(first + 12) * 24)
+
+    def get_last_30days(self) -> List[Dict]:
+        last = hourkey.day_key_of(date.today())
+        return self._daily_series(last - 29, last)
+
+    def get_last_12months(self) -> List[Dict]:
+        last = hourkey.month_key_of(date.today())
+        return [{'month': hourkey.month_str(k), **row}
+                for k, row in zip(range(last - 11, last + 1), self._monthly_sums(last - 11, last))]
+
+    def query_range(self, start: str, end: str, granularity: str = 'day') -> Dict:
+        first, last = hourkey.parse_day(start), hourkey.parse_day(end)
+        if granularity == 'hour':
+            series = self._hour_rows(first, last)
+        elif granularity == 'month':
+            # 与 SQLite 汇总表一致：只返回有流量的月份
+            m0, m1 = hourkey.month_of_hour(first * 24), hourkey.month_of_hour(last * 24)
+            series = [{'month': hourkey.month_str(k), **row}
+                      for k, row in zip(range(m0, m1 + 1), self._monthly_sums(m0, m1))
+                      if row['total_bytes']]
+        else:
+            series = self._daily_series(first, last)
+        summary = self._sum(first * 24, (last + 1) * 24) if granularity != 'month' else {
+            'up_bytes': sum(r['up_bytes'] for r in series),
+            'down_bytes': sum(r['down_bytes'] for r in series),
+            'total_bytes': sum(r['total_bytes'] for r in series),
+        }
+        return {'summary': summary, 'series': series}
+
+    def _daily_series(self, first: int, last: int) -> List[Dict]:
+        return [{'day': hourkey.day_str(k), **row}
+                for k, row in zip(range(first, last + 1), self._daily_sums(first, last))]
+
+    def _hour_rows(self, first_day: int, last_day: int, with_total: bool = True) -> List[Dict]:
+        """[first_day, last_day] 内有记录的小时。"""
+        result = []
+        with self._lock:
+            used = self._used()
+            a = min(max(first_day * 24 - BASE_HOUR, 0), used)
+            b = min(max((last_day + 1) * 24 - BASE_HOUR, 0), used)
+            up, down = self._cols['up'].view, self._cols['down'].view
+            updated = self._cols['updated'].view
+            for i in range(a, b):
+                if not updated[i]:
+                    continue
+                row = {'hour_ts': hourkey.hour_str(i + BASE_HOUR), 'up_bytes': up[i], 'down_bytes': down[i]}
+                if with_total:
+                    row['total_bytes'] = up[i] + down[i]
+                result.append(row)
+        return result
+
+    def get_available_date_range(self) -> Dict:
+        if self.first_hour is None:
+            today = date.today().strftime('%Y-%m-%d')
+            return {'min': today, 'max': today}
+        return {'min': hourkey.day_str(self.first_hour // 24), 'max': hourkey.day_str(self.last_hour // 24)}
+
+    def get_hourly_today(self) -> List[Dict]:
+        today = hourkey.day_key_of(date.today())
+        return self._hour_rows(today, today, with_total=False)
+
+    # ── 远端 IP 统计与维护：委托 SQLite ───────────────────────────────────────
+
+    def get_top_ips(self, start: str, end: str, n: int = 10) -> List[Dict]:
+        return self._sql.get_top_ips(start, end, n)
+
+    def get_ip_bytes(self, start: str, end: str, ips: Sequence[str]) -> Dict[str, int]:
+        return self._sql.get_ip_bytes(start, end, ips)
+
+    def get_ip_other_bytes(self, start: str, end: str) -> int:
+        return self._sql.get_ip_other_bytes(start, end)
+
+    @property
+    def last_maintenance(self) -> Optional[Dict]:
+        return self._sql.last_maintenance
+
+    def run_maintenance(self, hourly_months: int, daily_years: int, ip_retention_days: int) -> Dict:
+        """列式计数器体积很小（每年约 280 KB），不做降采样；SQLite 侧照常维护。"""
+        return self._sql.run_maintenance(hourly_months, daily_years, ip_retention_days)
+
+    def get_storage_info(self) -> Dict:
+        info = self._sql.get_storage_info()
+        # 稀疏文件按实际占用的块计算
+        info['columnar_bytes'] = sum(
+            os.stat(col.path).st_blocks * 512
+            for col in list(self._cols.values()) + list(self._cum.values()))
+        return info
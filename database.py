@@ -7,8 +7,13 @@ import sqlite3
 import logging
 import os
 import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta, date
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import hourkey
+from storage import StorageBackend
 
 
 def _local_now_str() -> str:
@@ -19,6 +24,22 @@ def _local_now_str() -> str:
 
 logger = logging.getLogger('sentinel.database')
 
+# 只读连接池上限：仪表盘同时轮询的接口数量级，超出部分用完即关
+READER_POOL_SIZE = 8
+# 每条连接缓存的已编译语句数
+STATEMENT_CACHE_SIZE = 64
+
+# 按小时的 IP 明细保留天数；更早的数据只保留按天汇总
+IP_HOURLY_RETENTION_DAYS = 7
+# 压缩时每个已结束的自然日保留的 IP 数，其余合并为一行 '*'（长尾合计）
+IP_DAILY_TOP_N = 1000
+# 长尾合计行使用的占位 IP
+IP_OTHER = '*'
+
+# PRAGMA auto_vacuum 取值：2 = INCREMENTAL（删除释放的页留在空闲列表，由 incremental_vacuum 归还文件系统）
+AUTO_VACUUM_INCREMENTAL = 2
+
+# v0 基础结构（仅在全新数据库上创建，之后的结构变更全部通过 MIGRATIONS 完成）
 SCHEMA = """
 CREATE TABLE IF NOT EXISTS traffic_hourly (
     id         INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -29,88 +50,468 @@ CREATE TABLE IF NOT EXISTS traffic_hourly (
     updated_at TEXT
 );
 
-CREATE VIEW IF NOT EXISTS traffic_daily AS
-SELECT
-    substr(hour_ts, 1, 10)     AS day,
-    SUM(up_bytes)              AS up_bytes,
-    SUM(down_bytes)            AS down_bytes,
-    SUM(up_bytes + down_bytes) AS total_bytes
-FROM traffic_hourly
-GROUP BY substr(hour_ts, 1, 10);
-
-CREATE VIEW IF NOT EXISTS traffic_monthly AS
-SELECT
-    substr(hour_ts, 1, 7)      AS month,
-    SUM(up_bytes)              AS up_bytes,
-    SUM(down_bytes)            AS down_bytes,
-    SUM(up_bytes + down_bytes) AS total_bytes
-FROM traffic_hourly
-GROUP BY substr(hour_ts, 1, 7);
-
 CREATE INDEX IF NOT EXISTS idx_hourly_hour_ts ON traffic_hourly(hour_ts);
 """
 
+# ── 结构迁移 ──────────────────────────────────────────────────────────────────
+# (目标版本, 迁移脚本)，按 PRAGMA user_version 依次执行，每个脚本在单个事务内完成
+
+MIGRATIONS = [
+    # v1：天/月视图替换为物化汇总表。
+    # 视图每次查询都要对整张小时表 GROUP BY；汇总表由 commit_stats 在同一事务内
+    # 增量维护，读取变为主键点查/范围查。此处一次性从小时表回填历史数据。
+    (1, """
+DROP VIEW IF EXISTS traffic_daily;
+DROP VIEW IF EXISTS traffic_monthly;
+
+CREATE TABLE IF NOT EXISTS traffic_daily (
+    day         TEXT PRIMARY KEY,          -- 'YYYY-MM-DD'
+    up_bytes    INTEGER NOT NULL DEFAULT 0,
+    down_bytes  INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS traffic_monthly (
+    month       TEXT PRIMARY KEY,          -- 'YYYY-MM'
+    up_bytes    INTEGER NOT NULL DEFAULT 0,
+    down_bytes  INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+INSERT OR REPLACE INTO traffic_daily (day, up_bytes, down_bytes, total_bytes)
+SELECT substr(hour_ts, 1, 10), SUM(up_bytes), SUM(down_bytes), SUM(up_bytes + down_bytes)
+FROM traffic_hourly GROUP BY substr(hour_ts, 1, 10);
+
+INSERT OR REPLACE INTO traffic_monthly (month, up_bytes, down_bytes, total_bytes)
+SELECT substr(hour_ts, 1, 7), SUM(up_bytes), SUM(down_bytes), SUM(up_bytes + down_bytes)
+FROM traffic_hourly GROUP BY substr(hour_ts, 1, 7);
+"""),
+
+    # v2：时间键由 TEXT 改为整数（见 hourkey.py）。
+    # 小时表以 hour_key 为主键并记录写入时的 UTC 偏移；天/月汇总表以 day_key /
+    # month_key 为主键。旧数据的偏移按当前时区推算（tz_offset_of 由 _migrate 注册）。
+    (2, """
+ALTER TABLE traffic_hourly RENAME TO traffic_hourly_v1;
+
+CREATE TABLE traffic_hourly (
+    hour_key   INTEGER PRIMARY KEY,        -- 本地挂钟小时数（自 1970-01-01 00:00）
+    tz_offset  INTEGER NOT NULL DEFAULT 0, -- 该小时的 UTC 偏移（秒）
+    up_bytes   INTEGER NOT NULL DEFAULT 0,
+    down_bytes INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT,
+    updated_at TEXT
+);
+
+INSERT INTO traffic_hourly (hour_key, tz_offset, up_bytes, down_bytes, created_at, updated_at)
+SELECT CAST(strftime('%s', hour_ts) AS INTEGER) / 3600,
+       tz_offset_of(CAST(strftime('%s', hour_ts) AS INTEGER) / 3600),
+       up_bytes, down_bytes, created_at, updated_at
+FROM traffic_hourly_v1;
+
+DROP TABLE traffic_hourly_v1;
+DROP TABLE traffic_daily;
+DROP TABLE traffic_monthly;
+
+CREATE TABLE traffic_daily (
+    day_key     INTEGER PRIMARY KEY,       -- hour_key / 24
+    up_bytes    INTEGER NOT NULL DEFAULT 0,
+    down_bytes  INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE traffic_monthly (
+    month_key   INTEGER PRIMARY KEY,       -- 年 * 12 + (月 - 1)
+    up_bytes    INTEGER NOT NULL DEFAULT 0,
+    down_bytes  INTEGER NOT NULL DEFAULT 0,
+    total_bytes INTEGER NOT NULL DEFAULT 0
+);
+
+INSERT INTO traffic_daily (day_key, up_bytes, down_bytes, total_bytes)
+SELECT hour_key / 24, SUM(up_bytes), SUM(down_bytes), SUM(up_bytes + down_bytes)
+FROM traffic_hourly GROUP BY hour_key / 24;
+
+INSERT INTO traffic_monthly (month_key, up_bytes, down_bytes, total_bytes)
+SELECT CAST(strftime('%Y', hour_key * 3600, 'unixepoch') AS INTEGER) * 12
+         + CAST(strftime('%m', hour_key * 3600, 'unixepoch') AS INTEGER) - 1 AS mk,
+       SUM(up_bytes), SUM(down_bytes), SUM(up_bytes + down_bytes)
+FROM traffic_hourly GROUP BY mk;
+"""),
+
+    # v3：按小时/按天的远端 IP 流量。小时表保留 IP_HOURLY_RETENTION_DAYS 天用于细粒度排查，
+    # 天表是任意日期范围 TOP-K 查询的预聚合数据源；两者均以 (时间键, ip) 为主键。
+    (3, """
+CREATE TABLE IF NOT EXISTS traffic_ip_hourly (
+    hour_key INTEGER NOT NULL,
+    ip       TEXT    NOT NULL,
+    bytes    INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (hour_key, ip)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS traffic_ip_daily (
+    day_key INTEGER NOT NULL,
+    ip      TEXT    NOT NULL,              -- '*' 为压缩后的长尾 IP 合计
+    bytes   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day_key, ip)
+) WITHOUT ROWID;
+"""),
+
+    # v4：存储状态键值表。journal_gen 为已写入的溢写日志最大代次，由 commit_stats 在
+    # 同一事务内更新；写库成功但删除日志分段之前崩溃时，重放据此跳过已写入的分段。
+    (4, """
+CREATE TABLE IF NOT EXISTS storage_state (
+    key   TEXT    PRIMARY KEY,
+    value INTEGER NOT NULL
+) WITHOUT ROWID;
+"""),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _upsert_many(conn: sqlite3.Connection, table: str, keys: Sequence[str], adds: Sequence[str],
+                 rows: Sequence[tuple], sets: Sequence[str] = (), inserts: Sequence[str] = ()):
+    """
+    批量累加式 upsert：一条语句经 executemany 写入全部行（语句只编译一次）。
+    rows 中每行的列顺序为 keys + adds + sets + inserts：
+      adds    冲突时在原值上累加
+      sets    冲突时以新值覆盖
+      inserts 仅在首次插入时写入
+    """
+    if not rows:
+        return
+    cols = list(keys) + list(adds) + list(sets) + list(inserts)
+    updates = [f"{c} = {c} + excluded.{c}" for c in adds] + [f"{c} = excluded.{c}" for c in sets]
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))}) "
+        f"ON CONFLICT({', '.join(keys)}) DO UPDATE SET {', '.join(updates)}",
+        rows)
+
+
+class Database(StorageBackend):
+    """
+    连接复用：
+      - 一条专用写连接，所有写入经 _lock 串行化
+      - 一个小型只读连接池，读取之间互不加锁（WAL 模式下读写互不阻塞）
+    连接只在首次创建时设置 PRAGMA，之后长期复用；sqlite3 模块按连接缓存
+    已编译的语句，重复执行的查询无需再次解析 SQL。
+    """
 
-class Database:
     def __init__(self, db_path: str):
         self.db_path = db_path
-        self._lock = threading.Lock()
+        self._lock = threading.Lock()          # 写锁：仅保护 _writer
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._writer = self._connect()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        # 最近一次 run_maintenance() 的结果，供 /api/health 展示
+        self._last_maintenance: Optional[Dict] = None
 
-    def _get_conn(self) -> sqlite3.Connection:
-        conn = sqlite3.connect(self.db_path, timeout=10)
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        # check_same_thread=False：连接会在不同请求线程间复用，由调用方保证同一时刻只有一个使用者
+        conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
         conn.row_factory = sqlite3.Row
+        if not readonly:
+            # 须在切换 WAL 之前设置才能对全新数据库生效；已有数据库由 vacuum() 首次运行时转换
+            conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
         conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("PRAGMA synchronous=NORMAL")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
         return conn
 
+    @contextmanager
+    def _reader(self):
+        """从连接池借出一条只读连接，用完归还；池空时新建，归还时超出上限则关闭。"""
+        with self._readers_lock:
+            conn = self._readers.pop() if self._readers else None
+        if conn is None:
+            conn = self._connect(readonly=True)
+        try:
+            yield conn
+        finally:
+            with self._readers_lock:
+                if len(self._readers) < READER_POOL_SIZE:
+                    self._readers.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+    def close(self):
+        """关闭写连接与池中全部只读连接。"""
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            conn.close()
+        with self._lock:
+            self._writer.close()
+
     def init_schema(self):
         with self._lock:
-            with self._get_conn() as conn:
-                conn.executescript(SCHEMA)
+            with self._writer as conn:
+                if conn.execute("PRAGMA user_version").fetchone()[0] == 0:
+                    conn.executescript(SCHEMA)
+                self._migrate(conn)
         logger.info(f"Database initialized: {self.db_path}")
 
-    def commit_stats(self, hourly_data: Dict[str, Dict]):
-        if not hourly_data:
-            return
+    def _migrate(self, conn: sqlite3.Connection):
+        """按 user_version 执行尚未应用的迁移；任一步失败则整步回滚，下次启动重试。"""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.create_function('tz_offset_of', 1, hourkey.offset_of_key, deterministic=True)
+        for target, script in MIGRATIONS:
+            if version >= target:
+                continue
+            logger.info(f"Migrating database schema v{version} -> v{target} ...")
+            try:
+                conn.executescript(f"BEGIN;\n{script}\nPRAGMA user_version = {target};\nCOMMIT;")
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            version = target
+            logger.info(f"Database schema migrated to v{target}")
+
+    def commit_stats(self, hourly_data: Dict[int, Dict],
+                     ip_hourly: Optional[Dict[int, Dict[str, int]]] = None, journal_gen: int = 0) -> float:
+        """
+        hourly_data: {hour_key: {'up', 'down', 'tz_offset'}}（TrafficStats.flush() 交出的数据）
+        缺少 tz_offset 时按当前时区推算。
+        ip_hourly:   {hour_key: {远端IP: 字节数}}，可选
+        journal_gen: 本批已包含的溢写日志最大代次，0 表示不记录
+        小时表、天/月汇总表、IP 表与日志代次全部在同一事务内写入。
+        返回写入耗时（秒），无数据时返回 0。
+        """
+        if not hourly_data and not ip_hourly:
+            return 0.0
         now_str = _local_now_str()          # 统一用 Python 本地时间，严格跟随 TZ 变量
+
+        hourly_rows = []
+        # 天/月汇总增量先在内存中按键合并，每个键只 upsert 一次
+        daily: Dict[int, List[int]] = {}
+        monthly: Dict[int, List[int]] = {}
+        for hour_key, stats in hourly_data.items():
+            up, down = stats.get('up', 0), stats.get('down', 0)
+            tz_offset = stats.get('tz_offset')
+            if tz_offset is None:
+                tz_offset = hourkey.offset_of_key(hour_key)
+            hourly_rows.append((hour_key, up, down, tz_offset, now_str, now_str))
+            for rollup, key in ((daily, hour_key // 24), (monthly, hourkey.month_of_hour(hour_key))):
+                acc = rollup.setdefault(key, [0, 0])
+                acc[0] += up
+                acc[1] += down
+
+        ip_hour_rows = []
+        ip_daily: Dict[Tuple[int, str], int] = {}
+        for hour_key, ips in (ip_hourly or {}).items():
+            day_key = hour_key // 24
+            for ip, b in ips.items():
+                ip_hour_rows.append((hour_key, ip, b))
+                ip_daily[(day_key, ip)] = ip_daily.get((day_key, ip), 0) + b
+
+        t0 = time.perf_counter()
+        with self._lock:
+            with self._writer as conn:
+                _upsert_many(conn, 'traffic_hourly', ('hour_key',), ('up_bytes', 'down_bytes'), hourly_rows,
+                             sets=('tz_offset', 'updated_at'), inserts=('created_at',))
+                # 汇总表与小时表在同一事务内更新，任何时刻都保持一致
+                for table, col, rollup in (('traffic_daily', 'day_key', daily),
+                                           ('traffic_monthly', 'month_key', monthly)):
+                    _upsert_many(conn, table, (col,), ('up_bytes', 'down_bytes', 'total_bytes'),
+                                 [(key, up, down, up + down) for key, (up, down) in rollup.items()])
+                _upsert_many(conn, 'traffic_ip_hourly', ('hour_key', 'ip'), ('bytes',), ip_hour_rows)
+                _upsert_many(conn, 'traffic_ip_daily', ('day_key', 'ip'), ('bytes',),
+                             [(d, ip, b) for (d, ip), b in ip_daily.items()])
+                if journal_gen:
+                    conn.execute(
+                        "INSERT INTO storage_state (key, value) VALUES ('journal_gen', ?) "
+                        "ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)", (journal_gen,))
+        elapsed = time.perf_counter() - t0
+        logger.debug(f"commit_stats: {len(hourly_rows)} hourly / {len(daily)} daily / "
+                     f"{len(monthly)} monthly / {len(ip_hour_rows)} ip rows in {elapsed * 1000:.1f} ms")
+        return elapsed
+
+    # ── 远端 IP 统计 ──────────────────────────────────────────────────────────
+
+    def get_top_ips(self, start: str, end: str, n: int = 10) -> List[Dict]:
+        """
+        [start, end]（'YYYY-MM-DD'）内字节数最多的 n 个远端 IP。
+        直接在按天预聚合的 IP 表上做主键区间扫描，不触及小时明细。
+        """
+        with self._reader() as conn:
+            rows = conn.execute("""
+                SELECT ip, SUM(bytes) AS bytes
+                FROM traffic_ip_daily
+                WHERE day_key >= ? AND day_key <= ? AND ip != ?
+                GROUP BY ip ORDER BY bytes DESC LIMIT ?
+            """, (hourkey.parse_day(start), hourkey.parse_day(end), IP_OTHER, n)).fetchall()
+        return [dict(r) for r in rows]
+
+    def get_ip_bytes(self, start: str, end: str, ips: Sequence[str]) -> Dict[str, int]:
+        """指定 IP 在 [start, end] 内已持久化的字节数（用于与内存增量合并排名）。"""
+        result: Dict[str, int] = {}
+        first, last = hourkey.parse_day(start), hourkey.parse_day(end)
+        ips = list(ips)
+        with self._reader() as conn:
+            for i in range(0, len(ips), 500):    # 分块，避免超出 SQLite 绑定参数上限
+                chunk = ips[i:i + 500]
+                rows = conn.execute(f"""
+                    SELECT ip, SUM(bytes) AS bytes FROM traffic_ip_daily
+                    WHERE day_key >= ? AND day_key <= ? AND ip IN ({','.join('?' * len(chunk))})
+                    GROUP BY ip
+                """, [first, last] + chunk).fetchall()
+                result.update((r['ip'], r['bytes']) for r in rows)
+        return result
+
+    def get_ip_other_bytes(self, start: str, end: str) -> int:
+        """[start, end] 内长尾行 IP_OTHER 的字节数（SpaceSaving 无法归属的部分与压缩并入的尾部 IP）。"""
+        with self._reader() as conn:
+            row = conn.execute("""
+                SELECT COALESCE(SUM(bytes), 0) FROM traffic_ip_daily
+                WHERE day_key >= ? AND day_key <= ? AND ip = ?
+            """, (hourkey.parse_day(start), hourkey.parse_day(end), IP_OTHER)).fetchone()
+        return row[0]
+
+    def compact_ip_stats(self, retention_days: int) -> Dict[str, int]:
+        """
+        IP 统计的保留与压缩，返回各步骤影响的行数：
+          - 删除 IP_HOURLY_RETENTION_DAYS 天之前的小时明细
+          - 已结束的自然日只保留前 IP_DAILY_TOP_N 个 IP，其余并入 '*' 长尾行
+          - retention_days > 0 时删除更早的按天数据
+        """
+        today = hourkey.day_key_of(date.today())
         with self._lock:
-            with self._get_conn() as conn:
-                for hour_ts, stats in hourly_data.items():
-                    conn.execute("""
-                        INSERT INTO traffic_hourly (hour_ts, up_bytes, down_bytes, created_at, updated_at)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(hour_ts) DO UPDATE SET
-                            up_bytes   = up_bytes   + excluded.up_bytes,
-                            down_bytes = down_bytes + excluded.down_bytes,
-                            updated_at = excluded.updated_at
-                    """, (hour_ts, stats.get('up', 0), stats.get('down', 0), now_str, now_str))
-                conn.commit()
+            with self._writer as conn:
+                hourly = conn.execute("DELETE FROM traffic_ip_hourly WHERE hour_key < ?",
+                                      ((today - IP_HOURLY_RETENTION_DAYS) * 24,)).rowcount
+                expired = 0
+                if retention_days > 0:
+                    expired = conn.execute("DELETE FROM traffic_ip_daily WHERE day_key < ?",
+                                           (today - retention_days,)).rowcount
+                # 找出 IP 数超限的已结束自然日，逐日把排名之外的行并入长尾
+                days = [r[0] for r in conn.execute("""
+                    SELECT day_key FROM traffic_ip_daily
+                    WHERE day_key < ? AND ip != ?
+                    GROUP BY day_key HAVING COUNT(*) > ?
+                """, (today, IP_OTHER, IP_DAILY_TOP_N))]
+                folded = 0
+                for day_key in days:
+                    tail = conn.execute("""
+                        SELECT ip, bytes FROM traffic_ip_daily
+                        WHERE day_key = ? AND ip != ?
+                        ORDER BY bytes DESC LIMIT -1 OFFSET ?
+                    """, (day_key, IP_OTHER, IP_DAILY_TOP_N)).fetchall()
+                    _upsert_many(conn, 'traffic_ip_daily', ('day_key', 'ip'), ('bytes',),
+                                 [(day_key, IP_OTHER, sum(r['bytes'] for r in tail))])
+                    conn.executemany("DELETE FROM traffic_ip_daily WHERE day_key = ? AND ip = ?",
+                                     [(day_key, r['ip']) for r in tail])
+                    folded += len(tail)
+        stats = {'hourly_deleted': hourly, 'daily_expired': expired, 'daily_folded': folded}
+        if any(stats.values()):
+            logger.info(f"IP stats compacted: {stats}")
+        return stats
+
+    # ── 保留策略与维护 ────────────────────────────────────────────────────────
+
+    def apply_retention(self, hourly_months: int, daily_years: int) -> Dict[str, int]:
+        """
+        按时间分级保留流量数据，返回删除的行数：
+          - hourly_months > 0：只保留最近 N 个自然月（含本月）的小时记录
+          - daily_years > 0  ：只保留最近 N 年的天汇总
+        天/月汇总由写入时维护，删除小时记录不影响更粗粒度的统计；月汇总永久保留。
+        """
+        month = hourkey.month_key_of(date.today())
+        hourly = daily = 0
+        with self._lock:
+            with self._writer as conn:
+                if hourly_months > 0:
+                    cutoff = hourkey.month_start_day(month - hourly_months + 1) * 24
+                    hourly = conn.execute("DELETE FROM traffic_hourly WHERE hour_key < ?",
+                                          (cutoff,)).rowcount
+                if daily_years > 0:
+                    cutoff = hourkey.month_start_day(month - daily_years * 12 + 1)
+                    daily = conn.execute("DELETE FROM traffic_daily WHERE day_key < ?",
+                                         (cutoff,)).rowcount
+        stats = {'hourly_deleted': hourly, 'daily_deleted': daily}
+        if any(stats.values()):
+            logger.info(f"Retention applied: {stats}")
+        return stats
+
+    def vacuum(self) -> int:
+        """
+        归还空闲页并刷新查询规划统计，返回归还的页数。
+        旧数据库首次执行时先转换为 auto_vacuum=INCREMENTAL（需一次完整 VACUUM），
+        之后每次只做增量回收，不重写整个文件。
+        """
+        with self._lock:
+            conn = self._writer
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+                logger.info("Converting database to incremental auto-vacuum (one-time full VACUUM) ...")
+                conn.execute(f"PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}")
+                conn.execute("VACUUM")
+            free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # sqlite3 模块的 execute() 每次只单步执行一次，只回收一页；executescript 会执行到底
+            conn.executescript("PRAGMA incremental_vacuum;")
+            conn.execute("PRAGMA optimize")
+            # 截断 WAL 文件，避免写入高峰后长期占用磁盘
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        return free
+
+    def run_maintenance(self, hourly_months: int, daily_years: int, ip_retention_days: int) -> Dict:
+        """保留策略 + IP 统计压缩 + 增量 VACUUM，结果记入 last_maintenance 并返回。"""
+        t0 = time.perf_counter()
+        result: Dict = {}
+        result.update(self.apply_retention(hourly_months, daily_years))
+        result['ip'] = self.compact_ip_stats(ip_retention_days)
+        result['vacuumed_pages'] = self.vacuum()
+        result['duration_s'] = round(time.perf_counter() - t0, 3)
+        result['finished_at'] = _local_now_str()
+        self._last_maintenance = result
+        logger.info(f"Maintenance finished in {result['duration_s']:.2f}s, "
+                    f"{result['vacuumed_pages']} free pages reclaimed")
+        return result
+
+    @property
+    def last_maintenance(self) -> Optional[Dict]:
+        return self._last_maintenance
+
+    def get_storage_info(self) -> Dict:
+        """数据库文件与 WAL 大小、空闲页占用（字节）。"""
+        def size_of(path: str) -> int:
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        with self._reader() as conn:
+            page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return {
+            'db_bytes': size_of(self.db_path),
+            'wal_bytes': size_of(self.db_path + '-wal'),
+            'free_bytes': free_pages * page_size,
+        }
 
     # ── 固定范围快捷查询 ──────────────────────────────────────────────────────
 
     def get_today_stats(self) -> Dict:
-        return self._day_stats(datetime.now().strftime('%Y-%m-%d'))
+        return self._day_stats(hourkey.day_key_of(date.today()))
 
     def get_month_stats(self) -> Dict:
-        month = datetime.now().strftime('%Y-%m')
-        with self._lock:
-            with self._get_conn() as conn:
-                row = conn.execute(
-                    "SELECT up_bytes,down_bytes,total_bytes FROM traffic_monthly WHERE month=?",
-                    (month,)).fetchone()
+        month_key = hourkey.month_key_of(date.today())
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT up_bytes,down_bytes,total_bytes FROM traffic_monthly WHERE month_key=?",
+                (month_key,)).fetchone()
         return dict(row) if row else {'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0}
 
     def get_year_stats(self) -> Dict:
-        year = datetime.now().strftime('%Y')
-        with self._lock:
-            with self._get_conn() as conn:
-                row = conn.execute("""
-                    SELECT SUM(up_bytes) AS up_bytes,
-                           SUM(down_bytes) AS down_bytes,
-                           SUM(up_bytes+down_bytes) AS total_bytes
-                    FROM traffic_hourly WHERE hour_ts LIKE ?
-                """, (year + '%',)).fetchone()
+        first = date.today().year * 12
+        with self._reader() as conn:
+            # 至多 12 行的主键范围扫描
+            row = conn.execute("""
+                SELECT SUM(up_bytes) AS up_bytes,
+                       SUM(down_bytes) AS down_bytes,
+                       SUM(total_bytes) AS total_bytes
+                FROM traffic_monthly WHERE month_key >= ? AND month_key <= ?
+            """, (first, first + 11)).fetchone()
         return dict(row) if row and row['total_bytes'] else {'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0}
 
     def get_last_30days(self) -> List[Dict]:
@@ -120,22 +521,10 @@ class Database:
         return self._daily_range(start, end, fill=True)
 
     def get_last_12months(self) -> List[Dict]:
-        now = datetime.now()
-        months = []
-        for i in range(11, -1, -1):
-            total_months = now.month - 1 - i
-            year  = now.year + total_months // 12
-            month = total_months % 12 + 1
-            months.append(f"{year:04d}-{month:02d}")
-        placeholders = ','.join(['?' for _ in months])
-        with self._lock:
-            with self._get_conn() as conn:
-                rows = conn.execute(
-                    f"SELECT month,up_bytes,down_bytes,total_bytes FROM traffic_monthly "
-                    f"WHERE month IN ({placeholders})", months).fetchall()
-        row_map = {r['month']: dict(r) for r in rows}
-        return [row_map.get(m, {'month': m, 'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0})
-                for m in months]
+        last = hourkey.month_key_of(date.today())
+        rows = self._monthly_rows(last - 11, last)
+        return [rows.get(k, {'month': hourkey.month_str(k), 'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0})
+                for k in range(last - 11, last + 1)]
 
     # ── 核心：日期范围查询 ─────────────────────────────────────────────────────
 
@@ -159,73 +548,99 @@ class Database:
             'series': series,
         }
 
-    def _day_stats(self, day: str) -> Dict:
-        with self._lock:
-            with self._get_conn() as conn:
-                row = conn.execute(
-                    "SELECT up_bytes,down_bytes,total_bytes FROM traffic_daily WHERE day=?",
-                    (day,)).fetchone()
+    def _day_stats(self, day_key: int) -> Dict:
+        with self._reader() as conn:
+            row = conn.execute(
+                "SELECT up_bytes,down_bytes,total_bytes FROM traffic_daily WHERE day_key=?",
+                (day_key,)).fetchone()
         return dict(row) if row else {'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0}
 
+    def _hour_rows(self, first_day: int, last_day: int, with_total: bool = True) -> List[Dict]:
+        """[first_day, last_day] 内的小时记录（主键区间扫描），hour_key 转回 hour_ts 字符串输出。"""
+        with self._reader() as conn:
+            rows = conn.execute("""
+                SELECT hour_key, up_bytes, down_bytes
+                FROM traffic_hourly
+                WHERE hour_key >= ? AND hour_key < ?
+                ORDER BY hour_key
+            """, (first_day * 24, (last_day + 1) * 24)).fetchall()
+        result = []
+        for r in rows:
+            row = {'hour_ts': hourkey.hour_str(r['hour_key']),
+                   'up_bytes': r['up_bytes'], 'down_bytes': r['down_bytes']}
+            if with_total:
+                row['total_bytes'] = r['up_bytes'] + r['down_bytes']
+            result.append(row)
+        return result
+
     def _hourly_range(self, start: str, end: str) -> List[Dict]:
-        with self._lock:
-            with self._get_conn() as conn:
-                rows = conn.execute("""
-                    SELECT hour_ts, up_bytes, down_bytes, (up_bytes+down_bytes) AS total_bytes
-                    FROM traffic_hourly
-                    WHERE hour_ts >= ? AND hour_ts <= ?
-                    ORDER BY hour_ts
-                """, (start + ' 00:00:00', end + ' 23:59:59')).fetchall()
-        return [dict(r) for r in rows]
+        return self._hour_rows(hourkey.parse_day(start), hourkey.parse_day(end))
 
     def _daily_range(self, start: str, end: str, fill: bool = False) -> List[Dict]:
-        with self._lock:
-            with self._get_conn() as conn:
-                rows = conn.execute("""
-                    SELECT day, up_bytes, down_bytes, total_bytes
-                    FROM traffic_daily WHERE day >= ? AND day <= ? ORDER BY day
-                """, (start, end)).fetchall()
-        row_map = {r['day']: dict(r) for r in rows}
+        first, last = hourkey.parse_day(start), hourkey.parse_day(end)
+        with self._reader() as conn:
+            rows = conn.execute("""
+                SELECT day_key, up_bytes, down_bytes, total_bytes
+                FROM traffic_daily WHERE day_key >= ? AND day_key <= ? ORDER BY day_key
+            """, (first, last)).fetchall()
+        row_map = {r['day_key']: {'day': hourkey.day_str(r['day_key']), 'up_bytes': r['up_bytes'],
+                                  'down_bytes': r['down_bytes'], 'total_bytes': r['total_bytes']}
+                   for r in rows}
         if not fill:
             return list(row_map.values())
-        result = []
-        cur   = datetime.strptime(start, '%Y-%m-%d').date()
-        end_d = datetime.strptime(end,   '%Y-%m-%d').date()
-        while cur <= end_d:
-            key = cur.strftime('%Y-%m-%d')
-            result.append(row_map.get(key, {'day': key, 'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0}))
-            cur += timedelta(days=1)
-        return result
+        return [row_map.get(k, {'day': hourkey.day_str(k), 'up_bytes': 0, 'down_bytes': 0, 'total_bytes': 0})
+                for k in range(first, last + 1)]
+
+    def _monthly_rows(self, first: int, last: int) -> Dict[int, Dict]:
+        with self._reader() as conn:
+            rows = conn.execute("""
+                SELECT month_key, up_bytes, down_bytes, total_bytes
+                FROM traffic_monthly WHERE month_key >= ? AND month_key <= ? ORDER BY month_key
+            """, (first, last)).fetchall()
+        return {r['month_key']: {'month': hourkey.month_str(r['month_key']), 'up_bytes': r['up_bytes'],
+                                 'down_bytes': r['down_bytes'], 'total_bytes': r['total_bytes']}
+                for r in rows}
 
     def _monthly_range(self, start: str, end: str) -> List[Dict]:
-        start_m, end_m = start[:7], end[:7]
-        with self._lock:
-            with self._get_conn() as conn:
-                rows = conn.execute("""
-                    SELECT month, up_bytes, down_bytes, total_bytes
-                    FROM traffic_monthly WHERE month >= ? AND month <= ? ORDER BY month
-                """, (start_m, end_m)).fetchall()
-        return [dict(r) for r in rows]
+        first = hourkey.month_key_of(datetime.strptime(start, '%Y-%m-%d').date())
+        last  = hourkey.month_key_of(datetime.strptime(end,   '%Y-%m-%d').date())
+        return list(self._monthly_rows(first, last).values())
+
+    def export_hourly(self) -> List[Tuple[int, int, int, int]]:
+        """全部小时记录 [(hour_key, tz_offset, up_bytes, down_bytes)]，按时间排序（切换存储后端时导入用）。"""
+        with self._reader() as conn:
+            return [tuple(r) for r in conn.execute(
+                "SELECT hour_key, tz_offset, up_bytes, down_bytes FROM traffic_hourly ORDER BY hour_key")]
+
+    def journal_generation(self) -> int:
+        with self._reader() as conn:
+            row = conn.execute("SELECT value FROM storage_state WHERE key = 'journal_gen'").fetchone()
+        return row[0] if row else 0
+
+    def export_rollups(self) -> Tuple[List[Tuple[int, int, int]], List[Tuple[int, int, int]]]:
+        """
+        天/月汇总 ([(day_key, up_bytes, down_bytes)], [(month_key, up_bytes, down_bytes)])，按时间排序。
+        保留策略删除小时记录后，更早的历史只存在于汇总表中，切换存储后端时需一并导入。
+        """
+        with self._reader() as conn:
+            daily = [tuple(r) for r in conn.execute(
+                "SELECT day_key, up_bytes, down_bytes FROM traffic_daily ORDER BY day_key")]
+            monthly = [tuple(r) for r in conn.execute(
+                "SELECT month_key, up_bytes, down_bytes FROM traffic_monthly ORDER BY month_key")]
+        return daily, monthly
 
     def get_available_date_range(self) -> Dict:
-        with self._lock:
-            with self._get_conn() as conn:
-                row = conn.execute("""
-                    SELECT MIN(substr(hour_ts,1,10)) AS min_day,
-                           MAX(substr(hour_ts,1,10)) AS max_day
-                    FROM traffic_hourly
-                """).fetchone()
-        if row and row['min_day']:
-            return {'min': row['min_day'], 'max': row['max_day']}
+        with self._reader() as conn:
+            # MIN/MAX 主键各一次索引端点查找
+            row = conn.execute("""
+                SELECT (SELECT MIN(day_key) FROM traffic_daily) AS min_day,
+                       (SELECT MAX(day_key) FROM traffic_daily) AS max_day
+            """).fetchone()
+        if row and row['min_day'] is not None:
+            return {'min': hourkey.day_str(row['min_day']), 'max': hourkey.day_str(row['max_day'])}
         today = date.today().strftime('%Y-%m-%d')
         return {'min': today, 'max': today}
 
     def get_hourly_today(self) -> List[Dict]:
-        today = datetime.now().strftime('%Y-%m-%d')
-        with self._lock:
-            with self._get_conn() as conn:
-                rows = conn.execute(
-                    "SELECT hour_ts,up_bytes,down_bytes FROM traffic_hourly "
-                    "WHERE hour_ts LIKE ? ORDER BY hour_ts",
-                    (today + '%',)).fetchall()
-        return [dict(r) for r in rows]
+        today = hourkey.day_key_of(date.today())
+        return self._hour_rows(today, today, with_total=False)
@@ -0,0 +1,191 @@
+"""
+heavyhitter.py - 固定内存的重流量 IP 统计（Space-Saving 算法）
+
+按远端 IP 精确计数需要为每个出现过的地址保留一项，BT、端口扫描等场景一小时内
+可能接触数十万个不同地址，内存随之无界增长，排行读取也要对整张表排序。
+
+SpaceSaving 最多监控 capacity 个键：
+  - 已监控的键直接累加，O(1)
+  - 未监控的键在表满时替换当前计数最小的键，新键继承其计数作为误差上界
+    （最小值由惰性最小堆维护，均摊 O(log capacity)）
+  - 每个键记录 (count, error)：真实值 ∈ [count - error, count]
+  - 所有计数之和恒等于输入总量；未被监控的键真实值不超过当前最小计数
+  - 并入另一个已满的计数器时，被对方淘汰的键在对方的真实值可能超过合并后的计数，
+    上限为对方的 min_count()。它累加到 merge_error 上：此后真实值
+    ∈ [count - error, count + merge_error]，min_count() 也相应加上 merge_error
+    （Agarwal et al. 的可合并 Space-Saving 规则，只是不把它摊到每个键上，
+    以保持计数之和等于输入总量）
+  - 另外增量维护计数最大的 track 个键（同样用惰性最小堆），top(n) 在 n ≤ track 时
+    只读这一小部分，不随容量增长
+只要不同键数不超过 capacity，结果与精确计数完全一致。
+
+参考：Metwally et al., "Efficient Computation of Frequent and Top-k Elements
+in Data Streams", ICDT 2005；Agarwal et al., "Mergeable Summaries", PODS 2012。
+"""
+
+import heapq
+import itertools
+from typing import Dict, Hashable, Iterable, List, Mapping, Tuple
+
+# 默认容量：每个小时桶最多监控的远端 IP 数
+DEFAULT_CAPACITY = 10000
+
+# 默认增量维护的前列键数：排行与跨进程发布每小时最多取 100 项
+DEFAULT_TRACK = 128
+
+
+class SpaceSaving:
+    """容量固定的 Space-Saving 计数器。非线程安全，由调用方加锁。"""
+
+    __slots__ = ('capacity', 'total', 'merge_error', '_counts', '_errors', '_heap', '_seq',
+                 '_track', '_top', '_top_heap', '_top_floor')
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, track: int = DEFAULT_TRACK):
+        self.capacity = max(1, capacity)
+        self.total = 0                              # 累计输入量（含被替换键的部分）
+        self.merge_error = 0                        # 并入的计数器的 min_count() 之和，见模块说明
+        self._counts: Dict[Hashable, int] = {}
+        self._errors: Dict[Hashable, int] = {}
+        # 每个已监控键在堆中恰有一项 (count, seq, key)；累加不更新堆，
+        # 堆顶计数可能偏小（过期），取最小值时再修正。seq 避免比较不同类型的键
+        self._heap: List[Tuple[int, int, Hashable]] = []
+        self._seq = itertools.count()
+        # 计数最大的至多 track 个键 {key: count}，其余已监控键的计数都不超过 _top_floor。
+        # 计数只增不减，键的计数超过 _top_floor 时进入，超员时淘汰其中最小者并抬高 _top_floor；
+        # _top_heap 与 _heap 一样惰性更新
+        self._track = max(1, track)
+        self._top: Dict[Hashable, int] = {}
+        self._top_heap: List[Tuple[int, int, Hashable]] = []
+        self._top_floor = 0
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+    def add(self, key: Hashable, count: int, error: int = 0):
+        """累加 key 的计数；error 为输入本身已带的误差（合并其他计数器时使用）。"""
+        self.total += count
+        counts = self._counts
+        if key in counts:
+            counts[key] += count
+            if error:
+                self._errors[key] += error
+            self._promote(key, counts[key])
+            return
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self._errors[key] = error
+            heapq.heappush(self._heap, (count, next(self._seq), key))
+            self._promote(key, count)
+            return
+        # 表满：替换计数最小的键，新键继承其计数作为误差
+        floor, victim = self._pop_min()
+        del counts[victim]
+        del self._errors[victim]
+        # 被替换的键离开整张表，不影响 _top_floor 的含义（其余键仍不超过它）
+        self._top.pop(victim, None)
+        counts[key] = floor + count
+        self._errors[key] = floor + error
+        heapq.heappush(self._heap, (floor + count, next(self._seq), key))
+        self._promote(key, floor + count)
+
+    def _promote(self, key: Hashable, count: int):
+        """key 的计数变为 count 后维护前列键集合，均摊 O(log track)。"""
+        top = self._top
+        if key in top:
+            top[key] = count
+            return
+        if count <= self._top_floor:
+            return
+        top[key] = count
+        heapq.heappush(self._top_heap, (count, next(self._seq), key))
+        if len(top) > self._track:
+            heap = self._top_heap
+            while True:
+                c, _, k = heapq.heappop(heap)
+                current = top.get(k)
+                if current is None:
+                    continue                    # 已离开前列的过期项
+                if current == c:
+                    del top[k]
+                    self._top_floor = c
+                    return
+                heapq.heappush(heap, (current, next(self._seq), k))
+
+    def _rebuild_top(self):
+        """前列键因替换而缺员时按整张表重建（只在表满且前列键被替换后发生）。"""
+        rows = heapq.nlargest(self._track, self._counts.items(), key=lambda kv: kv[1])
+        self._top = dict(rows)
+        self._top_heap = [(c, next(self._seq), k) for k, c in rows]
+        heapq.heapify(self._top_heap)
+        self._top_floor = rows[-1][1] if len(rows) < len(self._counts) else 0
+
+    def update(self, items: Mapping[Hashable, int]):
+        for key, count in items.items():
+            self.add(key, count)
+
+    def merge(self, other: 'SpaceSaving'):
+        """
+        并入另一个计数器（如工作进程发来的增量），误差一并累加。
+        对方已满时，其中被淘汰的键可能少计至多 other.min_count()，计入 merge_error。
+        """
+        self.merge_error += other.min_count()
+        for key, count in other._counts.items():
+            self.add(key, count, other._errors[key])
+
+    def _pop_min(self) -> Tuple[int, Hashable]:
+        heap, counts = self._heap, self._counts
+        while True:
+            count, _, key = heapq.heappop(heap)
+            current = counts[key]
+            if current == count:
+                return count, key
+            heapq.heappush(heap, (current, next(self._seq), key))
+
+    def min_count(self) -> int:
+        """
+        未被监控的键真实值的上界（含 merge_error）；表未满且未并入过已满的计数器时为 0
+        （此时所有计数都是精确值）。也是任一计数误差的上界。
+        """
+        if len(self._counts) < self.capacity:
+            return self.merge_error
+        heap, counts = self._heap, self._counts
+        while heap[0][0] != counts[heap[0][2]]:
+            _, _, key = heapq.heappop(heap)
+            heapq.heappush(heap, (counts[key], next(self._seq), key))
+        return heap[0][0] + self.merge_error
+
+    def items(self) -> Iterable[Tuple[Hashable, int, int]]:
+        """(key, count, error) 迭代器。"""
+        errors = self._errors
+        return ((k, c, errors[k]) for k, c in self._counts.items())
+
+    def guaranteed(self) -> Tuple[Dict[Hashable, int], int]:
+        """
+        返回 ({key: 确定下界 count - error}, 未能确定归属的字节数)。
+        两部分之和等于 total，持久化时把后者记到长尾键上即可保持总量不变。
+        """
+        result = {}
+        unattributed = 0
+        errors = self._errors
+        for key, count in self._counts.items():
+            err = errors[key]
+            if count > err:
+                result[key] = count - err
+            unattributed += err
+        return result, unattributed
+
+    def top(self, n: int) -> List[Tuple[Hashable, int, int]]:
+        """
+        计数最大的 n 项 [(key, count, error)]，按计数降序。
+        n ≤ track 时只读增量维护的前列键，耗时 O(track)；否则对整张表取前 n 项。
+        """
+        errors = self._errors
+        top = self._top
+        if n > self._track:
+            source = self._counts
+        else:
+            if len(top) < min(n, len(self._counts)):
+                self._rebuild_top()
+                top = self._top
+            source = top
+        return [(k, c, errors[k]) for k, c in heapq.nlargest(n, source.items(), key=lambda kv: kv[1])]
@@ -0,0 +1,78 @@
+"""
+hourkey.py - 整数时间键：小时 / 天 / 月
+
+存储与内存统计统一使用整数键，取代 'YYYY-MM-DD HH:00:00' 字符串：
+  hour_key  = 本地挂钟时间自 1970-01-01 00:00 起的小时数
+  day_key   = hour_key // 24（本地日期自 1970-01-01 起的天数）
+  month_key = 年 * 12 + (月 - 1)
+
+以本地挂钟（而非 UTC）计数，保证每个键都恰好对应一个本地整点，
+在 +05:30 这类非整点时区下也不会跨越本地小时/日期边界；天、月汇总直接由
+整数运算得到。写入时另存当时的 UTC 偏移（tz_offset，秒），
+hour_key * 3600 - tz_offset 即该小时起点的绝对时间戳，
+容器 TZ 变更或夏令时切换后历史数据仍可准确换算。
+
+整数键比字符串更小、比较更快，范围查询直接走主键区间扫描，
+不再需要 LIKE / substr()。
+"""
+
+import calendar
+import time
+from datetime import date, datetime, timedelta
+from typing import Tuple
+
+_EPOCH_DATE = date(1970, 1, 1)
+_EPOCH_DATETIME = datetime(1970, 1, 1)
+
+
+def hour_key_of(ts: float) -> Tuple[int, int]:
+    """时间戳 → (hour_key, 当时的 UTC 偏移秒数)，跟随 TZ 环境变量。"""
+    lt = time.localtime(ts)
+    return calendar.timegm(lt) // 3600, lt.tm_gmtoff
+
+
+def hour_start_ts(hour_key: int, tz_offset: int) -> int:
+    """该本地小时起点的绝对时间戳。"""
+    return hour_key * 3600 - tz_offset
+
+
+def offset_of_key(hour_key: int) -> int:
+    """按当前时区推算某本地小时的 UTC 偏移（用于迁移无偏移记录的旧数据）。"""
+    naive = _EPOCH_DATETIME + timedelta(hours=hour_key)
+    return hour_key * 3600 - int(naive.timestamp())
+
+
+def hour_str(hour_key: int) -> str:
+    """hour_key → 'YYYY-MM-DD HH:00:00'（API 输出格式保持不变）。"""
+    return (_EPOCH_DATETIME + timedelta(hours=hour_key)).strftime('%Y-%m-%d %H:00:00')
+
+
+def day_key_of(d: date) -> int:
+    return (d - _EPOCH_DATE).days
+
+
+def parse_day(day: str) -> int:
+    """'YYYY-MM-DD' → day_key"""
+    return day_key_of(datetime.strptime(day, '%Y-%m-%d').date())
+
+
+def day_str(day_key: int) -> str:
+    return (_EPOCH_DATE + timedelta(days=day_key)).strftime('%Y-%m-%d')
+
+
+def month_key_of(d: date) -> int:
+    return d.year * 12 + d.month - 1
+
+
+def month_of_hour(hour_key: int) -> int:
+    """hour_key → 所属月份的 month_key"""
+    return month_key_of(_EPOCH_DATE + timedelta(days=hour_key // 24))
+
+
+def month_start_day(month_key: int) -> int:
+    """month_key → 该月 1 日的 day_key"""
+    return day_key_of(date(month_key // 12, month_key % 12 + 1, 1))
+
+
+def month_str(month_key: int) -> str:
+    return f"{month_key // 12:04d}-{month_key % 12 + 1:02d}"
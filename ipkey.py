@@ -0,0 +1,36 @@
+"""
+ipkey.py - 远端地址的整数键
+
+统计层以整数而非字符串标识远端 IP，抓包路径上每个计费包不再调用
+inet_ntoa / ipaddress 格式化地址，只在读取排行、写库时才转换为文本：
+  IPv6 : 128 位地址整数本身
+  IPv4 : 映射到 ::ffff:0:0/96（IPv4-mapped IPv6），即 V4_MAPPED | 32 位地址
+两个族落在同一整数空间且互不冲突（::ffff:0:0/96 不会出现在真实 IPv6 报文中）。
+"""
+
+import ipaddress
+import socket
+import struct
+
+# IPv4-mapped 前缀：::ffff:0:0/96
+V4_MAPPED = 0xFFFF << 32
+
+
+def v4_key(addr: int) -> int:
+    """32 位 IPv4 地址 → 键"""
+    return V4_MAPPED | addr
+
+
+def key_str(key: int) -> str:
+    """键 → IP 文本（IPv4 为点分十进制，IPv6 为压缩格式）"""
+    if key >> 32 == 0xFFFF:
+        return socket.inet_ntoa(struct.pack('!I', key & 0xFFFFFFFF))
+    return str(ipaddress.IPv6Address(key))
+
+
+def key_of(ip: str) -> int:
+    """IP 文本 → 键"""
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 4:
+        return V4_MAPPED | int(addr)
+    return int(addr)
@@ -0,0 +1,128 @@
+"""
+journal.py - 流量增量溢写日志（append-only spill journal）
+
+内存中的小时统计每 SAVE_INTERVAL 秒才写入一次 SQLite，期间进程崩溃或容器被
+强制停止会丢失整个周期的数据；而缩短 SAVE_INTERVAL 又会成倍增加 SQLite 事务。
+
+SpillJournal 以极低成本补上这段窗口：
+  - TrafficStats 每隔几秒把新合并的小时增量追加为一行 JSON，并批量 fsync 一次
+  - 日志按"刷写代次"分段：每次开始写库时切换到新段，写库成功后删除旧段；
+    写库失败则旧段保留，数据仍可恢复
+  - 写库时把本批数据所在的最大代次与数据在同一事务内记入存储；启动时 replay()
+    只汇总代次更大的残留分段，由调用方写入数据库后 discard(upto_gen)。写库成功但
+    删除分段之前崩溃时，已写入的分段不会被重复累加
+崩溃时的数据损失从一个 SAVE_INTERVAL 缩短到一个日志间隔（默认 5 秒）。
+
+每行格式：{"h": [[hour_key, up, down, tz_offset], ...]}
+崩溃时可能残留半行，读取时忽略无法解析的行。
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+logger = logging.getLogger('sentinel.journal')
+
+_SEGMENT_RE = re.compile(r'^spill-(\d+)\.jsonl$')
+
+
+class SpillJournal:
+    """按代次分段的追加日志。所有方法线程安全。"""
+
+    def __init__(self, directory: str, interval: float = 5.0):
+        self.directory = directory
+        self.interval = interval          # 建议的写入间隔（秒），由 TrafficStats 读取
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        existing = self._segments()
+        # 新段编号接在残留分段之后，replay 前的旧数据不会被覆盖
+        self._gen = existing[-1][0] + 1 if existing else 1
+        self._fh = None
+
+    # ── 写入 ─────────────────────────────────────────────────────────────────
+
+    def _path(self, gen: int) -> str:
+        return os.path.join(self.directory, f'spill-{gen}.jsonl')
+
+    def _segments(self) -> List[Tuple[int, str]]:
+        segs = []
+        for name in os.listdir(self.directory):
+            m = _SEGMENT_RE.match(name)
+            if m:
+                segs.append((int(m.group(1)), os.path.join(self.directory, name)))
+        return sorted(segs)
+
+    def append(self, rows: Iterable[Tuple[int, int, int, int]]):
+        """追加一批 (hour_key, up, down, tz_offset) 增量并 fsync。"""
+        rows = [list(r) for r in rows]
+        if not rows:
+            return
+        line = json.dumps({'h': rows}, separators=(',', ':')) + '\n'
+        with self._lock:
+            if self._fh is None:
+                self._fh = open(self._path(self._gen), 'a', encoding='utf-8')
+            self._fh.write(line)
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def rotate(self) -> int:
+        """
+        结束当前段并切换到新段，返回被结束段的代次。
+        写库成功后以该代次调用 discard()。
+        """
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+            gen = self._gen
+            self._gen += 1
+            return gen
+
+    def discard(self, upto_gen: int):
+        """删除代次 ≤ upto_gen 的所有分段（其数据已确认写入数据库）。"""
+        with self._lock:
+            for gen, path in self._segments():
+                if gen <= upto_gen and gen != self._gen:
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logger.warning(f"[Journal] Failed to remove {path}: {e}")
+
+    # ── 恢复 ─────────────────────────────────────────────────────────────────
+
+    def replay(self, applied_gen: int = 0) -> Tuple[Dict[int, Dict], int]:
+        """
+        汇总代次大于 applied_gen（存储中已记录的代次）的残留分段，
+        返回 ({hour_key: {'up', 'down', 'tz_offset'}}, 最大代次)。
+        新段编号同时跳到 applied_gen 之后，日志目录被清空过也不会与已记录的代次冲突。
+        应在开始写入新增量之前调用。
+        """
+        with self._lock:
+            self._gen = max(self._gen, applied_gen + 1)
+        hourly: Dict[int, Dict] = {}
+        last_gen = 0
+        for gen, path in self._segments():
+            last_gen = max(last_gen, gen)
+            if gen <= applied_gen:
+                logger.info(f"[Journal] Skipping segment {gen}, already committed")
+                continue
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        rows = json.loads(line)['h']
+                    except (ValueError, KeyError):
+                        continue   # 崩溃时残留的半行
+                    for hour_key, up, down, tz_offset in rows:
+                        bucket = hourly.setdefault(hour_key, {'up': 0, 'down': 0, 'tz_offset': tz_offset})
+                        bucket['up'] += up
+                        bucket['down'] += down
+        return hourly, last_gen
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
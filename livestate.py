@@ -0,0 +1,319 @@
+"""
+livestate.py - 抓包进程与 API 进程之间的共享内存实时状态（PROCESS_MODE=split）
+
+拆分进程模式下，抓包进程独占 PacketCapture / TrafficStats，API 进程不再与收包、
+解析线程争抢同一个 GIL。抓包进程每秒把 API 需要的内存数据发布到一段
+multiprocessing.shared_memory 中，API 进程直接读取，不经过任何 RPC：
+  - 尚未写库的小时计数器
+  - 三级分辨率的实时速率采样（见 ratering.py）
+  - 每个内存小时确定下界最大的 IP_TOP_PER_HOUR 个远端 IP
+  - 内核丢包、socket 缓冲区、本机 IP / LAN 前缀、最近一次维护结果
+  - 存储写入版本号（API 侧查询缓存据此失效，见 cache.py）
+
+段布局（头部为小端，小时/采样/IP 数组段为本机字节序——只在同一台机器的进程间共享）：
+  0   magic      8s
+  8   seq        u64  顺序锁：写入期间为奇数，写完加一变回偶数
+  16  db_version i64  存储写入版本号，单独的对齐 8 字节字段，写入时立即更新
+  24  length     u64  负载字节数
+  32  crc        u32  负载 CRC32
+  64  负载：头部 + 小时 + 采样 + IP + 元数据 JSON
+只有一个写入者。读取方先读 seq，复制负载后再读一次 seq，两次相同且为偶数、
+CRC 匹配才采用；否则重试。CRC 同时兜住弱内存序平台上的乱序可见问题。
+"""
+
+import ipaddress
+import json
+import logging
+import struct
+import threading
+import time
+import zlib
+from array import array
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple
+
+from ipkey import key_str
+from ratering import pick_resolution
+
+logger = logging.getLogger('sentinel.livestate')
+
+MAGIC = b'NTSLIVE1'
+
+# 共享内存段大小；小时、采样、IP 均为 32 B 一条，常规负载不足 400 KB
+SEGMENT_SIZE = 1 << 20
+
+# 发布周期（秒），与 tick 线程的采样周期一致
+PUBLISH_INTERVAL = 1.0
+
+# 每个内存小时发布的远端 IP 数，与 /api/top_ips 的 n 上限一致
+IP_TOP_PER_HOUR = 100
+
+# 读取方遇到写入中或校验失败时的重试次数
+READ_RETRIES = 100
+
+_SEQ = struct.Struct('<Q')
+_VERSION = struct.Struct('<q')
+_LENGTH = struct.Struct('<QI')
+_SEQ_OFFSET, _VERSION_OFFSET, _LENGTH_OFFSET = 8, 16, 24
+_PAYLOAD_OFFSET = 64
+# 负载头部：发布时间、内核丢包、socket 缓冲区 KB、IP 误差上界、各段条数、元数据长度
+_HEAD = struct.Struct('<dqqqIIII')
+_HOUR_FIELDS, _SAMPLE_FIELDS, _IP_FIELDS = 4, 4, 4
+_U64 = (1 << 64) - 1
+
+
+def create_segment() -> shared_memory.SharedMemory:
+    """由父进程创建并初始化共享内存段，子进程按 name 连接。"""
+    shm = shared_memory.SharedMemory(create=True, size=SEGMENT_SIZE)
+    shm.buf[:_PAYLOAD_OFFSET] = bytes(_PAYLOAD_OFFSET)
+    shm.buf[:len(MAGIC)] = MAGIC
+    return shm
+
+
+class LiveStatePublisher:
+    """抓包进程侧：后台线程每秒把 capture 的内存状态写入共享内存段。"""
+
+    def __init__(self, name: str):
+        self._shm = shared_memory.SharedMemory(name=name)
+        if bytes(self._shm.buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"Shared memory segment '{name}' is not a live state segment")
+        self._seq = _SEQ.unpack_from(self._shm.buf, _SEQ_OFFSET)[0] & ~1
+        self._meta_src: Tuple = ()
+        self._meta = b''
+
+    def db_version(self) -> int:
+        """段中已发布的存储写入版本号；抓包进程被重启时由此接着递增。"""
+        return _VERSION.unpack_from(self._shm.buf, _VERSION_OFFSET)[0]
+
+    def set_db_version(self, version: int):
+        """存储写入版本号变化时立即更新（不等下一个发布周期），供 CachedStorage 回调。"""
+        _VERSION.pack_into(self._shm.buf, _VERSION_OFFSET, version)
+
+    def start(self, capture, db):
+        threading.Thread(target=self._run, args=(capture, db), daemon=True, name='live-publish').start()
+
+    def _run(self, capture, db):
+        while True:
+            try:
+                self.publish(capture, db)
+            except Exception as e:
+                logger.warning(f"[LiveState] Publish failed: {e}")
+            time.sleep(PUBLISH_INTERVAL)
+
+    def publish(self, capture, db):
+        stats = capture.stats
+        hourly = stats.get_hourly_snapshot()
+        tiers = stats.get_realtime_tiers()
+        ip_top, truncated = stats.get_ip_hourly_top(IP_TOP_PER_HOUR)
+        # 未发布的 IP 在该小时的字节数不超过已发布的最小值，计入误差上界
+        error_bound = stats.ip_error_bound() + truncated
+
+        hours = array('q')
+        for hour_key in sorted(hourly):
+            v = hourly[hour_key]
+            hours.extend((hour_key, v['up'], v['down'], v['tz_offset']))
+        ticks = array('q')
+        for resolution, rows in tiers.items():
+            for ts, up, down in rows:
+                ticks.extend((resolution, ts, up, down))
+        ips = array('Q')
+        for hour_key in sorted(ip_top, reverse=True):
+            for key, b in ip_top[hour_key]:
+                ips.extend((hour_key, key >> 64, key & _U64, b))
+
+        meta = self._encode_meta(capture, db)
+        room = SEGMENT_SIZE - _PAYLOAD_OFFSET - _HEAD.size - len(meta)
+        room -= hours.itemsize * len(hours) + ticks.itemsize * len(ticks)
+        if ips.itemsize * len(ips) > room:
+            # 空间不足时保留最近的小时（按小时倒序排列，截断尾部即最早的小时）
+            del ips[max(room, 0) // (ips.itemsize * _IP_FIELDS) * _IP_FIELDS:]
+
+        payload = b''.join((
+            _HEAD.pack(time.time(), capture.kernel_drops_last_60s, capture.socket_buffer_actual_kb,
+                       error_bound, len(hours) // _HOUR_FIELDS, len(ticks) // _SAMPLE_FIELDS,
+                       len(ips) // _IP_FIELDS, len(meta)),
+            hours.tobytes(), ticks.tobytes(), ips.tobytes(), meta,
+        ))
+        if _PAYLOAD_OFFSET + len(payload) > SEGMENT_SIZE:
+            logger.warning(f"[LiveState] Snapshot of {len(payload)} bytes exceeds the segment, skipped")
+            return
+
+        buf = self._shm.buf
+        self._seq += 1
+        _SEQ.pack_into(buf, _SEQ_OFFSET, self._seq)
+        buf[_PAYLOAD_OFFSET:_PAYLOAD_OFFSET + len(payload)] = payload
+        _LENGTH.pack_into(buf, _LENGTH_OFFSET, len(payload), zlib.crc32(payload))
+        self._seq += 1
+        _SEQ.pack_into(buf, _SEQ_OFFSET, self._seq)
+
+    def _encode_meta(self, capture, db) -> bytes:
+        """本机 IP、LAN 前缀与维护结果很少变化，来源对象不变时复用上次的编码。"""
+        state, maintenance = capture.local_state, db.last_maintenance
+        src = (state, maintenance)
+        if src != self._meta_src:
+            self._meta_src = src
+            self._meta = json.dumps({
+                'ips': sorted(state.ips),
+                'lan_prefixes': [str(n) for n in state.lan_prefixes],
+                'manual_mode': capture.manual_mode,
+                'last_maintenance': maintenance,
+            }, separators=(',', ':')).encode()
+        return self._meta
+
+    def close(self):
+        self._shm.close()
+
+
+class _Snapshot:
+    __slots__ = ('published_at', 'kernel_drops', 'socket_kb', 'error_bound',
+                 'hourly', 'samples', 'ip_hourly', 'meta')
+
+    def __init__(self, data: Optional[bytes] = None):
+        self.published_at = 0.0
+        self.kernel_drops = self.socket_kb = self.error_bound = 0
+        self.hourly: Dict[int, Dict] = {}
+        self.samples: Dict[int, List[Tuple[int, int, int]]] = {}
+        self.ip_hourly: Dict[int, List[Tuple[int, int]]] = {}
+        self.meta: Dict = {'ips': [], 'lan_prefixes': [], 'manual_mode': False, 'last_maintenance': None}
+        if data is not None:
+            self._decode(data)
+
+    def _decode(self, data: bytes):
+        (self.published_at, self.kernel_drops, self.socket_kb, self.error_bound,
+         n_hours, n_samples, n_ips, meta_len) = _HEAD.unpack_from(data)
+        off = _HEAD.size
+        hours = array('q', data[off:off + n_hours * _HOUR_FIELDS * 8])
+        off += n_hours * _HOUR_FIELDS * 8
+        ticks = array('q', data[off:off + n_samples * _SAMPLE_FIELDS * 8])
+        off += n_samples * _SAMPLE_FIELDS * 8
+        ips = array('Q', data[off:off + n_ips * _IP_FIELDS * 8])
+        off += n_ips * _IP_FIELDS * 8
+        self.meta = json.loads(data[off:off + meta_len])
+
+        for i in range(0, len(hours), _HOUR_FIELDS):
+            self.hourly[hours[i]] = {'up': hours[i + 1], 'down': hours[i + 2], 'tz_offset': hours[i + 3]}
+        for i in range(0, len(ticks), _SAMPLE_FIELDS):
+            self.samples.setdefault(ticks[i], []).append((ticks[i + 1], ticks[i + 2], ticks[i + 3]))
+        for i in range(0, len(ips), _IP_FIELDS):
+            self.ip_hourly.setdefault(ips[i], []).append(((ips[i + 1] << 64) | ips[i + 2], ips[i + 3]))
+
+
+class _LocalView:
+    """API 进程侧的本地侧快照，字段与 capture.LocalState 中 API 用到的部分一致。"""
+
+    def __init__(self, ips: List[str], lan_prefixes: List[str]):
+        self.ips = frozenset(ips)
+        self.lan_prefixes = tuple(ipaddress.IPv6Network(p) for p in lan_prefixes)
+
+
+class LiveStateView:
+    """
+    API 进程侧：以 PacketCapture 的只读接口读取共享内存（api.create_app 的 capture 参数）。
+    负载按 seq 缓存解码结果，发布周期内的多次请求只读一次 seq。
+    """
+
+    def __init__(self, name: str):
+        self._shm = shared_memory.SharedMemory(name=name)
+        if bytes(self._shm.buf[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"Shared memory segment '{name}' is not a live state segment")
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._snap = _Snapshot()
+        self._local_src: Tuple = ()
+        self._local = _LocalView([], [])
+
+    def _snapshot(self) -> _Snapshot:
+        buf = self._shm.buf
+        with self._lock:
+            for _ in range(READ_RETRIES):
+                seq = _SEQ.unpack_from(buf, _SEQ_OFFSET)[0]
+                if seq == self._seq:
+                    return self._snap
+                if seq & 1:
+                    time.sleep(0.0001)
+                    continue
+                length, crc = _LENGTH.unpack_from(buf, _LENGTH_OFFSET)
+                if length > SEGMENT_SIZE - _PAYLOAD_OFFSET:
+                    continue
+                data = bytes(buf[_PAYLOAD_OFFSET:_PAYLOAD_OFFSET + length])
+                if _SEQ.unpack_from(buf, _SEQ_OFFSET)[0] != seq or zlib.crc32(data) != crc:
+                    continue
+                self._seq, self._snap = seq, _Snapshot(data)
+                return self._snap
+            # 连续读到写入中（写入者在写入途中停住），沿用上一份完整快照
+            return self._snap
+
+    @property
+    def ready(self) -> bool:
+        """抓包进程是否已完成首次发布。"""
+        return _SEQ.unpack_from(self._shm.buf, _SEQ_OFFSET)[0] >= 2
+
+    @property
+    def age(self) -> float:
+        """最近一次发布距今的秒数，抓包进程停止时持续增长。"""
+        published = self._snapshot().published_at
+        return time.time() - published if published else float('inf')
+
+    def db_version(self) -> int:
+        return _VERSION.unpack_from(self._shm.buf, _VERSION_OFFSET)[0]
+
+    @property
+    def last_maintenance(self) -> Optional[Dict]:
+        return self._snapshot().meta['last_maintenance']
+
+    # ── 与 PacketCapture / TrafficStats 一致的读取接口 ─────────────────────────
+
+    @property
+    def stats(self) -> 'LiveStateView':
+        """API 通过 capture.stats 访问统计，这里同一个对象同时提供两组接口。"""
+        return self
+
+    def get_hourly_snapshot(self) -> Dict[int, Dict]:
+        return {k: dict(v) for k, v in self._snapshot().hourly.items()}
+
+    def get_ip_top(self, first_hour: int = None, last_hour: int = None, n: int = 10
+                   ) -> Tuple[Dict[str, int], int]:
+        totals: Dict[int, int] = {}
+        truncated = 0
+        for hour_key, rows in self._snapshot().ip_hourly.items():
+            if (first_hour is not None and hour_key < first_hour) or (last_hour is not None and hour_key > last_hour):
+                continue
+            # 发布时已按字节数降序排列
+            if len(rows) > n:
+                truncated += rows[n - 1][1]
+            for key, b in rows[:n]:
+                totals[key] = totals.get(key, 0) + b
+        return {key_str(key): b for key, b in totals.items()}, truncated
+
+    def ip_error_bound(self) -> int:
+        return self._snapshot().error_bound
+
+    def get_realtime(self, seconds: int = 60, resolution: Optional[int] = None) -> List[Dict]:
+        resolution = resolution or pick_resolution(seconds)
+        rows = self._snapshot().samples.get(resolution, [])
+        # 与 RateRing.samples() 相同的窗口：含 now - seconds + 1 所在的桶
+        first = (int(time.time()) - seconds + 1) // resolution * resolution
+        return [{'ts': ts, 'up': u, 'down': d} for ts, u, d in rows if ts >= first]
+
+    @property
+    def kernel_drops_last_60s(self) -> int:
+        return self._snapshot().kernel_drops
+
+    @property
+    def socket_buffer_actual_kb(self) -> int:
+        return self._snapshot().socket_kb
+
+    @property
+    def local_state(self) -> _LocalView:
+        meta = self._snapshot().meta
+        src = (tuple(meta['ips']), tuple(meta['lan_prefixes']))
+        if src != self._local_src:
+            self._local_src, self._local = src, _LocalView(meta['ips'], meta['lan_prefixes'])
+        return self._local
+
+    @property
+    def manual_mode(self) -> bool:
+        return self._snapshot().meta['manual_mode']
+
+    def close(self):
+        self._shm.close()
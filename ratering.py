@@ -0,0 +1,105 @@
+"""
+ratering.py - 多分辨率实时速率环形缓冲
+
+tick 线程每秒记录一次 (时间戳, 上行字节, 下行字节)。原实现每秒追加到列表后再用
+推导式整体重建以裁掉过期采样，读取时再逐个扫描转字典。RateRing 为每个分辨率
+预分配定长 int64 数组，以 "时间戳 // 分辨率" 对容量取模定位槽位：
+  1 秒  × 600   最近 10 分钟
+  10 秒 × 2160  最近 6 小时
+  1 分  × 2880  最近 48 小时
+每次 add() 在每一级各更新一个槽位（O(1)），粗粒度级别累加当前桶，槽位中记录的
+桶号与当前不同即视为过期并重置，不需要单独的淘汰过程。内存占用固定约 180 KB。
+读取时按窗口长度选用能覆盖它的最细一级，返回每个桶的平均每秒字节数。
+"""
+
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+# (分辨率秒数, 桶数)，由细到粗
+TIERS: Tuple[Tuple[int, int], ...] = ((1, 600), (10, 2160), (60, 2880))
+
+# 可查询的最长窗口（秒）
+MAX_WINDOW = TIERS[-1][0] * TIERS[-1][1]
+
+
+def pick_resolution(seconds: int) -> int:
+    """能覆盖 seconds 秒窗口的最细分辨率。"""
+    for resolution, size in TIERS:
+        if seconds <= resolution * size:
+            return resolution
+    return TIERS[-1][0]
+
+
+class _Tier:
+    __slots__ = ('resolution', 'size', 'bucket', 'up', 'down', 'count')
+
+    def __init__(self, resolution: int, size: int):
+        self.resolution = resolution
+        self.size = size
+        # 槽位当前存放的桶号（时间戳 // 分辨率），-1 表示空
+        self.bucket = array('q', [-1]) * size
+        self.up = array('q', [0]) * size
+        self.down = array('q', [0]) * size
+        # 桶内采样数；求平均时除以它，tick 偶尔漏拍也不会把速率算低
+        self.count = array('q', [0]) * size
+
+    def add(self, ts: int, up: int, down: int):
+        b = ts // self.resolution
+        i = b % self.size
+        if self.bucket[i] != b:
+            self.bucket[i] = b
+            self.up[i] = self.down[i] = self.count[i] = 0
+        self.up[i] += up
+        self.down[i] += down
+        self.count[i] += 1
+
+    def rows(self, first_ts: int, last_ts: int) -> List[Tuple[int, int, int]]:
+        """[first_ts, last_ts] 内有采样的桶：(桶起始时间戳, 平均上行 B/s, 平均下行 B/s)"""
+        result = []
+        r = self.resolution
+        for b in range(max(first_ts // r, last_ts // r - self.size + 1), last_ts // r + 1):
+            i = b % self.size
+            n = self.count[i]
+            if self.bucket[i] == b and n:
+                result.append((b * r, self.up[i] // n, self.down[i] // n))
+        return result
+
+
+class RateRing:
+    """非线程安全，由调用方（TrafficStats）在持锁状态下访问。"""
+
+    def __init__(self, tiers: Tuple[Tuple[int, int], ...] = TIERS):
+        self._tiers = {resolution: _Tier(resolution, size) for resolution, size in tiers}
+        self.last_ts = 0
+
+    def add(self, ts: float, up: int, down: int):
+        ts = int(ts)
+        self.last_ts = max(self.last_ts, ts)
+        for tier in self._tiers.values():
+            tier.add(ts, up, down)
+
+    def samples(self, seconds: int, now: float, resolution: Optional[int] = None) -> List[Dict]:
+        """最近 seconds 秒（不含 now - seconds 这一刻）的采样；resolution 缺省按窗口自动选择。"""
+        tier = self._tiers.get(resolution or pick_resolution(seconds))
+        if tier is None:
+            return []
+        now = int(now)
+        return [{'ts': ts, 'up': up, 'down': down}
+                for ts, up, down in tier.rows(now - seconds + 1, now)]
+
+    def copy(self) -> 'RateRing':
+        """整块复制数组（memcpy），调用方可在锁外慢慢读取副本。"""
+        ring = RateRing.__new__(RateRing)
+        ring.last_ts = self.last_ts
+        ring._tiers = {}
+        for r, tier in self._tiers.items():
+            t = ring._tiers[r] = _Tier.__new__(_Tier)
+            t.resolution, t.size = tier.resolution, tier.size
+            t.bucket, t.up, t.down, t.count = (array('q', tier.bucket), array('q', tier.up),
+                                               array('q', tier.down), array('q', tier.count))
+        return ring
+
+    def tiers(self) -> Dict[int, List[Tuple[int, int, int]]]:
+        """各分辨率全部有效桶 {分辨率: [(ts, up, down)]}，供跨进程发布。"""
+        now = self.last_ts
+        return {r: tier.rows(now - r * tier.size + 1, now) for r, tier in self._tiers.items()}
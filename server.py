@@ -0,0 +1,68 @@
+"""
+server.py - Web 服务运行方式
+
+Flask 开发服务器（app.run(threaded=True)）每个请求新建一个线程、数量不设上限，
+仪表盘被频繁刷新时会与抓包线程争抢 CPU 和 GIL。生产模式改用 waitress：
+  - 固定大小的工作线程池，并发请求再多也只占用 threads 个线程
+  - 连接由单独的 I/O 线程异步管理，空闲 keep-alive 连接不占工作线程
+  - 可选调低工作线程的调度优先级（nice），CPU 紧张时内核优先调度其他进程
+waitress 未安装时回退到 werkzeug 开发服务器（同样可降低请求线程优先级）。
+
+nice 只适合 Web 服务独占解释器的情况（PROCESS_MODE=split 的 API 进程）。与抓包线程
+共用一个 GIL 时，低优先级的请求线程可能在持有 GIL 时被内核抢占，收包/解析线程只能
+等它重新被调度后释放 GIL——优先级反转，反而拖慢抓包。因此默认 nice=0 不调整。
+"""
+
+import logging
+import os
+import threading
+
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+logger = logging.getLogger('sentinel.server')
+
+# 同时保持的连接数上限，超出的新连接留在内核 backlog 中等待
+CONNECTION_LIMIT = 100
+
+# 空闲连接（含 keep-alive）的超时秒数；SSE 连接每 15 秒有心跳，不受影响
+CHANNEL_TIMEOUT = 120
+
+
+def _niced(app, nice: int):
+    """包装 WSGI 应用：每个请求线程首次处理请求时把自身 nice 值设为 nice。"""
+    local = threading.local()
+
+    def wrapped(environ, start_response):
+        if not getattr(local, 'niced', False):
+            local.niced = True
+            try:
+                # Linux 上 PRIO_PROCESS + 线程 ID 只作用于该线程，降低优先级无需特权
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), nice)
+            except (AttributeError, OSError) as e:
+                logger.debug(f"[Web] setpriority failed: {e}")
+        return app(environ, start_response)
+
+    return wrapped
+
+
+def serve(app, host: str, port: int, server: str = 'waitress', threads: int = 8, nice: int = 0):
+    """阻塞运行 Web 服务。server: 'waitress' | 'dev'"""
+    wsgi = _niced(app, nice) if nice > 0 else app
+
+    if server == 'waitress' and waitress is None:
+        logger.warning("[Web] waitress is not installed, falling back to the development server")
+        server = 'dev'
+
+    if server == 'waitress':
+        logger.info(f"[Web] Serving with waitress (threads={threads}, nice={nice})")
+        waitress.serve(wsgi, host=host, port=port, threads=threads,
+                       connection_limit=CONNECTION_LIMIT, channel_timeout=CHANNEL_TIMEOUT,
+                       ident='NetTraffic-Sentinel')
+        return
+
+    from werkzeug.serving import run_simple
+    logger.info(f"[Web] Serving with the development server (nice={nice})")
+    run_simple(host, port, wsgi, threaded=True)
@@ -0,0 +1,118 @@
+"""
+storage.py - 流量存储后端接口
+
+API、持久化线程与维护线程只通过 StorageBackend 访问存储，具体实现：
+  database.Database      SQLite 行存储（默认），小时表 + 天/月汇总表
+  colstore.ColumnarStore 内存映射列式文件，按小时偏移定位的定长 int64 数组，
+                         区间求和为前缀和 O(1) 查表；远端 IP 统计与维护仍委托给 SQLite
+
+所有日期参数为 'YYYY-MM-DD'，返回结构与字段名在各实现间保持一致。
+"""
+
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence
+
+
+class StorageBackend(ABC):
+
+    # ── 生命周期 ──────────────────────────────────────────────────────────────
+
+    @abstractmethod
+    def init_schema(self):
+        """创建/迁移存储结构，启动时调用一次。"""
+
+    @abstractmethod
+    def close(self):
+        """释放连接与文件映射。"""
+
+    def attach(self):
+        """
+        以只读方式打开已由另一进程 init_schema() 的存储（PROCESS_MODE=split 的 API 进程）。
+        SQLite 连接按需建立，无需处理；有进程内元数据的实现需覆盖。
+        """
+
+    def refresh(self):
+        """另一进程写入后刷新本进程的只读视图（元数据、映射长度等），默认无需处理。"""
+
+    # ── 写入 ──────────────────────────────────────────────────────────────────
+
+    @abstractmethod
+    def commit_stats(self, hourly_data: Dict[int, Dict],
+                     ip_hourly: Optional[Dict[int, Dict[str, int]]] = None, journal_gen: int = 0) -> float:
+        """
+        累加写入一批小时增量：
+          hourly_data: {hour_key: {'up', 'down', 'tz_offset'}}
+          ip_hourly:   {hour_key: {远端IP: 字节数}}，可选
+          journal_gen: 本批已包含的溢写日志最大代次，与小时计数器原子地一并记录（见 journal.py）
+        返回写入耗时（秒）。抛出异常表示本批未写入，调用方会原样重试。
+        """
+
+    @abstractmethod
+    def journal_generation(self) -> int:
+        """已写入存储的溢写日志最大代次，从未记录时为 0；重放时跳过代次不超过它的分段。"""
+
+    # ── 流量查询 ──────────────────────────────────────────────────────────────
+
+    @abstractmethod
+    def get_today_stats(self) -> Dict:
+        """{'up_bytes', 'down_bytes', 'total_bytes'}"""
+
+    @abstractmethod
+    def get_month_stats(self) -> Dict:
+        """本月合计，结构同 get_today_stats()"""
+
+    @abstractmethod
+    def get_year_stats(self) -> Dict:
+        """本年合计，结构同 get_today_stats()"""
+
+    @abstractmethod
+    def get_last_30days(self) -> List[Dict]:
+        """最近 30 天逐日记录（含今天，无数据的日期补 0）"""
+
+    @abstractmethod
+    def get_last_12months(self) -> List[Dict]:
+        """最近 12 个月逐月记录（含本月，无数据的月份补 0）"""
+
+    @abstractmethod
+    def query_range(self, start: str, end: str, granularity: str = 'day') -> Dict:
+        """{'summary': {...}, 'series': [...]}，granularity: 'hour' | 'day' | 'month'"""
+
+    @abstractmethod
+    def get_available_date_range(self) -> Dict:
+        """{'min': 'YYYY-MM-DD', 'max': 'YYYY-MM-DD'}，无数据时均为今天"""
+
+    @abstractmethod
+    def get_hourly_today(self) -> List[Dict]:
+        """今天有记录的小时 [{'hour_ts', 'up_bytes', 'down_bytes'}]"""
+
+    # ── 远端 IP 统计 ──────────────────────────────────────────────────────────
+
+    @abstractmethod
+    def get_top_ips(self, start: str, end: str, n: int = 10) -> List[Dict]:
+        """[start, end] 内字节数最多的 n 个远端 IP [{'ip', 'bytes'}]"""
+
+    @abstractmethod
+    def get_ip_bytes(self, start: str, end: str, ips: Sequence[str]) -> Dict[str, int]:
+        """指定 IP 在 [start, end] 内已持久化的字节数"""
+
+    @abstractmethod
+    def get_ip_other_bytes(self, start: str, end: str) -> int:
+        """
+        [start, end] 内已持久化、未归属到具体 IP 的字节数（长尾行合计）。
+        任一 IP 的持久化字节数都是下界，真实值至多再多出这么多。
+        """
+
+    # ── 维护 ──────────────────────────────────────────────────────────────────
+
+    @property
+    @abstractmethod
+    def last_maintenance(self) -> Optional[Dict]:
+        """最近一次 run_maintenance() 的结果，尚未运行时为 None"""
+
+    @abstractmethod
+    def run_maintenance(self, hourly_months: int, daily_years: int, ip_retention_days: int) -> Dict:
+        """保留策略、压缩与空间回收，返回执行结果（含 duration_s）"""
+
+    @abstractmethod
+    def get_storage_info(self) -> Dict:
+        """存储占用（字节）"""
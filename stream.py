@@ -0,0 +1,138 @@
+"""
+stream.py - Server-Sent Events 广播
+
+仪表盘原先按固定周期轮询多个接口，每个打开的页面都各自触发一遍汇总计算与
+数据库查询。Broadcaster 由一个后台线程统一计算各类事件：
+  - 每个事件源按自己的周期计算一次，结果序列化为 SSE 帧
+  - 内容与上次相同时不推送
+  - 同一帧放入每个订阅者的队列，连接数再多也只计算一次
+新订阅者立即收到每类事件的最新一帧；没有订阅者时线程休眠，不做任何计算。
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('sentinel.stream')
+
+# 广播线程的调度粒度（秒），与 tick 线程的采样周期一致
+STREAM_TICK = 1.0
+
+# 每个订阅者最多积压的帧数；超出说明客户端读取过慢，断开后由浏览器自动重连
+CLIENT_QUEUE_SIZE = 64
+
+# 无事件时发送注释行的间隔（秒），防止反向代理判定连接空闲而断开
+HEARTBEAT_INTERVAL = 15
+
+# 浏览器断线后的重连等待（毫秒）
+RETRY_MS = 3000
+
+
+def _frame(event: str, payload: Dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, separators=(',', ':'), ensure_ascii=False)}\n\n"
+
+
+class Broadcaster:
+    """
+    sources: {事件名: (周期秒数, 生成负载的函数)}
+    生成函数在广播线程中调用，抛出异常时记录日志并跳过本周期。
+    max_clients: 同时订阅数上限（None 为不限）。每个 SSE 连接在 WSGI 服务器中
+    独占一个工作线程，需给普通请求留出余量。
+    """
+
+    def __init__(self, sources: Dict[str, Tuple[float, Callable[[], Dict]]],
+                 max_clients: Optional[int] = None):
+        self._sources = sources
+        self._max_clients = max_clients
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._clients: List[queue.Queue] = []
+        self._latest: Dict[str, str] = {}           # 事件名 → 最近一帧
+        self._due: Dict[str, float] = {name: 0.0 for name in sources}
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def client_count(self) -> int:
+        return len(self._clients)
+
+    def subscribe(self) -> Optional[queue.Queue]:
+        """新建订阅队列；已达 max_clients 时返回 None。"""
+        q: queue.Queue = queue.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        with self._lock:
+            if self._max_clients is not None and len(self._clients) >= self._max_clients:
+                return None
+            for frame in self._latest.values():
+                q.put_nowait(frame)
+            self._clients.append(q)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='sse-broadcast')
+                self._thread.start()
+            self._wake.notify()
+        return q
+
+    def unsubscribe(self, q: queue.Queue):
+        with self._lock:
+            if q in self._clients:
+                self._clients.remove(q)
+
+    def stream(self, q: queue.Queue) -> Iterator[str]:
+        """subscribe() 所得队列的 SSE 文本流（供 Flask Response 使用），断开时自动退订。"""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while True:
+                try:
+                    frame = q.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ": ping\n\n"
+                    continue
+                if frame is None:
+                    return      # 积压过多被广播线程踢出
+                yield frame
+        finally:
+            self.unsubscribe(q)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._clients:
+                    # 所有订阅者离开后清空缓存，重新有人订阅时立即计算最新数据
+                    self._latest.clear()
+                    self._due = {name: 0.0 for name in self._sources}
+                    self._wake.wait()
+            now = time.monotonic()
+            for name, (interval, build) in self._sources.items():
+                if now < self._due[name]:
+                    continue
+                self._due[name] = now + interval
+                try:
+                    frame = _frame(name, build())
+                except Exception as e:
+                    logger.warning(f"[SSE] Failed to build '{name}' event: {e}")
+                    continue
+                self._publish(name, frame)
+            time.sleep(STREAM_TICK)
+
+    def _publish(self, name: str, frame: str):
+        with self._lock:
+            if self._latest.get(name) == frame:
+                return
+            self._latest[name] = frame
+            for q in list(self._clients):
+                try:
+                    q.put_nowait(frame)
+                except queue.Full:
+                    self._clients.remove(q)
+                    self._kick(q)
+
+    @staticmethod
+    def _kick(q: queue.Queue):
+        """清空积压并放入结束标记，让该客户端的 stream() 退出。"""
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
+        q.put_nowait(None)
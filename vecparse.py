@@ -0,0 +1,170 @@
+"""
+vecparse.py - 基于 NumPy 的批量向量化解析
+
+逐包解析时每个包都要多次 struct.unpack_from、两次本地地址判定和一次统计加锁，
+高包速率下 Python 解释器开销占绝对大头。本模块把一整批帧（FrameBatch）视为
+n × stride 的 uint8 矩阵，一次性完成：
+  - 提取 EtherType / VLAN 偏移 / IP 长度 / 源与目的地址
+  - 与私有网段、本机地址、IPv6 排除前缀做向量化比较，得到上下行掩码
+  - 用 bincount 按远端地址聚合字节数（以 ipkey.py 的整数键输出，不格式化文本）
+每批只产生一次统计更新，逐包的 Python 开销被整批摊销。
+
+判定规则与 PacketCapture._handle_ipv4 / _handle_ipv6 完全一致：
+恰好一端属于本地侧时计费，本地侧为 src → 上行，否则 → 下行。
+
+NumPy 为可选依赖：未安装时 HAVE_NUMPY=False，调用方回退到逐包解析。
+"""
+
+import ipaddress
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+from ipkey import V4_MAPPED
+
+try:
+    import numpy as np
+    HAVE_NUMPY = True
+except ImportError:
+    np = None
+    HAVE_NUMPY = False
+
+# 批内帧数低于此值时向量化的固定开销得不偿失，由调用方走逐包解析
+VECTOR_MIN_BATCH = 32
+
+# 向量化解析要求每帧槽位至少容纳 VLAN + IPv6 固定头（14 + 4 + 40）
+_MIN_STRIDE = 58
+
+_ETH_P_IP    = 0x0800
+_ETH_P_IPV6  = 0x86DD
+_ETH_P_8021Q = 0x8100
+
+
+class LocalTables:
+    """
+    "本地侧"判定所需的只读数组，本机 IP / LAN 前缀变化时整体重建后替换。
+      v4_lo, v4_hi   : 私有网段整数区间
+      v4_local       : 本机 IPv4（uint32）
+      v6_local       : 本机 IPv6，(k, 2) 大端 uint64（高 64 位, 低 64 位）
+      v6_net, v6_mask: IPv6 排除/LAN 前缀，(p, 2) uint64 网络号与掩码
+    """
+
+    __slots__ = ('v4_lo', 'v4_hi', 'v4_local', 'v6_local', 'v6_net', 'v6_mask')
+
+    def __init__(self, v4_ranges: Sequence[Tuple[int, int]], v4_local: Iterable[int],
+                 v6_local: Iterable[bytes], v6_nets: Sequence[ipaddress.IPv6Network]):
+        self.v4_lo = np.array([lo for lo, _ in v4_ranges], dtype=np.uint32)
+        self.v4_hi = np.array([hi for _, hi in v4_ranges], dtype=np.uint32)
+        self.v4_local = np.array(sorted(v4_local), dtype=np.uint32)
+        self.v6_local = _split_u64([bytes(b) for b in v6_local])
+        self.v6_net = _split_u64([net.network_address.packed for net in v6_nets])
+        self.v6_mask = _split_u64([net.netmask.packed for net in v6_nets])
+
+
+def _split_u64(packed_list) -> 'np.ndarray':
+    """16 字节地址列表 → (k, 2) uint64 数组（按大端拆成高/低 64 位）。"""
+    if not packed_list:
+        return np.zeros((0, 2), dtype=np.uint64)
+    raw = np.frombuffer(b''.join(packed_list), dtype='>u8').reshape(-1, 2)
+    return raw.astype(np.uint64)
+
+
+def _be16(frames, rows, cols):
+    return (frames[rows, cols].astype(np.uint32) << 8) | frames[rows, cols + 1]
+
+
+def _be32(frames, rows, cols):
+    return ((frames[rows, cols].astype(np.uint32) << 24)
+            | (frames[rows, cols + 1].astype(np.uint32) << 16)
+            | (frames[rows, cols + 2].astype(np.uint32) << 8)
+            | frames[rows, cols + 3])
+
+
+def _is_local_v4(addrs, tables: LocalTables):
+    priv = ((addrs[:, None] >= tables.v4_lo) & (addrs[:, None] <= tables.v4_hi)).any(axis=1)
+    if tables.v4_local.size:
+        priv |= np.isin(addrs, tables.v4_local)
+    return priv
+
+
+def _is_local_v6(addrs, tables: LocalTables):
+    """addrs: (k, 2) uint64。命中本机地址或任一排除/LAN 前缀即为本地侧。"""
+    hi, lo = addrs[:, 0:1], addrs[:, 1:2]
+    local = np.zeros(len(addrs), dtype=bool)
+    if len(tables.v6_local):
+        local |= ((hi == tables.v6_local[:, 0]) & (lo == tables.v6_local[:, 1])).any(axis=1)
+    if len(tables.v6_net):
+        local |= (((hi & tables.v6_mask[:, 0]) == tables.v6_net[:, 0])
+                  & ((lo & tables.v6_mask[:, 1]) == tables.v6_net[:, 1])).any(axis=1)
+    return local
+
+
+def _direction(src_local, dst_local, ip_len):
+    """返回 (上行掩码, 下行掩码, 上行字节, 下行字节)。"""
+    up = src_local & ~dst_local
+    down = dst_local & ~src_local
+    return up, down, int(ip_len[up].sum()), int(ip_len[down].sum())
+
+
+def parse_batch(batch, tables: LocalTables) -> Optional[Tuple[int, int, Dict[int, int]]]:
+    """
+    向量化解析一批帧，返回 (上行字节, 下行字节, {远端地址整数键: 字节数})。
+    槽位过小（无法容纳完整 IP 头）时返回 None，由调用方逐包解析。
+    """
+    n = len(batch.caplens)
+    stride = batch.stride
+    if stride < _MIN_STRIDE:
+        return None
+
+    frames = np.frombuffer(batch.buf, dtype=np.uint8, count=n * stride).reshape(n, stride)
+    caplen = np.asarray(batch.caplens, dtype=np.int32)
+    rows = np.arange(n)
+
+    ethertype = _be16(frames, rows, 12)
+    vlan = ethertype == _ETH_P_8021Q
+    ethertype = np.where(vlan, _be16(frames, rows, 16), ethertype)
+    l3 = np.where(vlan, 18, 14)
+    avail = caplen - l3
+
+    up_bytes = down_bytes = 0
+    ip_bytes: Dict[int, int] = {}
+
+    # ── IPv4 ────────────────────────────────────────────────────────────────
+    m4 = (ethertype == _ETH_P_IP) & (avail >= 20)
+    if m4.any():
+        r, base = rows[m4], l3[m4]
+        ip_len = _be16(frames, r, base + 2).astype(np.int64)
+        src = _be32(frames, r, base + 12)
+        dst = _be32(frames, r, base + 16)
+        up, down, u, d = _direction(_is_local_v4(src, tables), _is_local_v4(dst, tables), ip_len)
+        up_bytes += u
+        down_bytes += d
+        counted = up | down
+        if counted.any():
+            remote = np.where(up, dst, src)[counted]
+            uniq, inv = np.unique(remote, return_inverse=True)
+            sums = np.bincount(inv, weights=ip_len[counted])
+            for addr, b in zip(uniq.tolist(), sums.tolist()):
+                ip_bytes[V4_MAPPED | addr] = int(b)
+
+    # ── IPv6 ────────────────────────────────────────────────────────────────
+    m6 = (ethertype == _ETH_P_IPV6) & (avail >= 40)
+    if m6.any():
+        r, base = rows[m6], l3[m6]
+        ip_len = 40 + _be16(frames, r, base + 4).astype(np.int64)
+        cols = base[:, None] + np.arange(16)
+        src_raw = np.ascontiguousarray(frames[r[:, None], cols + 8])
+        dst_raw = np.ascontiguousarray(frames[r[:, None], cols + 24])
+        src = src_raw.view('>u8').astype(np.uint64)
+        dst = dst_raw.view('>u8').astype(np.uint64)
+        up, down, u, d = _direction(_is_local_v6(src, tables), _is_local_v6(dst, tables), ip_len)
+        up_bytes += u
+        down_bytes += d
+        counted = up | down
+        if counted.any():
+            remote = np.where(up[:, None], dst, src)[counted]
+            uniq, inv = np.unique(remote, axis=0, return_inverse=True)
+            sums = np.bincount(inv.reshape(-1), weights=ip_len[counted])
+            for (hi, lo), b in zip(uniq.tolist(), sums.tolist()):
+                key = (hi << 64) | lo
+                ip_bytes[key] = ip_bytes.get(key, 0) + int(b)
+
+    return up_bytes, down_bytes, ip_bytes